@@ -1,19 +1,20 @@
 """
 Class representing a chatbot that utilizes langchain.
 """
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain.chains.conversation.memory import ConversationSummaryBufferMemory,ConversationBufferWindowMemory,ConversationBufferMemory
+from langchain.chains.conversation.memory import ConversationBufferWindowMemory,ConversationBufferMemory
 from langchain_openai import OpenAIEmbeddings
 from langchain_openai import ChatOpenAI
-from langchain.chains import ConversationalRetrievalChain
-from langchain_community.llms import OpenAI
 from langchain_community.callbacks.manager import get_openai_callback
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
 
 
 from langchain_mongodb import MongoDBChatMessageHistory
+from utils_Chromadb import get_vectordb, vectordb_count
+from summary_memory import RollingSummaryMemory, SummaryStore
+from single_flight import CoalescingChatOpenAI
+from topic_router import build_retriever
+from qa_engine import CHAIN_ANSWER_TEMPLATE, CONDENSE_TEMPLATE, SAMPLE_QUESTIONS, chain_engine
 
 
 
@@ -37,13 +38,13 @@ class EmbeddingChainChatBot():
         ef (OpenAIEmbeddings): Object representing the OpenAI embedding function.
         vectordb (Chroma): Chroma instance for storing and retrieving document embeddings.
         retriever (ChromaRetriever): Retriever instance for similarity search.
-        qachat (ConversationalRetrievalChain): Conversational retrieval chain for handling conversations.
+        engine (QAEngine): Staged engine condensing, retrieving and answering the questions.
 
     Methods:
         __init__(): Initialize the EmbeddingChainChatBot instance.
         ask_model(question, print_info): Process user's question and generate a response.
     """
-    def __init__(self,session_id, memory_type='buffer_window'):
+    def __init__(self,session_id, memory_type='buffer_window', vectordb=None, topic_router=None, embedding_cache=None, persist_async=False):
         """
         Initialize the EmbeddingChainChatBot instance.
 
@@ -51,19 +52,23 @@ class EmbeddingChainChatBot():
             memory_type (str): Type of memory to use for conversation history.
                 - 'buffer': Basic buffer memory.
                 - 'buffer_window': Buffer window memory with a limited number of previous messages.
-                - 'buffer_summary': Summary buffer memory with a token limit.
+                - 'buffer_summary': Rolling summary of the earlier turns, stored in MongoDB, and the last turns.
                 Default is 'buffer_window'.
+            vectordb (VectorStore): Vector store shared with other chatbots. Default opens the one selected by VECTOR_BACKEND.
+            topic_router (TopicRouter): Routes the questions to the chunks of their closest topics. Default searches every chunk.
+            embedding_cache (EmbeddingCache): Cache of the question embeddings shared with other chatbots. Default embeds every question.
+            persist_async (bool): Whether each turn is saved to the chat history after the answer is returned. Default saves it before.
 
         Attributes:
             GPTmodel_name (str): The name of the GPT model to use (default: "gpt-3.5-turbo-1106").
             temperature_gpt (float): The temperature for GPT response generation (default: 0.5).
             llm (ChatOpenAI): ChatOpenAI instance for GPT-based language models.
-            llm_memory (OpenAI): OpenAI instance for memory-related language models.
+            llm_memory (ChatOpenAI): ChatOpenAI instance summarizing the conversation in 'buffer_summary' mode.
             memory_tokens (int): The maximum number of tokens to use for conversation history memory (default: 200).
             embedding_number_documents (int): The number of documents to retrieve in the similarity search (default: 3).
             total_cost (float): Total cost of tokens used by GPT-3.5 Turbo.
             last_memory_messages (int): Number of previous messages to store in memory.
-            memory (ConversationBufferMemory or ConversationBufferWindowMemory or ConversationSummaryBufferMemory): Memory instance based on the specified type.
+            memory (ConversationBufferMemory or ConversationBufferWindowMemory or RollingSummaryMemory): Memory instance based on the specified type.
 
         Example:
             chatbot = EmbeddingChainChatBot(memory_type='buffer_window')
@@ -86,12 +91,16 @@ class EmbeddingChainChatBot():
         self.total_cost = 0
         self.memory_type = memory_type
         self.session_id = session_id   
+        self.vectordb = vectordb
+        self.topic_router = topic_router
+        self.embedding_cache = embedding_cache
+        self.persist_async = persist_async
         self.setup_model()
         
         
     def setup_model(self):
         """
-        Set up the EmbeddingChainChatBot model by configuring memory, embeddings, and the conversational retrieval chain.
+        Set up the EmbeddingChainChatBot model by configuring memory, embeddings, and the QA engine.
 
         Raises:
             ValueError: If an invalid memory_type is provided.
@@ -112,57 +121,66 @@ class EmbeddingChainChatBot():
             self.last_memory_messages = 2
             self.memory = ConversationBufferWindowMemory(k=self.last_memory_messages, memory_key="chat_history", input_key='question', output_key='answer', return_messages=True,chat_memory=self.message_history)
         elif self.memory_type == 'buffer_summary':
-            llm_memory = OpenAI(temperature=self.temperature_gpt, model_name=self.GPTmodel_name)
-            self.memory = ConversationSummaryBufferMemory(llm=llm_memory, max_token_limit=self.memory_tokens, memory_key="chat_history",
-                                         input_key='question', output_key='answer', return_messages=True,chat_memory=self.message_history)
+            # The summary is updated by update_memory() after the answer is returned, not while answering.
+            self.last_memory_messages = 2
+            llm_memory = ChatOpenAI(temperature=0, model_name=self.GPTmodel_name)
+            self.memory = RollingSummaryMemory(llm=llm_memory, summary_store=SummaryStore(self.message_history.db), k=self.last_memory_messages,
+                                               memory_key="chat_history", input_key='question', output_key='answer', return_messages=True,
+                                               chat_memory=self.message_history)
         else: 
             print("please input a valid memory type: \n buffer, buffer_window, buffer_summary")
-        self.ef = OpenAIEmbeddings()
-            
-        self.vectordb = Chroma(persist_directory=f"./abogacia_data", embedding_function=self.ef)
-
-        print("There are",  self.vectordb._collection.count(), "in the collection")
-        self.retriever = self.vectordb.as_retriever(search_kwargs={"k": self.embedding_number_documents})
+        if self.vectordb is None:
+            self.ef = OpenAIEmbeddings()
+            self.vectordb = get_vectordb(self.ef)
+        else:
+            self.ef = self.vectordb.embeddings
+
+        print("There are",  vectordb_count(self.vectordb), "in the collection")
+        # Identical concurrent questions of any session share one embedding, one search and one LLM call.
+        self.retriever = build_retriever(self.vectordb, {"k": self.embedding_number_documents}, self.topic_router, self.embedding_cache)
         
         
-        llm = ChatOpenAI(temperature=self.temperature_gpt, model_name=self.GPTmodel_name)
+        llm = CoalescingChatOpenAI(temperature=self.temperature_gpt, model_name=self.GPTmodel_name)
         self.prompt_generation()
-        # Create the multipurpose chain
-        print()
-        self.qachat = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            memory=self.memory,
-            retriever=self.retriever, 
-            condense_question_prompt = self.condense_prompt,
-            combine_docs_chain_kwargs={"prompt": self.question_prompt},
-            return_source_documents=True,
-            verbose=True,
-            
-        )
+        self.engine = chain_engine(self.memory, self.retriever, llm, k=self.embedding_number_documents, persist_async=self.persist_async,
+                                   condense_prompt=self.condense_prompt, answer_prompt=self.question_prompt)
     def load_chat_history(self):
+        self.engine.wait_persisted()
         return self.message_history.messages
+
+    def update_memory(self):
+        """
+        Folds the turns that left the memory window into the rolling summary of the session, in 'buffer_summary' mode.
+        Meant to run after the answer has been returned, e.g. in a FastAPI background task.
+        """
+        if isinstance(self.memory, RollingSummaryMemory):
+            self.engine.wait_persisted()
+            try:
+                self.memory.update_summary()
+            except Exception as e:
+                print(f"Failed to update the summary of session {self.session_id}: {e}")
     
-    def ask_model(self,question,print_info = False):
+    def ask_model(self,question,print_info = False, filters=None):
         """
         Process user's question and generate a response.
 
         Args:
             question (str): The user's input question.
             print_info (bool): Whether to print additional information about the response (default: False).
+            filters (dict): Metadata filters (topic, court, chamber, year, doc_id) pushed down into the vector search (default: None).
 
         Returns:
             str: The response generated by the chatbot.
         """
         with get_openai_callback() as cost:
-            data =self.qachat(question)
-            answer = data['answer']
-            print(data)
+            turn = self.engine.ask(question, filters)
+            answer = turn.answer
             
             
         if print_info == True:
         
             # Extracting the 'source' metadata information
-            sources = [doc.metadata.get('source', '') for doc in data.get('source_documents', [])]
+            sources = [doc.metadata.get('source', '') for doc in turn.source_documents]
 
             # Print the extracted 'source' information
             print('Sources: \n ')
@@ -174,6 +192,7 @@ class EmbeddingChainChatBot():
 # # Print the extracted 'chat_history'
 #             for idx, message in enumerate(chat_history, start=1):
 #                 print(f"Message {idx}: {message}")
+            print("timings:", {stage: round(seconds, 3) for stage, seconds in turn.timings.items()})
             print(f'cost:{cost}  \n ')
             self.total_cost += cost.total_tokens
             print("self.total_cost ",self.total_cost )
@@ -189,45 +208,8 @@ class EmbeddingChainChatBot():
 
         """
         
-        template_condense = """
-            Given a chat history and the latest user question \
-            which might reference the chat history, formulate a standalone question \
-            which can be understood without the chat history. Do NOT answer the question, \
-            just reformulate it if needed and otherwise return it as is.
-            Return the standalone question in the same language as the input
-
-            Chat History:
-            {chat_history}
-            Follow Up Input: {question}
-            Standalone question:"""
-            
-        self.condense_prompt= PromptTemplate.from_template(template_condense)
-        
-        
-        
-   
-        template = ("""
-                     \
-                    
-                    instructions: 
-                    - You are a lawyer expert assistant that helps to solve, instruct and assist to a lawyer in different juridical cases . \
-                    - You give recommendations, build documents, and continuously ask how you can help.
-                    - provide complete informative answers, Focus on providing helpful and relevant information,
-                    - Always Answer the Question in the same language as the user question.
-                    - you return the helpful answer directly
-                    - if you are asked for a document, letter, email or similar, please return the document template with all the required information.
-                    
-                    use the context as reference that may help in the juridical case, however if you dont consider it useful information still try to help the person
-                    remember that the new user question can be related with the chat history.
-                    Context that may help to answer question:\n{context}
-
-                    Chat History:\n{chat_history}
-
-                    Answer the User question:\n{question}
-
-                    """)
-        
-        self.question_prompt = PromptTemplate.from_template(template)
+        self.condense_prompt= PromptTemplate.from_template(CONDENSE_TEMPLATE)
+        self.question_prompt = PromptTemplate.from_template(CHAIN_ANSWER_TEMPLATE)
         
         
 if __name__ == "__main__":
@@ -235,28 +217,7 @@ if __name__ == "__main__":
     session_id = 'test_session_1'
 
     chatbot = EmbeddingChainChatBot(session_id)
-    questions = preguntas = [
-    "Solicita asesoría sobre los derechos y obligaciones en casos de abandono de menores.",
-    "¿Cómo proceder legalmente ante un caso de abandono de bienes por parte de un cónyuge?",
-    "Necesito orientación sobre el proceso de divorcio y los pasos legales a seguir.",
-    "Genera una carta para solicitar la custodia de un menor ante el juzgado.",
-    "Ayúdame a redactar un documento de conciliación en un proceso de divorcio.",
-    "Quiero presentar una petición ante el juzgado de familia, ¿qué información necesito incluir?",
-    "¿Cuáles son los requisitos legales para establecer una pensión alimenticia?",
-    "Proporciona orientación sobre cómo responder a una solicitud de paternidad.",
-    "Necesito redactar una carta de notificación sobre el incumplimiento de visitas a menores.",
-    "¿Qué documentos son necesarios para iniciar un proceso de adopción?",
-    "¿Cómo solicitar una modificación de medidas en un proceso de divorcio?",
-    "Ayúdame a redactar una queja formal ante la entidad reguladora.",
-    "Genera un documento para solicitar la revisión de una sentencia judicial.",
-    "Solicita información sobre los derechos de visita en casos de custodia compartida.",
-    "¿Qué pasos debo seguir para realizar una separación de bienes?",
-    "Ayúdame a redactar una carta de reclamación por incumplimiento de contrato.",
-    "Necesito orientación sobre cómo presentar una demanda por violencia intrafamiliar.",
-    "¿Qué información debo incluir en una solicitud de medidas cautelares?",
-    "Genera un documento para solicitar la liquidación de bienes gananciales.",
-    "Solicita asistencia para redactar una carta de autorización para representación legal."
-]
+    questions = SAMPLE_QUESTIONS
 
     for i, question in enumerate(questions, 1):
         start_time = time.time()
@@ -0,0 +1,180 @@
+"""
+Admission control of the chat API: a global cap on the questions answered at once, a bounded wait queue, one
+question at a time per session and round-robin between the sessions that are waiting.
+
+The scheduler runs on the event loop of the worker, so waiting requests hold no thread. A question is admitted when a
+slot is free and its session has no question running; a later question of the same session waits for it, so the
+memory of an EmbeddingChainChatBot is never used by two requests at once. When slots free up they go to the waiting
+sessions in turn, one question each, so a session sending many questions does not delay the others. A request is
+rejected with `AdmissionRejected`, answered as 429 with Retry-After, when the queue or the queue of its session is
+full, or when it waited longer than the queue timeout.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        retry_after (int): The seconds after which the client should retry.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Scheduler of the questions of one worker. Must be used from its event loop.
+
+    Attributes:
+        max_concurrent (int): The questions answered at once.
+        max_queue (int): The questions waiting at once, over all sessions.
+        max_session_queue (int): The questions of one session waiting at once.
+        queue_timeout (float): The seconds a question waits before it is rejected.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=64, max_session_queue=2, queue_timeout=30.0, history=1000):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_session_queue = max_session_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._running = set()
+        # Waiting requests of each session, and the sessions that can be admitted, in turn.
+        self._pending = {}
+        self._ready = deque()
+        self._waiting = 0
+        self._wait_times = deque(maxlen=history)
+        self._service_time = None
+        self._counts = {"admitted": 0, "rejected_queue_full": 0, "rejected_session_queue_full": 0, "timed_out": 0}
+
+    def _retry_after(self):
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil((self._waiting + 1) / self.max_concurrent * service_time))
+
+    def _start(self, session_id, wait_time):
+        self._active += 1
+        self._running.add(session_id)
+        self._wait_times.append(wait_time)
+        self._counts["admitted"] += 1
+
+    def _dispatch(self):
+        while self._active < self.max_concurrent and self._ready:
+            session_id = self._ready.popleft()
+            queue = self._pending[session_id]
+            future, enqueued = queue.popleft()
+            if not queue:
+                del self._pending[session_id]
+            self._waiting -= 1
+            self._start(session_id, time.perf_counter() - enqueued)
+            future.set_result(None)
+
+    def _remove(self, session_id, entry):
+        queue = self._pending[session_id]
+        queue.remove(entry)
+        self._waiting -= 1
+        if not queue:
+            del self._pending[session_id]
+            if session_id in self._ready:
+                self._ready.remove(session_id)
+
+    async def acquire(self, session_id):
+        """
+        Waits until a question of the session can be answered.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Raises:
+            AdmissionRejected: If the queue or the queue of the session is full, or the wait timed out.
+        """
+        if session_id not in self._running and session_id not in self._pending and self._active < self.max_concurrent:
+            self._start(session_id, 0.0)
+            return
+        if self._waiting >= self.max_queue:
+            self._counts["rejected_queue_full"] += 1
+            raise AdmissionRejected("Too many questions are waiting, please retry.", self._retry_after())
+        if len(self._pending.get(session_id, ())) >= self.max_session_queue:
+            self._counts["rejected_session_queue_full"] += 1
+            raise AdmissionRejected("This session already has questions waiting, please retry.", self._retry_after())
+
+        entry = (asyncio.get_running_loop().create_future(), time.perf_counter())
+        if session_id not in self._pending:
+            self._pending[session_id] = deque()
+            if session_id not in self._running:
+                self._ready.append(session_id)
+        self._pending[session_id].append(entry)
+        self._waiting += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[0]), self.queue_timeout)
+        except BaseException as error:
+            if entry[0].done():
+                # Admitted while being cancelled, the slot is given back.
+                self.release(session_id)
+            else:
+                entry[0].cancel()
+                self._remove(session_id, entry)
+            if isinstance(error, asyncio.TimeoutError):
+                self._counts["timed_out"] += 1
+                raise AdmissionRejected("The question waited too long, please retry.", self._retry_after()) from None
+            raise
+
+    def release(self, session_id, service_time=None):
+        """
+        Frees the slot of the session and admits the next waiting questions.
+
+        Args:
+            session_id (str): The id of the session.
+            service_time (float, optional): The seconds the question took, used to estimate Retry-After.
+        """
+        self._active -= 1
+        self._running.discard(session_id)
+        if service_time is not None:
+            self._service_time = service_time if self._service_time is None else 0.9 * self._service_time + 0.1 * service_time
+        if session_id in self._pending:
+            self._ready.append(session_id)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, session_id):
+        """
+        Context manager holding a slot for a question of the session.
+
+        Raises:
+            AdmissionRejected: If the question is not admitted.
+        """
+        await self.acquire(session_id)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(session_id, time.perf_counter() - start_time)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The running and waiting questions, the admitted and rejected ones, and the wait times in seconds.
+        """
+        wait_times = sorted(self._wait_times)
+
+        def percentile(fraction):
+            return round(wait_times[min(len(wait_times) - 1, int(fraction * len(wait_times)))], 4) if wait_times else 0.0
+
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "sessions_waiting": len(self._pending),
+            **self._counts,
+            "wait_seconds": {"p50": percentile(0.5), "p95": percentile(0.95), "max": round(wait_times[-1], 4) if wait_times else 0.0},
+            "service_seconds": round(self._service_time, 4) if self._service_time is not None else None,
+        }
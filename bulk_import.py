@@ -0,0 +1,297 @@
+"""
+Imports a directory tree of firm documents (pdf, docx and txt) into the vector database without the crawler.
+
+Files are parsed and chunked in a pool of processes, their chunks are embedded in token packed batches by the
+EmbeddingExecutor and stored with ids derived from the file path, so an interrupted import can be run again. The
+chunks an earlier import stored for a file are deleted before its new chunks are stored. Every file whose chunks are
+stored is recorded in the document catalog, so it can be deleted like a downloaded ruling, and appended to a
+checkpoint, which a resumed import skips. The run ends with a JSON report of the files, pages, chunks, failures and
+throughput.
+
+Usage:
+    python bulk_import.py /archive/contratos --topic contratos --workers 8
+    python bulk_import.py /archive/contratos --parse-only
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+from document_catalog import DEFAULT_CATALOG_PATH, INGESTED, DocumentCatalog, file_sha256
+from text_extraction import CHUNK_OVERLAP, CHUNK_SIZE, SUPPORTED_EXTENSIONS, is_cache_file, iter_pages
+from utils_Chromadb import (add_embedded_texts, delete_source_chunks, document_metadata_from_path, get_vectordb,
+                            sanitize_topic)
+
+PROGRESS_SECONDS = 5
+
+
+def find_files(root, checkpoint=None):
+    """
+    Lists the supported files under `root` that are not in the checkpoint, or changed since.
+
+    Args:
+        root (str): The directory to import.
+        checkpoint (dict, optional): Path to the (size, mtime) of the files already imported.
+
+    Returns:
+        list: The absolute paths of the files to import, sorted.
+    """
+    checkpoint = checkpoint or {}
+    paths = []
+    for foldername, subfolders, filenames in os.walk(root):
+        subfolders[:] = sorted(subfolder for subfolder in subfolders if not subfolder.startswith("."))
+        for filename in sorted(filenames):
+            # The text extracted from a pdf or docx is cached next to it as `<file>.txt`, it is not a document.
+            if not filename.lower().endswith(SUPPORTED_EXTENSIONS) or is_cache_file(filename):
+                continue
+            path = os.path.abspath(os.path.join(foldername, filename))
+            stat = os.stat(path)
+            if checkpoint.get(path) != (stat.st_size, int(stat.st_mtime)):
+                paths.append(path)
+    return paths
+
+
+def load_checkpoint(path):
+    """
+    Returns:
+        dict: Path to the (size, mtime) of the files recorded in the checkpoint file.
+    """
+    checkpoint = {}
+    if os.path.exists(path):
+        with open(path) as checkpoint_file:
+            for line in checkpoint_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    checkpoint[entry["path"]] = (entry["size"], entry["mtime"])
+    return checkpoint
+
+
+def import_doc_id(path):
+    """
+    Returns:
+        str: The document id of an imported file, derived from its path. Unlike the providencia numbers the crawled
+            rulings are named after, the names of firm documents repeat across folders and extensions.
+    """
+    return hashlib.sha1(path.encode("utf-8")).hexdigest()[:16]
+
+
+def chunk_ids(path, count):
+    """
+    Returns:
+        list: Ids of the chunks of a file that stay the same between runs, so an interrupted import overwrites them.
+    """
+    prefix = import_doc_id(path)
+    return [f"{prefix}-{index}" for index in range(count)]
+
+
+def parse_file(path, topic=None, use_cache=True):
+    """
+    Parses and chunks a file in a worker process.
+
+    Args:
+        path (str): The absolute path of the file.
+        topic (str, optional): The topic of the chunks.
+        use_cache (bool): Whether to read and write the cached text next to pdf and docx files.
+
+    Returns:
+        dict: The path, size, mtime, SHA-256, pages, characters, chunks (text and metadata), parse seconds and error of
+            the file.
+    """
+    from langchain_text_splitters import CharacterTextSplitter
+
+    start_time = time.perf_counter()
+    stat = os.stat(path)
+    result = {"path": path, "size": stat.st_size, "mtime": int(stat.st_mtime), "pages": 0, "characters": 0,
+              "texts": [], "metadatas": [], "error": None}
+    try:
+        splitter = CharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        metadata = {**document_metadata_from_path(path, topic), "doc_id": import_doc_id(path)}
+        page_metadatas = []
+        for page_number, text in enumerate(iter_pages(path, use_cache)):
+            result["characters"] += len(text)
+            page_metadata = {"source": path, "file_path": path, "page": page_number, **metadata}
+            page_metadatas.append(page_metadata)
+            for chunk in splitter.split_text(text):
+                result["texts"].append(chunk)
+                result["metadatas"].append(page_metadata)
+        result["pages"] = len(page_metadatas)
+        result["sha256"] = file_sha256(path)
+        # The metadata of each page is shared by its chunks, the page count is only known once all are read.
+        for page_metadata in page_metadatas:
+            page_metadata["total_pages"] = result["pages"]
+    except Exception as error:
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+class BulkImporter:
+    """
+    Imports a directory tree into the vector database.
+
+    Attributes:
+        root (str): The directory to import.
+        topic (str): The topic of the chunks, None to only derive the document id from the filename.
+        workers (int): The parsing processes.
+        batch_chunks (int): The chunks embedded and stored together.
+        checkpoint_path (str): The JSON lines file of the imported files.
+        utils_db (UtilsDB): The vector database, None to only parse.
+        catalog (DocumentCatalog): The catalog the imported files are recorded in.
+        use_cache (bool): Whether to cache the text of pdf and docx files next to them.
+        stats (dict): The counters of the run.
+    """
+
+    def __init__(self, root, utils_db=None, topic=None, workers=None, batch_chunks=512, checkpoint_path=None,
+                 catalog=None, use_cache=True):
+        """
+        Args:
+            root (str): The directory to import.
+            utils_db (UtilsDB, optional): The vector database. Defaults to parsing without storing.
+            topic (str, optional): The topic of the chunks.
+            workers (int, optional): The parsing processes. Defaults to the number of CPUs.
+            batch_chunks (int): The chunks embedded and stored together.
+            checkpoint_path (str, optional): The checkpoint file. Defaults to `.bulk_import_checkpoint.jsonl` in `root`.
+            catalog (DocumentCatalog, optional): The document catalog. Defaults to the catalog of `utils_db`, or to
+                `downloads/catalog.db` when storing.
+            use_cache (bool): Whether to cache the text of pdf and docx files next to them, False to leave the
+                imported directory free of caches.
+        """
+        self.root = os.path.abspath(root)
+        self.utils_db = utils_db
+        self.topic = sanitize_topic(topic) if topic else None
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_chunks = batch_chunks
+        self.checkpoint_path = checkpoint_path or os.path.join(self.root, ".bulk_import_checkpoint.jsonl")
+        if catalog is None and utils_db is not None:
+            # An empty catalog is falsy, its length is its number of rulings.
+            catalog = utils_db.catalog if utils_db.catalog is not None else DocumentCatalog()
+        self.catalog = catalog
+        self.use_cache = use_cache
+        self.stats = {"files": 0, "failed": 0, "pages": 0, "characters": 0, "chunks": 0, "parse_seconds": 0.0}
+        self.failures = []
+        self._pending = []
+        self._pending_chunks = 0
+
+    def _flush(self):
+        """
+        Embeds the pending chunks, replaces the chunks stored for their files by earlier imports, then records the
+        files in the catalog and the checkpoint.
+        """
+        if not self._pending:
+            return
+        if self.utils_db is not None:
+            texts, metadatas, ids = [], [], []
+            for result in self._pending:
+                texts += result["texts"]
+                metadatas += result["metadatas"]
+                ids += chunk_ids(result["path"], len(result["texts"]))
+            embeddings = self.utils_db.embedding_executor.embed_documents(texts) if texts else []
+            # A changed file can have fewer chunks than when it was imported, its trailing ids would be left behind.
+            for result in self._pending:
+                delete_source_chunks(self.utils_db.vectordb, result["path"])
+            if texts:
+                add_embedded_texts(self.utils_db.vectordb, texts, embeddings, metadatas, ids)
+            for result in self._pending:
+                self.catalog.record_file(result["path"], self.topic, INGESTED, result["sha256"],
+                                         doc_id=import_doc_id(result["path"]))
+            with open(self.checkpoint_path, "a") as checkpoint_file:
+                for result in self._pending:
+                    checkpoint_file.write(json.dumps({"path": result["path"], "size": result["size"],
+                                                      "mtime": result["mtime"], "chunks": len(result["texts"])}) + "\n")
+        self._pending = []
+        self._pending_chunks = 0
+
+    def _print_progress(self, total, start_time):
+        elapsed = time.time() - start_time
+        embedded = f", {self.utils_db.embedding_executor.tokens} tokens embedded" if self.utils_db is not None else ""
+        print(f"{self.stats['files'] + self.stats['failed']}/{total} files, {self.stats['pages']} pages "
+              f"({self.stats['pages'] / elapsed:.0f} pages/s), {self.stats['chunks']} chunks{embedded}")
+
+    def run(self, report_path=None):
+        """
+        Imports the files not in the checkpoint.
+
+        Args:
+            report_path (str, optional): The JSON file the report is written to.
+
+        Returns:
+            dict: The report of the run.
+        """
+        start_time = time.time()
+        paths = find_files(self.root, load_checkpoint(self.checkpoint_path))
+        print(f"Importing {len(paths)} files from '{self.root}' with {self.workers} workers")
+        last_progress = start_time
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for result in pool.map(parse_file, paths, [self.topic] * len(paths), [self.use_cache] * len(paths),
+                                   chunksize=4):
+                if result["error"]:
+                    self.stats["failed"] += 1
+                    self.failures.append({"path": result["path"], "error": result["error"]})
+                    print(f"Failed to parse '{result['path']}': {result['error']}")
+                else:
+                    self.stats["files"] += 1
+                    self.stats["pages"] += result["pages"]
+                    self.stats["characters"] += result["characters"]
+                    self.stats["chunks"] += len(result["texts"])
+                    self._pending.append(result)
+                    self._pending_chunks += len(result["texts"])
+                self.stats["parse_seconds"] += result["seconds"]
+                if self._pending_chunks >= self.batch_chunks:
+                    self._flush()
+                if time.time() - last_progress >= PROGRESS_SECONDS:
+                    self._print_progress(len(paths), start_time)
+                    last_progress = time.time()
+        self._flush()
+        if paths:
+            self._print_progress(len(paths), start_time)
+
+        elapsed = time.time() - start_time
+        report = {
+            "root": self.root,
+            "topic": self.topic,
+            "workers": self.workers,
+            "elapsed_seconds": elapsed,
+            **self.stats,
+            "pages_per_second": self.stats["pages"] / elapsed if elapsed else None,
+            "failures": self.failures,
+            "embedding": self.utils_db.embedding_executor.report() if self.utils_db is not None else None,
+        }
+        if report_path:
+            with open(report_path, "w") as report_file:
+                json.dump(report, report_file, indent=2)
+            print(f"Report written to '{report_path}'")
+        return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a directory of pdf, docx and txt documents into the vector database.")
+    parser.add_argument("root", help="directory to import")
+    parser.add_argument("--topic", help="topic metadata of the chunks")
+    parser.add_argument("--workers", type=int, help="parsing processes, defaults to the number of CPUs")
+    parser.add_argument("--batch-chunks", type=int, default=512, help="chunks embedded and stored together")
+    parser.add_argument("--checkpoint", help="checkpoint file, defaults to .bulk_import_checkpoint.jsonl in the directory")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="document catalog the imported files are recorded in")
+    parser.add_argument("--report", default="bulk_import_report.json", help="JSON report of the run")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not write the extracted text next to each pdf and docx, e.g. for a read-only archive")
+    parser.add_argument("--parse-only", action="store_true", help="parse and chunk without embedding, to measure throughput")
+    args = parser.parse_args()
+
+    utils_db = None
+    if not args.parse_only:
+        import openai
+        from utils_Chromadb import UtilsDB
+
+        load_dotenv()
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        utils_db = UtilsDB(get_vectordb())
+    importer = BulkImporter(args.root, utils_db, topic=args.topic, workers=args.workers, batch_chunks=args.batch_chunks,
+                            checkpoint_path=args.checkpoint, catalog=DocumentCatalog(args.catalog) if utils_db else None,
+                            use_cache=not args.no_cache)
+    report = importer.run(args.report)
+    print(f"{report['files']} files, {report['failed']} failed, {report['pages']} pages, {report['chunks']} chunks "
+          f"in {report['elapsed_seconds']:.1f} seconds ({report['pages_per_second'] or 0:.0f} pages/s)")
@@ -0,0 +1,251 @@
+"""
+Paces the requests of the relatoria crawler by how fast the site answers. The number of concurrent requests grows by
+one per window of fast responses and halves on slow responses or transient errors (AIMD), and the delay between
+requests does the opposite, always within the configured limits. Transient failures (timeouts, dropped connections,
+429 and 5xx answers, elements not ready yet) are retried with jittered exponential backoff, and every failure is
+counted per topic by error class.
+"""
+import asyncio
+import random
+import time
+from collections import Counter, defaultdict
+
+# HTTP statuses worth retrying: timeouts, rate limiting and server errors.
+TRANSIENT_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Selenium exceptions raised while the page is still updating.
+TRANSIENT_BROWSER_ERRORS = {"TimeoutException", "StaleElementReferenceException", "ElementClickInterceptedException",
+                            "ElementNotInteractableException", "NoSuchElementException"}
+
+
+def classify_error(error):
+    """
+    Classifies an exception of httpx, Selenium or the fetcher, matching class names so neither library is imported.
+
+    Args:
+        error (Exception): The exception.
+
+    Returns:
+        tuple: The error class, e.g. "timeout", "connection", "http_503" or the exception name, and whether it is transient.
+    """
+    names = {cls.__name__ for cls in type(error).__mro__}
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return ("rate_limited" if status == 429 else f"http_{status}"), status in TRANSIENT_STATUSES
+    if names & TRANSIENT_BROWSER_ERRORS:
+        return ("timeout" if "TimeoutException" in names else type(error).__name__), True
+    if "TimeoutException" in names or isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "timeout", True
+    if "TransportError" in names or isinstance(error, ConnectionError):
+        return "connection", True
+    return type(error).__name__, False
+
+
+def retry_after(error):
+    """
+    Returns:
+        float: The seconds of the Retry-After header of a 429 or 503 answer, None if absent or not in seconds.
+    """
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class CrawlScheduler:
+    """
+    Adaptive concurrency, delay and retries of the crawler requests.
+
+    Attributes:
+        min_concurrency (int): The fewest concurrent requests.
+        max_concurrency (int): The most concurrent requests.
+        min_delay (float): The shortest pause before a request, in seconds.
+        max_delay (float): The longest pause before a request, in seconds.
+        target_latency (float): The response time above which the site is considered loaded, in seconds.
+        max_retries (int): The retries of a transient failure.
+        concurrency (int): The current number of concurrent requests allowed.
+        delay (float): The current pause before a request.
+        latency (float): The moving average of the response time.
+        errors (dict): Topic to a Counter of the failures per error class.
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=4, min_delay=0.0, max_delay=30.0, target_latency=3.0,
+                 max_retries=4, backoff_base=1.0, backoff_cap=60.0, delay_step=0.25):
+        """
+        Args:
+            min_concurrency (int): The fewest concurrent requests.
+            max_concurrency (int): The most concurrent requests.
+            min_delay (float): The shortest pause before a request, in seconds.
+            max_delay (float): The longest pause before a request, in seconds.
+            target_latency (float): The response time above which the site is considered loaded, in seconds.
+            max_retries (int): The retries of a transient failure.
+            backoff_base (float): The backoff of the first retry, doubled on each retry, in seconds.
+            backoff_cap (float): The longest backoff, in seconds.
+            delay_step (float): The additive change of the delay, in seconds.
+        """
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.delay_step = delay_step
+        # Start slow, the window grows by one request per window of fast responses.
+        self.window = float(min_concurrency)
+        self.delay = min_delay
+        self.latency = None
+        self.in_flight = 0
+        self.requests = Counter()
+        self.retries = Counter()
+        self.errors = defaultdict(Counter)
+        self._condition = None
+        self._loop = None
+
+    @property
+    def concurrency(self):
+        return int(self.window)
+
+    def observe(self, latency, ok=True):
+        """
+        Adapts the concurrency and delay to a response.
+
+        Args:
+            latency (float): The response time in seconds.
+            ok (bool): False for a transient failure.
+        """
+        self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        if ok and latency <= self.target_latency:
+            self.window = min(self.max_concurrency, self.window + 1 / max(self.window, 1))
+            self.delay = max(self.min_delay, self.delay - self.delay_step)
+        else:
+            self.window = max(self.min_concurrency, self.window / 2)
+            self.delay = min(self.max_delay, max(self.delay * 2, self.delay_step))
+
+    def backoff(self, attempt, error=None):
+        """
+        Returns:
+            float: The seconds to wait before retry `attempt`, the Retry-After of the answer or a full jitter backoff.
+        """
+        seconds = retry_after(error) if error is not None else None
+        if seconds is not None:
+            return min(seconds, self.backoff_cap)
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def record_error(self, topic, error):
+        """
+        Counts a failure of a topic by its error class.
+
+        Returns:
+            bool: Whether the error is transient.
+        """
+        error_class, transient = classify_error(error)
+        self.errors[topic][error_class] += 1
+        return transient
+
+    async def request(self, topic, send, retries=None):
+        """
+        Sends a request when a concurrency slot is free, retrying transient failures.
+
+        Args:
+            topic (str): The topic the request is for.
+            send (callable): Coroutine function sending the request and returning its response.
+            retries (int, optional): The retries of this request, 0 for requests that must not be sent twice.
+                Defaults to `max_retries`.
+
+        Returns:
+            The response of `send`.
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Each fetch runs in its own event loop, the condition belongs to the loop it was created in.
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < self.concurrency)
+                self.in_flight += 1
+            try:
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                start_time = time.perf_counter()
+                self.requests[topic] += 1
+                try:
+                    response = await send()
+                except Exception as error:
+                    transient = self.record_error(topic, error)
+                    if transient:
+                        self.observe(time.perf_counter() - start_time, ok=False)
+                    if not transient or attempt >= retries:
+                        raise
+                    failure = error
+                else:
+                    self.observe(time.perf_counter() - start_time)
+                    return response
+            finally:
+                async with self._condition:
+                    self.in_flight -= 1
+                    self._condition.notify_all()
+            attempt += 1
+            self.retries[topic] += 1
+            wait = self.backoff(attempt, failure)
+            print(f"Retrying a request of topic '{topic}' in {wait:.1f} seconds after {classify_error(failure)[0]} (attempt {attempt})")
+            await asyncio.sleep(wait)
+
+    def call(self, topic, function, *args, default=None, retries=None):
+        """
+        Calls a blocking step of the crawl, e.g. a Selenium click, retrying transient failures.
+
+        Args:
+            topic (str): The topic the step is for.
+            function (callable): The step.
+            *args: The arguments of the step.
+            default: The result when the step keeps failing or fails with a non transient error.
+            retries (int, optional): The retries of this step. Defaults to `max_retries`.
+
+        Returns:
+            The result of the step, or `default`.
+        """
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            self.pause()
+            start_time = time.perf_counter()
+            self.requests[topic] += 1
+            try:
+                result = function(*args)
+            except Exception as error:
+                transient = self.record_error(topic, error)
+                if not transient:
+                    print(f"Step {getattr(function, '__name__', function)} of topic '{topic}' failed: {error!r}")
+                    return default
+                self.observe(time.perf_counter() - start_time, ok=False)
+                if attempt < retries:
+                    self.retries[topic] += 1
+                    time.sleep(self.backoff(attempt + 1, error))
+            else:
+                self.observe(time.perf_counter() - start_time)
+                return result
+        return default
+
+    def pause(self):
+        """
+        Waits the current delay between requests.
+        """
+        if self.delay:
+            time.sleep(self.delay)
+
+    def report(self):
+        """
+        Prints the requests, retries and error classes of each topic and the current pacing.
+        """
+        latency = f"{self.latency:.2f} s" if self.latency is not None else "n/a"
+        print(f"Crawl pacing: concurrency {self.concurrency}, delay {self.delay:.2f} s, latency {latency}")
+        for topic in sorted(set(self.requests) | set(self.errors)):
+            errors = ", ".join(f"{error_class}: {count}" for error_class, count in self.errors[topic].most_common()) or "none"
+            print(f"  {topic}: {self.requests[topic]} requests, {self.retries[topic]} retries, errors {errors}")
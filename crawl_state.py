@@ -0,0 +1,274 @@
+"""
+Persistent crawl state of the relatoria, in a SQLite file next to the downloads: per topic the results page the
+crawl reached and the id of every result already handled, stored or failed. A restarted crawl skips the results it
+has seen without downloading them again, and an incremental crawl stops once it reaches the results of earlier runs.
+
+Usage:
+    python crawl_state.py status
+    python crawl_state.py reset --topic Divorcio
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_STATE_PATH = os.path.join("downloads", "crawl_state.db")
+
+STORED = "stored"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS topics (
+    topic TEXT PRIMARY KEY,
+    last_page INTEGER NOT NULL DEFAULT 0,
+    run_started REAL,
+    run_finished REAL,
+    exhausted INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS results (
+    topic TEXT NOT NULL,
+    result_id TEXT NOT NULL,
+    page INTEGER,
+    status TEXT NOT NULL,
+    filename TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL,
+    PRIMARY KEY (topic, result_id)
+);
+"""
+
+# The position of the result in the search, "Resultado: 3 de 120", which shifts whenever rulings are published.
+RESULT_COUNTER_PATTERN = re.compile(r"Resultado:\s*(\d+)\s*de\s*(\d+)", re.IGNORECASE)
+# The fields of the current ruling, listed as "Providencia: SC3727-2021" (written "SC 3727-2021" in some results) and
+# "Radicado: 11001-02-03-000-2020-01234-00" or "Radicación n.° 54321". The label keeps the rulings cited by the
+# summary out, they are not written after a label and a colon.
+PROVIDENCIA_FIELD_PATTERN = re.compile(
+    r"(?:n[úu]mero\s+de\s+)?providencia\s*:\s*((?:S|A)T?[CLP])\s?(\d{1,6})-((?:19|20)\d{2})(?!\d)", re.IGNORECASE)
+RADICADO_FIELD_PATTERN = re.compile(
+    r"(?:radicado|radicaci[oó]n|n[úu]mero\s+de\s+proceso)\s*(?:n\.?\s*[°º]|no\.?|número)?\s*:?\s*"
+    r"(\d{5}-\d{2}-\d{2}-\d{3}-\d{4}-\d{5}-\d{2}|\d{4,6})(?![\d-])", re.IGNORECASE)
+
+
+def result_fields(result_text):
+    """
+    Reads the providencia number and radicado of the current ruling from the text of the result form.
+
+    Args:
+        result_text (str): The text of the result form.
+
+    Returns:
+        dict: The "providencia" ("SC3727-2021") and "radicado", None when the result does not have them.
+    """
+    providencia = PROVIDENCIA_FIELD_PATTERN.search(result_text)
+    radicado = RADICADO_FIELD_PATTERN.search(result_text)
+    return {
+        "providencia": f"{providencia.group(1).upper()}{providencia.group(2)}-{providencia.group(3)}" if providencia else None,
+        "radicado": radicado.group(1) if radicado else None,
+    }
+
+
+def result_position(counter_text):
+    """
+    Reads the position of the current result from the "Resultado: N de M" counter of the result form.
+
+    Args:
+        counter_text (str): The text of the counter.
+
+    Returns:
+        tuple: The number of the current result and the number of results, or None if the counter cannot be read.
+    """
+    match = RESULT_COUNTER_PATTERN.search(counter_text or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def result_id(result_text):
+    """
+    Identifies a result of the relatoria across sessions and crawls, by its providencia number or, for results
+    without one, by the text describing it without its position in the search.
+
+    Args:
+        result_text (str): The text of the result form, see `relatoria_http_fetcher.result_description`.
+
+    Returns:
+        str: A short hash of the providencia number or of the whitespace normalized text.
+    """
+    providencia = result_fields(result_text)["providencia"]
+    key = providencia or " ".join(RESULT_COUNTER_PATTERN.sub(" ", result_text).split())
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+class CrawlStateStore:
+    """
+    SQLite store of the crawl cursor and seen results of each topic, shared by the HTTP fetcher and Selenium.
+
+    Attributes:
+        path (str): The path of the SQLite file.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        """
+        Args:
+            path (str): The path of the SQLite file, created with its directory if missing.
+        """
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Topics are fetched from several threads, the connection is shared behind a lock.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def topic_state(self, topic):
+        """
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            dict: The last_page, run_started, run_finished and exhausted flag of the topic, None if never crawled.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT last_page, run_started, run_finished, exhausted FROM topics WHERE topic = ?", (topic,)).fetchone()
+        if row is None:
+            return None
+        return {"last_page": row[0], "run_started": row[1], "run_finished": row[2], "exhausted": bool(row[3])}
+
+    def start_run(self, topic):
+        """
+        Marks the start of a crawl of the topic.
+
+        Returns:
+            int: The results page the previous run reached, 0 if none.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO topics (topic, run_started) VALUES (?, ?) "
+                "ON CONFLICT(topic) DO UPDATE SET run_started = excluded.run_started, run_finished = NULL",
+                (topic, time.time()))
+            return self.connection.execute("SELECT last_page FROM topics WHERE topic = ?", (topic,)).fetchone()[0]
+
+    def finish_run(self, topic, exhausted=False):
+        """
+        Marks the end of a crawl of the topic.
+
+        Args:
+            topic (str): The topic.
+            exhausted (bool): Whether the crawl reached the last results page, kept once a crawl did.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE topics SET run_finished = ?, exhausted = MAX(exhausted, ?) WHERE topic = ?",
+                                    (time.time(), int(exhausted), topic))
+
+    def save_page(self, topic, page):
+        """
+        Moves the cursor of the topic forward to `page`.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO topics (topic, last_page) VALUES (?, ?) "
+                "ON CONFLICT(topic) DO UPDATE SET last_page = MAX(last_page, excluded.last_page)",
+                (topic, page))
+
+    def is_seen(self, topic, result_id):
+        """
+        Returns:
+            bool: True if the result was stored or was a duplicate, failed results are fetched again.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM results WHERE topic = ? AND result_id = ?", (topic, result_id)).fetchone()
+        return row is not None and row[0] != FAILED
+
+    def mark_result(self, topic, result_id, page, status, filename=None, error=None):
+        """
+        Records the outcome of a result.
+
+        Args:
+            topic (str): The topic.
+            result_id (str): The id of the result, see `result_id`.
+            page (int): The results page of the result.
+            status (str): STORED, DUPLICATE or FAILED.
+            filename (str, optional): The name of the downloaded PDF.
+            error (str, optional): The error of a failed result.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO results (topic, result_id, page, status, filename, error, updated) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(topic, result_id) DO UPDATE SET page = excluded.page, status = excluded.status, "
+                "filename = COALESCE(excluded.filename, filename), error = excluded.error, "
+                "attempts = attempts + 1, updated = excluded.updated",
+                (topic, result_id, page, status, filename, error, time.time()))
+
+    def failed_results(self, topic=None):
+        """
+        Returns:
+            list: The (topic, result_id, page, attempts, error) of the failed results, of one topic or all of them.
+        """
+        query = "SELECT topic, result_id, page, attempts, error FROM results WHERE status = ?"
+        params = [FAILED]
+        if topic is not None:
+            query += " AND topic = ?"
+            params.append(topic)
+        with self.lock:
+            return self.connection.execute(query + " ORDER BY topic, page", params).fetchall()
+
+    def counts(self):
+        """
+        Returns:
+            dict: Topic to a dict of the number of results per status.
+        """
+        counts = {}
+        with self.lock:
+            rows = self.connection.execute("SELECT topic, status, COUNT(*) FROM results GROUP BY topic, status").fetchall()
+        for topic, status, count in rows:
+            counts.setdefault(topic, {})[status] = count
+        return counts
+
+    def reset(self, topic=None):
+        """
+        Forgets the cursor and seen results of one topic, or of all of them.
+        """
+        with self.lock, self.connection:
+            if topic is None:
+                self.connection.execute("DELETE FROM topics")
+                self.connection.execute("DELETE FROM results")
+            else:
+                self.connection.execute("DELETE FROM topics WHERE topic = ?", (topic,))
+                self.connection.execute("DELETE FROM results WHERE topic = ?", (topic,))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or reset the crawl state of the relatoria.")
+    parser.add_argument("command", choices=["status", "reset"])
+    parser.add_argument("--path", default=DEFAULT_STATE_PATH)
+    parser.add_argument("--topic", help="only this topic")
+    args = parser.parse_args()
+
+    state = CrawlStateStore(args.path)
+    if args.command == "status":
+        counts = state.counts()
+        with state.lock:
+            topics = [row[0] for row in state.connection.execute("SELECT topic FROM topics ORDER BY topic")]
+        for topic in topics:
+            if args.topic and topic != args.topic:
+                continue
+            topic_state = state.topic_state(topic)
+            finished = "finished" if topic_state["run_finished"] else "interrupted"
+            exhausted = ", exhausted" if topic_state["exhausted"] else ""
+            print(f"{topic}: page {topic_state['last_page']}, last run {finished}{exhausted}, results {counts.get(topic, {})}")
+        for topic, failed_id, page, attempts, error in state.failed_results(args.topic):
+            print(f"  failed {topic} page {page} result {failed_id} after {attempts} attempts: {error}")
+    else:
+        state.reset(args.topic)
+        print(f"Reset the crawl state of {args.topic or 'all topics'}")
+    state.close()
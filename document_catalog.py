@@ -0,0 +1,364 @@
+"""
+Catalog of the rulings already ingested, shared by every topic. The crawler reads the providencia number of each
+result from its field on the results page (else its radicado, else a hash of the result) and looks it up here before
+downloading, so a ruling listed under several topics is downloaded and embedded once.
+
+The catalog also indexes the downloaded files (topic, path, size, hash and ingestion status), so the downloader and
+the deletion of documents query it instead of walking `downloads/`.
+
+Usage:
+    python document_catalog.py status
+    python document_catalog.py import
+    python document_catalog.py rebuild
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from crawl_state import result_fields, result_id
+from utils_Chromadb import sanitize_topic
+
+DEFAULT_CATALOG_PATH = os.path.join("downloads", "catalog.db")
+
+# Ingestion status of a downloaded file.
+DOWNLOADED = "downloaded"
+INGESTED = "ingested"
+
+# Version of the identifiers table. Catalogs of version 0 mapped every number cited by a result to its ruling.
+IDENTIFIERS_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    added REAL NOT NULL,
+    topic TEXT,
+    path TEXT,
+    sha256 TEXT,
+    size INTEGER,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS identifiers (
+    identifier TEXT PRIMARY KEY,
+    doc_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_topics (
+    doc_id TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    PRIMARY KEY (doc_id, topic)
+);
+"""
+INDEXES = """
+CREATE INDEX IF NOT EXISTS documents_filename ON documents (filename);
+CREATE INDEX IF NOT EXISTS documents_topic ON documents (topic, status);
+CREATE INDEX IF NOT EXISTS documents_path ON documents (path);
+"""
+FILE_COLUMNS = ("topic", "path", "sha256", "size", "status")
+
+
+def document_identifiers(result_text):
+    """
+    Extracts the identifier of a result from the providencia or radicado field of the result form. The numbers
+    cited elsewhere in the result, e.g. by its summary, belong to other rulings and are ignored.
+
+    A case (radicado) can have several rulings, so the radicado only identifies results without a providencia number.
+
+    Args:
+        result_text (str): The text of the result form.
+
+    Returns:
+        list: The providencia number ("SC3727-2021"), else the radicado ("RAD:11001-02-03-000-2020-01234-00"),
+            else the hash of the result ("HASH:<result_id>").
+    """
+    fields = result_fields(result_text)
+    if fields["providencia"]:
+        return [fields["providencia"]]
+    if fields["radicado"]:
+        return [f"RAD:{fields['radicado']}"]
+    return [f"HASH:{result_id(result_text)}"]
+
+
+def file_sha256(path):
+    """
+    Returns:
+        str: The SHA-256 of a file, read in 1 MB blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def doc_id_from_filename(filename):
+    """
+    Returns:
+        str: The document id of a downloaded ruling, the providencia number its PDF is named after.
+    """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+class DocumentCatalog:
+    """
+    SQLite index of the ingested rulings: their document id, file, ingestion status, identifiers on the results page
+    and topics.
+
+    Attributes:
+        path (str): The path of the SQLite file.
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        """
+        Args:
+            path (str): The path of the SQLite file, created with its directory if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Topics are fetched from several threads, the connection is shared behind a lock.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            # Catalogs created before the files were indexed only have the doc_id, filename and added columns.
+            columns = {row[1] for row in self.connection.execute("PRAGMA table_info(documents)")}
+            for column in FILE_COLUMNS:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE documents ADD COLUMN {column} {'INTEGER' if column == 'size' else 'TEXT'}")
+            self.connection.executescript(INDEXES)
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] < IDENTIFIERS_VERSION:
+                # The cited numbers of older catalogs would skip the rulings they cite as already ingested. Forgetting
+                # them only costs a download, the ruling is still found by its document id once its PDF is named.
+                self.connection.execute("DELETE FROM identifiers")
+                self.connection.execute(f"PRAGMA user_version = {IDENTIFIERS_VERSION}")
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def lookup(self, identifiers):
+        """
+        Finds the ingested ruling of a result.
+
+        Args:
+            identifiers (list): The identifier of the result, see `document_identifiers`, or document ids.
+
+        Returns:
+            str: The document id of the ruling, or None if it was not ingested.
+        """
+        if not identifiers:
+            return None
+        placeholders = ", ".join("?" * len(identifiers))
+        # A file still DOWNLOADED failed to be stored, it is ingested again rather than skipped. Catalogs created
+        # before the files were indexed have no status, their rulings were ingested.
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT identifiers.doc_id FROM identifiers LEFT JOIN documents ON documents.doc_id = identifiers.doc_id "
+                f"WHERE identifier IN ({placeholders}) AND (status IS NULL OR status = ?) "
+                f"UNION SELECT doc_id FROM documents WHERE doc_id IN ({placeholders}) AND (status IS NULL OR status = ?) LIMIT 1",
+                [*identifiers, INGESTED, *identifiers, INGESTED]).fetchone()
+        return row[0] if row else None
+
+    def record_file(self, path, topic, status=DOWNLOADED, sha256=None, doc_id=None):
+        """
+        Records a downloaded ruling at its final path, replacing the previous entry of its document id.
+
+        Args:
+            path (str): The path of the file in `downloads/<topic>/`, or of a file imported by `bulk_import.py`.
+            topic (str): The topic it was downloaded for, None for an imported file without topic.
+            status (str): DOWNLOADED until its chunks are stored, then INGESTED.
+            sha256 (str, optional): The hash of the file when already known. Defaults to hashing the file.
+            doc_id (str, optional): The document id. Defaults to the filename of a crawled ruling, see
+                `doc_id_from_filename`; imported files pass the id derived from their path.
+
+        Returns:
+            str: The document id of the ruling.
+        """
+        path = os.path.abspath(path)
+        filename = os.path.basename(path)
+        doc_id = doc_id or doc_id_from_filename(filename)
+        sha256 = sha256 or file_sha256(path)
+        topic = sanitize_topic(topic) if topic else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO documents (doc_id, filename, added, topic, path, sha256, size, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(doc_id) DO UPDATE SET filename = excluded.filename, topic = excluded.topic, path = excluded.path, "
+                "sha256 = excluded.sha256, size = excluded.size, status = excluded.status",
+                (doc_id, filename, time.time(), topic, path, sha256, os.path.getsize(path), status))
+            if topic:
+                self.connection.execute("INSERT OR IGNORE INTO document_topics (doc_id, topic) VALUES (?, ?)",
+                                        (doc_id, topic))
+        return doc_id
+
+    def set_status(self, doc_id, status):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE documents SET status = ? WHERE doc_id = ?", (status, doc_id))
+
+    def file(self, filename):
+        """
+        Args:
+            filename (str): The name of a downloaded file, or the path of a file, which tells apart imported files
+                with the same name.
+
+        Returns:
+            dict: The doc_id, filename, topic, path, sha256, size and status of the file, None if not in the catalog.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT doc_id, filename, topic, path, sha256, size, status FROM documents WHERE filename = ? OR path = ?",
+                (filename, os.path.abspath(filename))).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("doc_id", "filename", "topic", "path", "sha256", "size", "status"), row))
+
+    def filenames(self, topic=None, status=INGESTED):
+        """
+        Args:
+            topic (str, optional): The topic whose directory holds the files. Defaults to every topic.
+            status (str, optional): The status of the files. Defaults to the ingested ones, None for every file.
+
+        Returns:
+            set: The filenames of the downloaded files.
+        """
+        query = "SELECT filename FROM documents WHERE path IS NOT NULL"
+        params = []
+        if topic is not None:
+            query += " AND topic = ?"
+            params.append(sanitize_topic(topic))
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        with self.lock:
+            return {row[0] for row in self.connection.execute(query, params)}
+
+    def pending_files(self):
+        """
+        Returns:
+            list: The doc_id, path and topic of the files downloaded but not ingested, e.g. when embedding failed.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT doc_id, path, topic FROM documents WHERE status = ? AND path IS NOT NULL", (DOWNLOADED,)).fetchall()
+        return [dict(zip(("doc_id", "path", "topic"), row)) for row in rows]
+
+    def remove(self, doc_id):
+        """
+        Forgets a deleted ruling, so a later crawl can download it again.
+        """
+        with self.lock, self.connection:
+            for table in ("documents", "identifiers", "document_topics"):
+                self.connection.execute(f"DELETE FROM {table} WHERE doc_id = ?", (doc_id,))
+
+    def register(self, doc_id, topic, identifiers=()):
+        """
+        Records the identifier a ruling had on the results page of `topic`.
+
+        Args:
+            doc_id (str): The document id, see `doc_id_from_filename`.
+            topic (str): The topic it was listed under.
+            identifiers (iterable): The identifier it had on the results page, see `document_identifiers`.
+        """
+        with self.lock, self.connection:
+            # The identifier is read from the field of the ruling itself, so the latest download is right.
+            self.connection.executemany(
+                "INSERT INTO identifiers (identifier, doc_id) VALUES (?, ?) "
+                "ON CONFLICT(identifier) DO UPDATE SET doc_id = excluded.doc_id",
+                [(identifier, doc_id) for identifier in identifiers])
+            self.connection.execute("INSERT OR IGNORE INTO document_topics (doc_id, topic) VALUES (?, ?)",
+                                    (doc_id, sanitize_topic(topic)))
+
+    def add_topic(self, doc_id, topic):
+        """
+        Records that an ingested ruling is also listed under `topic`.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO document_topics (doc_id, topic) VALUES (?, ?)",
+                                    (doc_id, sanitize_topic(topic)))
+
+    def topics(self, doc_id):
+        """
+        Returns:
+            list: The sanitized topics a ruling is listed under.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT topic FROM document_topics WHERE doc_id = ? ORDER BY topic", (doc_id,))
+            return [row[0] for row in rows]
+
+    def import_directory(self, download_dir):
+        """
+        Records the PDFs in `downloads/<topic>/` that are missing from the catalog or changed size, as ingested.
+        Used for catalogs created after the first crawls and by `rebuild`.
+
+        Args:
+            download_dir (str): The downloads directory.
+
+        Returns:
+            int: The number of PDFs recorded.
+        """
+        with self.lock:
+            known = dict(self.connection.execute("SELECT path, size FROM documents WHERE path IS NOT NULL").fetchall())
+        recorded = 0
+        for foldername, subfolders, filenames in os.walk(download_dir):
+            # Skip the staging directory of the browser downloads.
+            subfolders[:] = [subfolder for subfolder in subfolders if not subfolder.startswith(".")]
+            topic = os.path.relpath(foldername, download_dir).split(os.sep)[0]
+            if topic == ".":
+                continue
+            for filename in filenames:
+                path = os.path.abspath(os.path.join(foldername, filename))
+                if filename.endswith(".pdf") and known.get(path) != os.path.getsize(path):
+                    self.record_file(path, topic, INGESTED)
+                    recorded += 1
+        return recorded
+
+    def rebuild(self, download_dir):
+        """
+        Reconciles the catalog with `downloads/`: forgets the files that no longer exist and records the new ones.
+
+        Args:
+            download_dir (str): The downloads directory.
+
+        Returns:
+            tuple: The number of files forgotten and recorded.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT doc_id, path FROM documents WHERE path IS NOT NULL").fetchall()
+        missing = [doc_id for doc_id, path in rows if not os.path.exists(path)]
+        for doc_id in missing:
+            self.remove(doc_id)
+        return len(missing), self.import_directory(download_dir)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect the catalog of ingested rulings.")
+    parser.add_argument("command", choices=["status", "import", "rebuild"],
+                        help="status: count the rulings per topic, import: record the PDFs of the downloads directory missing "
+                             "from the catalog, rebuild: also forget the files that no longer exist")
+    parser.add_argument("--path", default=DEFAULT_CATALOG_PATH)
+    parser.add_argument("--download-dir", default="downloads")
+    args = parser.parse_args()
+
+    catalog = DocumentCatalog(args.path)
+    if args.command == "import":
+        print(f"Recorded {catalog.import_directory(args.download_dir)} PDFs from '{args.download_dir}'")
+    elif args.command == "rebuild":
+        forgotten, recorded = catalog.rebuild(args.download_dir)
+        print(f"Forgot {forgotten} missing files and recorded {recorded} PDFs from '{args.download_dir}'")
+    with catalog.lock:
+        rows = catalog.connection.execute(
+            "SELECT topic, COUNT(*) FROM document_topics GROUP BY topic ORDER BY topic").fetchall()
+        shared = catalog.connection.execute(
+            "SELECT COUNT(*) FROM (SELECT doc_id FROM document_topics GROUP BY doc_id HAVING COUNT(*) > 1)").fetchone()[0]
+        statuses = catalog.connection.execute("SELECT status, COUNT(*), SUM(size) FROM documents GROUP BY status").fetchall()
+    print(f"{len(catalog)} rulings, {shared} listed under several topics")
+    for status, count, size in statuses:
+        print(f"  {status}: {count} files, {(size or 0) / 1e6:.1f} MB")
+    for topic, count in rows:
+        print(f"  {topic}: {count}")
+    catalog.close()
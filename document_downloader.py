@@ -2,50 +2,77 @@ from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException, WebDriverException
+import asyncio
+import hashlib
+import threading
 import time
 import os
 import shutil
-from utils_Chromadb import UtilsDB
-from langchain_community.vectorstores import Chroma
+from utils_Chromadb import UtilsDB, delete_source_chunks, document_metadata_from_path, get_vectordb, sanitize_topic
+from relatoria_http_fetcher import RELATORIA_URL, RelatoriaHttpFetcher, result_text_from_html
+from crawl_scheduler import CrawlScheduler
+from crawl_state import DUPLICATE, FAILED, STORED, CrawlStateStore, result_id, result_position
+from document_catalog import DOWNLOADED, INGESTED, DocumentCatalog, doc_id_from_filename, document_identifiers
 from langchain_openai import OpenAIEmbeddings
 import openai
 from dotenv import load_dotenv
 
 class DocumentDownloader:
     """
-    A class to download and manage legal documents using Selenium and Chroma vector database.
+    A class to download and manage legal documents, over HTTP with RelatoriaHttpFetcher or through Selenium
+    when that fails, and store them in the vector database.
 
     Attributes:
         topics (dict): A dictionary with topics as keys and number of documents to download as values.
-        database_name (str): The name of the database.
         download_dir (str): The directory to save downloaded documents.
+        staging_dir (str): The directory the browser downloads into, holding only the download in progress.
         utils_db (UtilsDB): An instance of UtilsDB to interact with the vector database.
+        use_http (bool): Whether to fetch with plain HTTP requests before falling back to Selenium.
+        incremental (bool): Whether to only download the rulings published since the last run.
+        crawl_state (CrawlStateStore): The cursor and seen results of each topic, to resume interrupted crawls.
+        catalog (DocumentCatalog): The rulings already ingested under any topic, checked before downloading.
+        scheduler (CrawlScheduler): Paces the requests and browser steps and retries their transient failures.
     """
 
-    def __init__(self, topics):
+    def __init__(self, topics, use_http=True, incremental=False):
         """
         Initializes the DocumentDownloader with topics and sets up environment variables and database.
 
         Args:
             topics (dict): A dictionary with topics as keys and number of documents to download as values.
+            use_http (bool): Whether to fetch with plain HTTP requests before falling back to Selenium. Defaults to True.
+            incremental (bool): Whether to only download the rulings published since the last run, stopping each
+                topic at the results seen by earlier runs. The number of documents then caps the new documents of
+                the topic. Defaults to False.
         """
         load_dotenv()
         openai.api_key = os.getenv("OPENAI_API_KEY")
         self.topics = topics
-        self.database_name = "abogacia_data"
+        self.use_http = use_http
+        self.incremental = incremental
+        self.stop_after_seen = 3
+        self.scheduler = CrawlScheduler(max_concurrency=4)
         self.download_dir = os.path.abspath("./downloads")
+        self.staging_dir = os.path.join(self.download_dir, ".incoming")
+        self.crawl_state = CrawlStateStore(os.path.join(self.download_dir, "crawl_state.db"))
+        self.catalog = DocumentCatalog(os.path.join(self.download_dir, "catalog.db"))
+        if not self.catalog.filenames(status=None):
+            print(f"Recorded {self.catalog.import_directory(self.download_dir)} downloaded PDFs in the catalog")
         self.utils_db = self.initialize_utils_db()
+        # The vector database has a single writer, topics fetched concurrently store their documents one at a time.
+        self.store_lock = threading.Lock()
 
     def initialize_utils_db(self):
         """
-        Initializes the UtilsDB with Chroma vector database.
+        Initializes the UtilsDB with the vector database selected by VECTOR_BACKEND.
 
         Returns:
             UtilsDB: An instance of UtilsDB.
         """
         ef = OpenAIEmbeddings()
-        vectordb = Chroma(persist_directory=f"./{self.database_name}", embedding_function=ef)
-        return UtilsDB(vectordb)
+        vectordb = get_vectordb(ef)
+        return UtilsDB(vectordb, self.catalog)
 
     def create_download_directory(self, topic):
         """
@@ -72,7 +99,7 @@ class DocumentDownloader:
         Returns:
             str: The sanitized topic.
         """
-        return topic.replace(" ", "_").lower()
+        return sanitize_topic(topic)
 
     def move_downloaded_file(self, file_path, topic):
         """
@@ -100,7 +127,8 @@ class DocumentDownloader:
         """
         firefox_profile = webdriver.FirefoxProfile()
         firefox_profile.set_preference("browser.download.folderList", 2)
-        firefox_profile.set_preference("browser.download.dir", self.download_dir)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        firefox_profile.set_preference("browser.download.dir", self.staging_dir)
         firefox_profile.set_preference("browser.helperApps.neverAsk.saveToDisk", "application/pdf")
         firefox_profile.set_preference("pdfjs.disabled", True)
         firefox_profile.set_preference("browser.download.manager.showWhenStarting", False)
@@ -121,23 +149,17 @@ class DocumentDownloader:
 
     def load_downloaded_files(self, topic=None):
         """
-        Loads the already downloaded files for a specific topic.
+        Loads the already downloaded files for a specific topic from the catalog.
 
         Args:
-            topic (str, optional): The topic to load files for. Defaults to None.
+            topic (str, optional): The topic to load files for. Defaults to None, the files of every topic of the downloader.
 
         Returns:
             set: A set of filenames of the already downloaded files.
         """
         existing_files = set()
-        topic_sanitized = self.sanitize_topic(topic) if topic else None
-        topic_dirs = [os.path.join(self.download_dir, self.sanitize_topic(t)) for t in self.topics.keys() if (topic_sanitized is None or self.sanitize_topic(t) == topic_sanitized)]
-        for topic_dir in topic_dirs:
-            if os.path.exists(topic_dir):
-                for foldername, subfolders, filenames in os.walk(topic_dir):
-                    for filename in filenames:
-                        if filename.endswith(".pdf"):
-                            existing_files.add(filename)
+        for t in ([topic] if topic else self.topics.keys()):
+            existing_files |= {filename for filename in self.catalog.filenames(t) if filename.endswith(".pdf")}
         print(f"Existing files for topic '{topic}': {len(existing_files)}")
         return existing_files
 
@@ -151,39 +173,150 @@ class DocumentDownloader:
         Returns:
             int: The current page number, or None if it cannot be retrieved.
         """
+        print("Getting page number")
+        position = self.get_result_position(driver)
+        return position[0] if position else None
+
+    def get_result_position(self, driver):
+        """
+        Reads the "Resultado: N de M" counter of the search results.
+
+        Args:
+            driver (WebDriver): The Selenium WebDriver.
+
+        Returns:
+            tuple: The number of the current result and the number of results, or None if it cannot be read.
+        """
         try:
-            print("Getting page number")
-            page_number_element = driver.find_element(By.XPATH, '//*[@id="resultForm:pagText2"]')
-            page_text = page_number_element.text.strip()
-            if "Resultado:" in page_text:
-                parts = page_text.split()
-                return int(parts[1])
+            return result_position(driver.find_element(By.XPATH, '//*[@id="resultForm:pagText2"]').text)
+        except WebDriverException:
             return None
-        except:
+
+    def get_result_text(self, driver):
+        """
+        Reads the text describing the current ruling from the markup of the result form, parsed as the HTTP fetcher
+        parses it so both give the result the same id.
+
+        Args:
+            driver (WebDriver): The Selenium WebDriver.
+
+        Returns:
+            str: The text describing the current ruling, or None if it cannot be read.
+        """
+        try:
+            return result_text_from_html(driver.find_element(By.ID, "resultForm").get_attribute("outerHTML"))
+        except WebDriverException:
             return None
 
+    def wait_for_page_change(self, driver, previous_page, timeout=10):
+        """
+        Waits until the results page is no longer `previous_page`, at most `timeout` seconds.
+
+        Args:
+            driver (WebDriver): The Selenium WebDriver.
+            previous_page (int): The page number before clicking next.
+            timeout (float): The maximum wait in seconds.
+        """
+        def page_changed(driver):
+            try:
+                page_text = driver.find_element(By.ID, "resultForm:pagText2").text.split()
+                return len(page_text) > 1 and page_text[1] != str(previous_page)
+            except WebDriverException:
+                return False
+
+        try:
+            WebDriverWait(driver, timeout).until(page_changed)
+        except TimeoutException:
+            pass
+
+    def wait_for_download(self, timeout=30):
+        """
+        Waits until the browser finished writing a PDF into the staging directory.
+
+        Args:
+            timeout (float): The maximum wait in seconds.
+
+        Returns:
+            bool: True if a complete PDF is there before the timeout.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            files = os.listdir(self.staging_dir)
+            # Firefox writes the download into a .part file next to an empty placeholder.
+            if any(file.endswith(".pdf") for file in files) and not any(file.endswith(".part") for file in files):
+                return True
+            time.sleep(0.5)
+        return False
+
+    def download_current_result(self, driver, topic, downloaded_files):
+        """
+        Downloads the PDF of the current result, moves it to the topic directory and adds it to the vector database if it is new.
+
+        Args:
+            driver (WebDriver): The Selenium WebDriver.
+            topic (str): The topic associated with the file.
+            downloaded_files (set): The filenames already downloaded for the topic, updated with the new file.
+
+        Returns:
+            tuple: The status (STORED, DUPLICATE or FAILED), the filename and the error of a failed download.
+        """
+        if not self.scheduler.call(topic, self.click_download_button, driver, default=False):
+            return FAILED, None, "download button not clickable"
+        if not self.scheduler.call(topic, self.click_pdf_option, driver, default=False):
+            return FAILED, None, "PDF option not clickable"
+        if not self.wait_for_download():
+            self.scheduler.errors[topic]["download_timeout"] += 1
+            return FAILED, None, "no PDF in the download directory"
+        duplicate = None
+        files = os.listdir(self.staging_dir)
+        for file in files:
+            if file.endswith(".pdf"):
+                file_path = os.path.join(self.staging_dir, file)
+
+                if file not in downloaded_files and not self.catalog.lookup([doc_id_from_filename(file)]):
+                    print("File is new, moving and adding to Chroma DB")
+                    new_file_path = self.move_downloaded_file(file_path, topic)
+                    self.ingest_document(new_file_path, topic)
+                    downloaded_files.add(file)
+                    self.scheduler.pause()
+                    return STORED, file, None
+                else:
+                    print(f"PDF file already exists, removing file \n'{file_path}'")
+                    os.remove(file_path)
+                    duplicate = file
+                    self.scheduler.pause()
+        if duplicate:
+            return DUPLICATE, duplicate, None
+        return FAILED, None, "no PDF in the download directory"
+
     def download_documents(self, driver, topic, num_documents):
         """
-        Downloads the specified number of documents for a topic.
+        Downloads the specified number of documents for a topic, skipping the results seen by earlier runs.
 
         Args:
             driver (WebDriver): The Selenium WebDriver.
             topic (str): The topic for which documents are to be downloaded.
-            num_documents (int): The number of documents to download.
+            num_documents (int): The number of documents to download, or of new documents in incremental mode.
         """
         downloaded_files = self.load_downloaded_files(topic)
         print("Downloaded files", downloaded_files)
         current_page = None
         consecutive_page_count = 0
-        time.sleep(5)
-        self.ensure_sidebar_visible(driver)
-        self.perform_search(driver, topic)
 
-        downloaded_count = len(downloaded_files)
+        downloaded_count = 0 if self.incremental else len(downloaded_files)
         if downloaded_count >= num_documents:
             print(f"Already have {num_documents} or more documents for topic '{topic}'. Skipping download.")
             return
 
+        time.sleep(5)
+        self.ensure_sidebar_visible(driver)
+        self.perform_search(driver, topic)
+        resume_page = self.crawl_state.start_run(topic)
+        if resume_page and not self.incremental:
+            print(f"Resuming topic '{topic}', results up to page {resume_page} were seen by earlier runs")
+        exhausted = False
+        seen_streak = 0
+
         while downloaded_count < num_documents:
             new_page = self.get_current_page_number(driver)
             if new_page is not None:
@@ -191,39 +324,52 @@ class DocumentDownloader:
                     consecutive_page_count += 1
                     if consecutive_page_count >= 3:
                         print(f"Stopped searching for topic '{topic}' as the page did not change for 3 consecutive attempts.")
+                        exhausted = True
                         break
                 else:
                     consecutive_page_count = 0
                     current_page = new_page
+                    result_text = self.get_result_text(driver)
+                    current_id = result_id(result_text) if result_text else None
+                    identifiers = document_identifiers(result_text) if result_text else []
+                    known_doc_id = self.catalog.lookup(identifiers)
+                    if current_id and self.crawl_state.is_seen(topic, current_id):
+                        seen_streak += 1
+                        if self.incremental and seen_streak >= self.stop_after_seen:
+                            print(f"Stopped searching for topic '{topic}' at page {new_page}, reached the results of earlier runs.")
+                            break
+                    elif known_doc_id:
+                        seen_streak = 0
+                        print(f"Skipping '{known_doc_id}' for topic '{topic}', it is already ingested")
+                        self.catalog.add_topic(known_doc_id, topic)
+                        if current_id:
+                            self.crawl_state.mark_result(topic, current_id, new_page, DUPLICATE)
+                    else:
+                        seen_streak = 0
+                        print("Trying to download document")
+                        status, filename, error = self.download_current_result(driver, topic, downloaded_files)
+                        if filename:
+                            self.catalog.register(doc_id_from_filename(filename), topic, identifiers)
+                        if current_id:
+                            self.crawl_state.mark_result(topic, current_id, new_page, status, filename, error)
+                        if status == STORED:
+                            downloaded_count += 1
+                    self.crawl_state.save_page(topic, new_page)
 
-                print("Trying to download document")
-                if self.click_download_button(driver):
-                    if self.click_pdf_option(driver):
-                        time.sleep(10)
-                        files = os.listdir(self.download_dir)
-                        for file in files:
-                            if file.endswith(".pdf"):
-                                file_path = os.path.join(self.download_dir, file)
-                                
-                                if file not in downloaded_files:
-                                    print("File is new, moving and adding to Chroma DB")
-                                    new_file_path = self.move_downloaded_file(file_path, topic)
-                                    self.utils_db.add_db_doc(new_file_path)
-                                    downloaded_files.add(file)
-                                    downloaded_count += 1
-                                    time.sleep(2)
-                                    break
-                                else:
-                                    print(f"PDF file already exists, removing file \n'{file_path}'")
-                                    os.remove(file_path)
-                                    time.sleep(2)
-                                    
                 if downloaded_count >= num_documents:
                     break
 
             if downloaded_count < num_documents:
-                self.click_next_button(driver)
-                time.sleep(10)
+                position = self.get_result_position(driver)
+                if position and position[0] >= position[1]:
+                    # The next button is not clickable on the last page, clicking it would only wait for it.
+                    print(f"Stopped searching for topic '{topic}', page {position[0]} is its last result.")
+                    exhausted = True
+                    break
+                self.scheduler.call(topic, self.click_next_button, driver, retries=1)
+                self.wait_for_page_change(driver, current_page)
+
+        self.crawl_state.finish_run(topic, exhausted)
 
     def ensure_sidebar_visible(self, driver):
         """
@@ -267,16 +413,16 @@ class DocumentDownloader:
             driver (WebDriver): The Selenium WebDriver.
 
         Returns:
-            bool: True if the button was clicked, False otherwise.
+            bool: True once the button was clicked.
+
+        Raises:
+            TimeoutException: If the button is not clickable within 10 seconds.
         """
-        try:
-            download_button = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.ID, "resultForm:j_idt265_menuButton"))
-            )
-            driver.execute_script("arguments[0].click();", download_button)
-            return True
-        except:
-            return False
+        download_button = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "resultForm:j_idt265_menuButton"))
+        )
+        driver.execute_script("arguments[0].click();", download_button)
+        return True
 
     def click_pdf_option(self, driver):
         """
@@ -286,16 +432,16 @@ class DocumentDownloader:
             driver (WebDriver): The Selenium WebDriver.
 
         Returns:
-            bool: True if the option was clicked, False otherwise.
+            bool: True once the option was clicked.
+
+        Raises:
+            TimeoutException: If the option is not clickable within 10 seconds.
         """
-        try:
-            pdf_option = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.ID, "resultForm:j_idt268"))
-            )
-            driver.execute_script("arguments[0].click();", pdf_option)
-            return True
-        except:
-            return False
+        pdf_option = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.ID, "resultForm:j_idt268"))
+        )
+        driver.execute_script("arguments[0].click();", pdf_option)
+        return True
 
     def click_next_button(self, driver):
         """
@@ -303,26 +449,128 @@ class DocumentDownloader:
 
         Args:
             driver (WebDriver): The Selenium WebDriver.
+
+        Returns:
+            bool: True once the button was clicked.
+
+        Raises:
+            TimeoutException: If the button is not clickable within 10 seconds.
         """
-        try:
-            next_button = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.XPATH, "//button[@id='resultForm:j_idt248' and @name='resultForm:j_idt248' and @class='ui-button ui-widget ui-state-default ui-corner-all ui-button-icon-only pageButton']"))
-            )
-            driver.execute_script("arguments[0].click();", next_button)
-        except:
-            pass
+        next_button = WebDriverWait(driver, 10).until(
+            EC.element_to_be_clickable((By.XPATH, "//button[@id='resultForm:j_idt248' and @name='resultForm:j_idt248' and @class='ui-button ui-widget ui-state-default ui-corner-all ui-button-icon-only pageButton']"))
+        )
+        driver.execute_script("arguments[0].click();", next_button)
+        return True
 
-    def run(self):
+    def ingest_document(self, file_path, topic, sha256=None):
         """
-        Runs the document downloading process.
+        Records a downloaded file in the catalog and adds it to the vector database. The file stays DOWNLOADED in
+        the catalog until all its chunks are stored, so a failed ingestion is retried by the next run.
+
+        Args:
+            file_path (str): The path of the file in its topic directory.
+            topic (str): The topic associated with the file.
+            sha256 (str, optional): The hash of the file when already known.
+        """
+        previous = self.catalog.file(os.path.basename(file_path))
+        doc_id = self.catalog.record_file(file_path, topic, sha256=sha256)
+        if previous and previous["status"] == DOWNLOADED:
+            # The chunks stored before the previous attempt failed would be duplicated.
+            delete_source_chunks(self.utils_db.vectordb, os.path.abspath(file_path))
+        self.utils_db.add_db_doc(file_path, document_metadata_from_path(file_path, topic))
+        self.catalog.set_status(doc_id, INGESTED)
+
+    def ingest_pending(self):
+        """
+        Ingests again the files of earlier runs that were downloaded but not stored, e.g. after an embedding error.
+
+        Returns:
+            int: The number of files ingested.
+        """
+        ingested = 0
+        for entry in self.catalog.pending_files():
+            if not os.path.exists(entry["path"]):
+                self.catalog.remove(entry["doc_id"])
+                continue
+            print(f"Ingesting '{entry['path']}' again, its previous ingestion did not finish")
+            try:
+                with self.store_lock:
+                    self.ingest_document(entry["path"], entry["topic"])
+                ingested += 1
+            except Exception as e:
+                print(f"Failed to ingest '{entry['path']}' again, it is retried by the next run: {e!r}")
+        return ingested
+
+    def store_fetched_document(self, topic, filename, content, downloaded_files):
+        """
+        Writes a PDF fetched over HTTP into the topic directory and adds it to the vector database if it is new.
+
+        Args:
+            topic (str): The topic associated with the file.
+            filename (str): The name of the PDF.
+            content (bytes): The content of the PDF.
+            downloaded_files (set): The filenames already downloaded for the topic, updated with the new file.
+
+        Returns:
+            bool: True if the document was new.
         """
-        driver = self.initialize_driver()
-        driver.get("http://consultajurisprudencial.ramajudicial.gov.co:8080/WebRelatoria/csj/index.xhtml")
+        with self.store_lock:
+            if filename in downloaded_files or self.catalog.lookup([doc_id_from_filename(filename)]):
+                print(f"PDF file already exists, skipping '{filename}'")
+                return False
+            topic_dir = self.create_download_directory(self.sanitize_topic(topic))
+            new_file_path = os.path.join(topic_dir, filename)
+            with open(new_file_path, "wb") as pdf_file:
+                pdf_file.write(content)
+            self.ingest_document(new_file_path, topic, hashlib.sha256(content).hexdigest())
+            downloaded_files.add(filename)
+            return True
 
-        for topic, num_documents in self.topics.items():
-            self.download_documents(driver, topic, num_documents)
+    def fetch_with_http(self):
+        """
+        Fetches the topics concurrently over HTTP.
 
-        driver.quit()
+        Returns:
+            dict: The topics that failed, with their number of documents, to be downloaded through Selenium.
+        """
+        downloaded_files = {topic: self.load_downloaded_files(topic) for topic in self.topics}
+        if self.incremental:
+            missing = dict(self.topics)
+        else:
+            missing = {topic: num_documents - len(downloaded_files[topic]) for topic, num_documents in self.topics.items()}
+
+        async def store_document(topic, filename, content):
+            return await asyncio.to_thread(self.store_fetched_document, topic, filename, content, downloaded_files[topic])
+
+        fetcher = RelatoriaHttpFetcher(crawl_state=self.crawl_state, incremental=self.incremental,
+                                       stop_after_seen=self.stop_after_seen, catalog=self.catalog,
+                                       scheduler=self.scheduler)
+        results = fetcher.run(missing, store_document)
+        failed = {}
+        for topic, result in results.items():
+            if isinstance(result, Exception):
+                print(f"HTTP fetch failed for topic '{topic}': {result!r}, falling back to Selenium")
+                failed[topic] = self.topics[topic]
+        return failed
+
+    def run(self):
+        """
+        Runs the document downloading process.
+        """
+        start_time = time.time()
+        self.ingest_pending()
+        pending = self.fetch_with_http() if self.use_http else self.topics
+        if pending:
+            driver = self.initialize_driver()
+            driver.get(RELATORIA_URL)
+
+            for topic, num_documents in pending.items():
+                self.download_documents(driver, topic, num_documents)
+
+            driver.quit()
+        self.scheduler.report()
+        self.utils_db.embedding_executor.report()
+        print(f"Download finished in {time.time() - start_time:.1f} seconds")
 
 if __name__ == "__main__":
     temas_legales = {"Divorcio": 10, "PQR": 10, "Abandono de bienes": 10, "Abandono de menores": 10}
@@ -0,0 +1,345 @@
+"""
+Content-addressed store of the embeddings of chunk texts, in a SQLite file next to the downloads. The EmbeddingExecutor
+looks every chunk up by the hash of its model and text before sending it to the API, so a chunk whose text was already
+embedded, by an earlier ingestion or before a change of the chunking, is never embedded again.
+
+The re-index command re-chunks every indexed document from its cached text (see text_extraction.py) with the current
+or given splitter parameters, embeds only the chunks with new text, writes them to a new collection or directory and
+replaces the old one with it once complete. Readers of a local store follow the new directory. The Chroma collection is
+replaced by deleting the old one and renaming the new one, which other processes do not see: restart the API workers
+and the downloader after a re-index of a Chroma store.
+
+Usage:
+    python embedding_cache.py stats
+    python embedding_cache.py seed
+    python embedding_cache.py reindex --chunk-size 800 --chunk-overlap 80
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join("downloads", "embedding_cache.db")
+# Keys looked up per query, below the SQLite limit of bound parameters.
+LOOKUP_BATCH = 500
+# Chunks read from the vector store per call while seeding or re-indexing.
+READ_BATCH = 1000
+# Metadata of a chunk that depends on the page it comes from rather than on its document.
+PAGE_METADATA_KEYS = ("page", "total_pages")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    dim INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+def content_key(model, text):
+    """
+    Args:
+        model (str): The embedding model.
+        text (str): The text of the chunk.
+
+    Returns:
+        str: The SHA-256 of the model and text, the same text embedded by another model has another key.
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite store of embeddings keyed by the hash of their model and text.
+
+    Attributes:
+        path (str): The path of the SQLite file.
+        hits (int): The texts found since the store was opened.
+        misses (int): The texts not found since the store was opened.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        """
+        Args:
+            path (str): The path of the SQLite file, created with its directory if missing.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The executor embeds from several threads, the connection is shared behind a lock.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, model, texts):
+        """
+        Looks up the embeddings of texts.
+
+        Args:
+            model (str): The embedding model.
+            texts (list): The texts.
+
+        Returns:
+            list: The embedding of each text as a list of floats, None for the texts not in the store.
+        """
+        keys = [content_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                batch = keys[start:start + LOOKUP_BATCH]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                found.update(rows)
+        vectors = [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+        hits = sum(vector is not None for vector in vectors)
+        self.hits += hits
+        self.misses += len(vectors) - hits
+        return vectors
+
+    def put_many(self, model, texts, embeddings):
+        """
+        Stores the embeddings of texts, keeping the ones already stored.
+
+        Args:
+            model (str): The embedding model.
+            texts (list): The texts.
+            embeddings (list): The embedding of each text.
+        """
+        rows = []
+        now = time.time()
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append((content_key(model, text), model, vector.shape[0], vector.tobytes(), now))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, model, dim, vector, created) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def counts(self):
+        """
+        Returns:
+            dict: Model to the number of embeddings stored.
+        """
+        with self.lock:
+            return dict(self.connection.execute("SELECT model, COUNT(*) FROM embeddings GROUP BY model").fetchall())
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def model_name(embeddings):
+    """
+    Returns:
+        str: The model of an embedding function, its class name if it has no model.
+    """
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+def iter_store(vectordb, include, batch_size=READ_BATCH):
+    """
+    Yields the chunks of a Chroma store or a LocalVectorStore in batches, in the format of their `get`.
+    """
+    offset = 0
+    while True:
+        batch = vectordb.get(include=list(include), limit=batch_size, offset=offset)
+        if not batch["ids"]:
+            return
+        yield batch
+        offset += len(batch["ids"])
+
+
+def seed_from_store(cache, vectordb, model=None):
+    """
+    Stores the embeddings already in a vector store, so chunks whose text does not change are not embedded again.
+
+    Args:
+        cache (EmbeddingCache): The cache.
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        model (str, optional): The model the store was embedded with. Defaults to the model of its embeddings.
+
+    Returns:
+        int: The chunks read from the store.
+    """
+    model = model or model_name(vectordb.embeddings)
+    seeded = 0
+    for batch in iter_store(vectordb, ("documents", "embeddings")):
+        cache.put_many(model, batch["documents"], batch["embeddings"])
+        seeded += len(batch["ids"])
+    return seeded
+
+
+def _new_store(vectordb):
+    """
+    Creates an empty store next to `vectordb` with the same settings, and the function replacing `vectordb` with it.
+
+    A local store is replaced by swapping its directory, which its readers notice on their next search. A Chroma
+    collection is deleted and the new one renamed, two steps: a store opened in between finishes the rename (see
+    `finish_interrupted_swap`), but processes that opened the collection before keep the id of the deleted one and
+    must be restarted.
+
+    Returns:
+        tuple: The new store and the swap function.
+    """
+    from local_vector_store import LocalVectorStore, swap_directories
+    from utils_Chromadb import REBUILD_SUFFIX
+
+    if isinstance(vectordb, LocalVectorStore):
+        directory = f"{vectordb.persist_directory.rstrip(os.sep)}.reindex"
+        shutil.rmtree(directory, ignore_errors=True)
+        new_store = LocalVectorStore(directory, vectordb.embeddings, dtype=vectordb.dtype.name,
+                                     ann_threshold=vectordb.ann_threshold, quantization=vectordb.quantization,
+                                     rescore_factor=vectordb.rescore_factor)
+
+        def swap():
+            swap_directories(directory, vectordb.persist_directory)
+            # Threads of this process may be searching the store, load the new directory into a copy and swap it in.
+            vectordb._reload()
+
+        return new_store, swap
+
+    from langchain_community.vectorstores import Chroma
+
+    # Same name as the rebuild of vector_index_maintenance.py, which finishes a swap interrupted after the delete.
+    client = vectordb._client
+    name = vectordb._collection.name
+    rebuild_name = f"{name}{REBUILD_SUFFIX}"
+    if rebuild_name in [collection.name for collection in client.list_collections()]:
+        client.delete_collection(rebuild_name)
+    new_store = Chroma(client=client, collection_name=rebuild_name, embedding_function=vectordb.embeddings,
+                       collection_metadata=vectordb._collection.metadata)
+
+    def swap():
+        client.delete_collection(name)
+        new_store._collection.modify(name=name)
+        vectordb._collection = client.get_collection(name)
+
+    return new_store, swap
+
+
+def reindex(vectordb, executor, chunk_size=None, chunk_overlap=None):
+    """
+    Re-chunks every document of a vector store and swaps in a new store with the new chunks.
+
+    Chunks keep the metadata of their document. Documents whose file is gone are copied with their old chunks.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        executor (EmbeddingExecutor): The executor embedding the new chunks, with an EmbeddingCache.
+        chunk_size (int, optional): The characters of a chunk. Defaults to the chunk size of text_extraction.py.
+        chunk_overlap (int, optional): The characters shared by consecutive chunks. Defaults to the overlap of text_extraction.py.
+
+    Returns:
+        dict: The documents, missing files, old and new chunks, embeddings reused and recomputed, and seconds.
+    """
+    from text_extraction import CHUNK_OVERLAP, CHUNK_SIZE, batched, iter_chunks
+    from local_vector_store import LocalVectorStore
+    from utils_Chromadb import add_embedded_texts, vectordb_count
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    chunk_overlap = CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+    start_time = time.time()
+    if executor.cache is None:
+        raise ValueError("Re-indexing needs an EmbeddingExecutor with an EmbeddingCache")
+
+    print(f"Seeding the embedding cache from the {vectordb_count(vectordb)} chunks of the store")
+    old_chunks = seed_from_store(executor.cache, vectordb, model_name(executor.embeddings))
+
+    # The metadata of each document, taken from its first chunk, and the ids of the chunks without a source.
+    documents = {}
+    orphan_ids = []
+    for batch in iter_store(vectordb, ("metadatas",)):
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            source = (metadata or {}).get("source")
+            if source is None:
+                orphan_ids.append(chunk_id)
+            elif source not in documents:
+                documents[source] = {key: value for key, value in metadata.items()
+                                     if key not in PAGE_METADATA_KEYS + ("source", "file_path")}
+
+    new_store, swap = _new_store(vectordb)
+    executor.reset_stats()
+    missing = []
+    for number, (source, metadata) in enumerate(sorted(documents.items()), 1):
+        if os.path.exists(source):
+            for chunks in batched(iter_chunks(source, metadata, chunk_size, chunk_overlap)):
+                texts = [chunk.page_content for chunk in chunks]
+                add_embedded_texts(new_store, texts, executor.embed_documents(texts), [chunk.metadata for chunk in chunks])
+        else:
+            missing.append(source)
+            old = vectordb.get(where={"source": source}, include=["documents", "metadatas", "embeddings"])
+            add_embedded_texts(new_store, old["documents"], list(old["embeddings"]), old["metadatas"], old["ids"])
+        if number % 50 == 0:
+            print(f"Re-chunked {number}/{len(documents)} documents, {executor.reused} embeddings reused, "
+                  f"{executor.embedded} recomputed")
+    for ids in batched(orphan_ids, READ_BATCH):
+        old = vectordb.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+        add_embedded_texts(new_store, old["documents"], list(old["embeddings"]), old["metadatas"], old["ids"])
+
+    new_chunks = vectordb_count(new_store)
+    swap()
+    if not isinstance(vectordb, LocalVectorStore):
+        print("The Chroma collection was replaced, restart the API workers and the downloader so they open it")
+    report = {
+        "documents": len(documents),
+        "missing_files": len(missing),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "old_chunks": old_chunks,
+        "new_chunks": new_chunks,
+        "reused": executor.reused,
+        "recomputed": executor.embedded,
+        "tokens": executor.tokens,
+        "cost_usd": executor.cost(),
+        "seconds": time.time() - start_time,
+    }
+    print(f"Re-indexed {len(documents)} documents from {old_chunks} to {new_chunks} chunks in {report['seconds']:.1f} "
+          f"seconds: {report['reused']} embeddings reused, {report['recomputed']} recomputed ({report['tokens']} tokens)")
+    for source in missing:
+        print(f"  '{source}' not found, its old chunks were kept")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect the embedding cache, seed it from the vector store or re-index the store.")
+    parser.add_argument("command", choices=["stats", "seed", "reindex"])
+    parser.add_argument("--path", default=DEFAULT_CACHE_PATH)
+    parser.add_argument("--chunk-size", type=int, help="characters of a chunk, defaults to CHUNK_SIZE of text_extraction.py")
+    parser.add_argument("--chunk-overlap", type=int, help="characters shared by consecutive chunks, defaults to CHUNK_OVERLAP")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.path)
+    if args.command == "stats":
+        for model, count in sorted(cache.counts().items()):
+            print(f"{model}: {count} embeddings")
+        print(f"{os.path.getsize(args.path) / 1e6:.1f} MB in '{args.path}'")
+    else:
+        import openai
+        from dotenv import load_dotenv
+
+        from embedding_executor import EmbeddingExecutor
+        from utils_Chromadb import get_vectordb
+
+        load_dotenv()
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        vectordb = get_vectordb()
+        if args.command == "seed":
+            seeded = seed_from_store(cache, vectordb)
+            print(f"Read {seeded} chunks, {len(cache)} embeddings in the cache")
+        else:
+            executor = EmbeddingExecutor(vectordb.embeddings, cache=cache)
+            reindex(vectordb, executor, args.chunk_size, args.chunk_overlap)
+            executor.report()
+    cache.close()
@@ -0,0 +1,298 @@
+"""
+Embeds the chunks of an ingestion with explicit control over the OpenAI requests: chunks are packed into requests up
+to a token budget, a bounded number of requests run in parallel, the rate limit headers pause every worker before
+the limit is hit, and 429, 5xx and timeouts are retried with jittered exponential backoff. The tokens, throughput
+and cost of the run are tracked so each ingestion can report them. With an EmbeddingCache, texts embedded before are
+taken from the cache and only the new ones are sent.
+"""
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from embedding_cache import model_name
+
+# USD per 1000 tokens of the OpenAI embedding models.
+EMBEDDING_PRICES_PER_1K = {
+    "text-embedding-ada-002": 0.0001,
+    "text-embedding-3-small": 0.00002,
+    "text-embedding-3-large": 0.00013,
+}
+# The API accepts up to 2048 inputs and 300k tokens per request, stay below the token limit.
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 100_000
+# Inputs are truncated by the API above this, chunks of 1000 characters are far below it.
+MAX_TOKENS_PER_INPUT = 8191
+
+
+def parse_reset(value):
+    """
+    Parses the duration of the x-ratelimit-reset headers, e.g. "1s", "120ms" or "6m0s".
+
+    Returns:
+        float: The seconds, None if the value is missing or not a duration.
+    """
+    if not value:
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+class EmbeddingExecutor:
+    """
+    Embeds texts in token packed, parallel and rate limited requests.
+
+    Attributes:
+        embeddings (Embeddings): The embedding function of the vector store.
+        max_tokens_per_request (int): The token budget of a request.
+        max_concurrency (int): The requests sent at the same time.
+        max_retries (int): The retries of a failed request.
+        tokens (int): The tokens embedded since the last `reset_stats`.
+        requests (int): The requests sent since the last `reset_stats`.
+        retries (int): The retries since the last `reset_stats`.
+        cache (EmbeddingCache): The cache of the embeddings by text, None to embed every text.
+        reused (int): The texts taken from the cache since the last `reset_stats`.
+        embedded (int): The texts sent to the API since the last `reset_stats`.
+    """
+
+    def __init__(self, embeddings, max_tokens_per_request=MAX_TOKENS_PER_REQUEST, max_concurrency=4, max_retries=6,
+                 backoff_base=1.0, backoff_cap=60.0, cache=None):
+        """
+        Args:
+            embeddings (Embeddings): The embedding function of the vector store. OpenAIEmbeddings are called through
+                the OpenAI client to read the rate limit headers, other embeddings through `embed_documents`.
+            max_tokens_per_request (int): The token budget of a request.
+            max_concurrency (int): The requests sent at the same time.
+            max_retries (int): The retries of a request failing with 429, 5xx, a timeout or a connection error.
+            backoff_base (float): The backoff of the first retry, doubled on each retry, in seconds.
+            backoff_cap (float): The longest backoff, in seconds.
+            cache (EmbeddingCache, optional): The cache of the embeddings by text.
+        """
+        self.embeddings = embeddings
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.cache = cache
+        self.model = getattr(embeddings, "model", None)
+        self._client = None
+        self._encoding = None
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.elapsed_seconds = 0.0
+        self.reused = 0
+        self.embedded = 0
+
+    def _openai_client(self):
+        """
+        Returns:
+            openai.OpenAI: A client without retries of its own, None for embeddings other than OpenAIEmbeddings.
+        """
+        if self._client is None and type(self.embeddings).__name__ == "OpenAIEmbeddings":
+            import openai
+
+            api_key = getattr(self.embeddings, "openai_api_key", None)
+            self._client = openai.OpenAI(
+                api_key=api_key.get_secret_value() if api_key is not None else None,
+                organization=getattr(self.embeddings, "openai_organization", None),
+                base_url=getattr(self.embeddings, "openai_api_base", None),
+                timeout=getattr(self.embeddings, "request_timeout", None) or 60,
+                max_retries=0,
+            )
+        return self._client
+
+    def count_tokens(self, text):
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def pack(self, texts):
+        """
+        Groups consecutive texts into requests of at most `max_tokens_per_request` tokens and 2048 inputs.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: The (start index, texts, tokens) of each request.
+        """
+        batches = []
+        start = 0
+        batch = []
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = min(self.count_tokens(text), MAX_TOKENS_PER_INPUT)
+            if batch and (batch_tokens + tokens > self.max_tokens_per_request or len(batch) >= MAX_INPUTS_PER_REQUEST):
+                batches.append((start, batch, batch_tokens))
+                start, batch, batch_tokens = index, [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append((start, batch, batch_tokens))
+        return batches
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            wait = self._paused_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def _pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+
+    def _follow_headers(self, headers, next_tokens):
+        """
+        Pauses every worker until the limit resets when the remaining requests or tokens would not cover the next request.
+        """
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None and int(remaining_requests) <= self.max_concurrency:
+            self._pause(parse_reset(headers.get("x-ratelimit-reset-requests")) or 1.0)
+        if remaining_tokens is not None and int(remaining_tokens) < next_tokens * self.max_concurrency:
+            self._pause(parse_reset(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+
+    def _send(self, texts, tokens):
+        client = self._openai_client()
+        if client is None:
+            return self.embeddings.embed_documents(texts)
+        kwargs = {"model": self.model, "input": texts}
+        if getattr(self.embeddings, "dimensions", None):
+            kwargs["dimensions"] = self.embeddings.dimensions
+        raw_response = client.embeddings.with_raw_response.create(**kwargs)
+        self._follow_headers(raw_response.headers, tokens)
+        response = raw_response.parse()
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def _backoff(self, attempt, error):
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        retry_after = headers.get("retry-after-ms")
+        if retry_after is not None:
+            return float(retry_after) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _is_transient(self, error):
+        import openai
+
+        return isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError,
+                                  openai.InternalServerError))
+
+    def _embed_batch(self, texts, tokens):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            try:
+                vectors = self._send(texts, tokens)
+            except Exception as error:
+                if self._openai_client() is None or not self._is_transient(error) or attempt == self.max_retries:
+                    raise
+                wait = self._backoff(attempt + 1, error)
+                with self._lock:
+                    self.retries += 1
+                    self.rate_limited += getattr(error, "status_code", None) == 429
+                # A 429 pauses every worker, not just the one that got it.
+                if getattr(error, "status_code", None) == 429:
+                    self._pause(wait)
+                print(f"Embedding request failed with {type(error).__name__}, retrying in {wait:.1f} seconds")
+                time.sleep(wait)
+            else:
+                with self._lock:
+                    self.tokens += tokens
+                    self.requests += 1
+                return vectors
+
+    def embed_documents(self, texts):
+        """
+        Embeds texts in parallel token packed requests, taking the texts embedded before from the cache.
+
+        Args:
+            texts (list): The texts to embed.
+
+        Returns:
+            list: The embeddings, in the order of the texts.
+        """
+        texts = list(texts)
+        if self.cache is None:
+            self.embedded += len(texts)
+            return self._embed_texts(texts)
+        model = model_name(self.embeddings)
+        embeddings = self.cache.get_many(model, texts)
+        # Repeated texts, e.g. headers of the rulings, are embedded once.
+        missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+        if missing:
+            computed = self._embed_texts(missing)
+            self.cache.put_many(model, missing, computed)
+            computed = dict(zip(missing, computed))
+            embeddings = [computed[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+        self.reused += len(texts) - len(missing)
+        self.embedded += len(missing)
+        return embeddings
+
+    def _embed_texts(self, texts):
+        start_time = time.perf_counter()
+        batches = self.pack(texts)
+        embeddings = [None] * len(texts)
+        if len(batches) <= 1 or self.max_concurrency <= 1:
+            results = [self._embed_batch(batch, tokens) for _, batch, tokens in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as pool:
+                results = list(pool.map(lambda batch: self._embed_batch(batch[1], batch[2]), batches))
+        for (start, batch, _), vectors in zip(batches, results):
+            embeddings[start:start + len(batch)] = vectors
+        self.elapsed_seconds += time.perf_counter() - start_time
+        return embeddings
+
+    def cost(self):
+        """
+        Returns:
+            float: The USD cost of the tokens embedded, None for models without a known price.
+        """
+        price = EMBEDDING_PRICES_PER_1K.get(self.model)
+        return self.tokens / 1000 * price if price is not None else None
+
+    def report(self, elapsed=None):
+        """
+        Prints and returns the tokens, requests, retries, throughput and cost of the run.
+
+        Args:
+            elapsed (float, optional): The seconds of the run. Defaults to the time spent embedding.
+
+        Returns:
+            dict: The statistics of the run.
+        """
+        elapsed = elapsed or self.elapsed_seconds
+        stats = {
+            "model": self.model,
+            "tokens": self.tokens,
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "reused": self.reused,
+            "embedded": self.embedded,
+            "tokens_per_second": self.tokens / elapsed if elapsed else None,
+            "cost_usd": self.cost(),
+        }
+        throughput = f"{stats['tokens_per_second']:.0f} tokens/s" if stats["tokens_per_second"] else "n/a"
+        cost = f"${stats['cost_usd']:.4f}" if stats["cost_usd"] is not None else "unknown cost"
+        cached = f", {self.reused} texts reused from the cache" if self.cache is not None else ""
+        print(f"Embedded {self.tokens} tokens in {self.requests} requests ({self.retries} retries, "
+              f"{self.rate_limited} rate limited), {throughput}, {cost}{cached}")
+        return stats
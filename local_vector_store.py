@@ -0,0 +1,916 @@
+"""
+Local vector store backed by a memory-mapped float32 (or float16) matrix of embeddings and a metadata sidecar.
+
+It implements the LangChain VectorStore interface used by UtilsDB and the chatbots, so it can replace the Chroma
+store by setting VECTOR_BACKEND=local. The files of the store are:
+
+    manifest.json   committed row count, dimension, dtype and sizes of the append-only files
+    embeddings.bin  row-major matrix of L2-normalized embeddings, opened with np.memmap
+    texts.bin       utf-8 text of the chunks, sliced through spans.bin (int64 offset, length per row)
+    metadata.jsonl  log of the ids, metadata updates and deletions of each row
+    codes.bin       optional int8 copy of the matrix with a float32 scale per row in scales.bin
+    ann.bin         optional hnswlib index of the first rows, used for large stores
+
+Opening the store maps the embedding, text and code files, so their pages are shared by every worker process
+reading the same directory and none of them is read at startup. The ids and metadata are not mapped: each process
+parses metadata.jsonl and rebuilds its id and metadata indexes in memory, which takes time and memory proportional
+to the number of rows (about 40 ms for 5k rows). A single writer appends rows and then
+replaces the manifest, readers ignore anything past the committed sizes. Stores opened with read_only=True refuse
+writes and reload the store when the writer replaced the manifest, checking at most every REFRESH_INTERVAL seconds.
+
+With int8 quantization the exact search scans the codes, a quarter of the size of the float32 matrix, and only
+re-scores the top candidates against the full-precision rows, so the float32 pages can stay on disk. The codes are
+kept besides the matrix, so they add about a quarter of its size on disk.
+"""
+import argparse
+import json
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+DEFAULT_PERSIST_DIRECTORY = "abogacia_local"
+# Stores with more live rows than this are searched through the ANN index when one has been built.
+ANN_THRESHOLD = 200_000
+# Number of rows copied, quantized or migrated per batch.
+BLOCK_ROWS = 65_536
+# Bytes of float32 rows multiplied per block in the exact search, keeps the converted block in cache.
+SEARCH_BLOCK_BYTES = 8 * 2 ** 20
+# Candidates of the int8 first pass re-scored at full precision, per requested result.
+RESCORE_FACTOR = 4
+QUANTIZATIONS = (None, "int8")
+# Seconds between the checks of a read-only store for commits of the writer.
+REFRESH_INTERVAL = 1.0
+
+MANIFEST = "manifest.json"
+EMBEDDINGS = "embeddings.bin"
+TEXTS = "texts.bin"
+SPANS = "spans.bin"
+METADATA_LOG = "metadata.jsonl"
+ANN_INDEX = "ann.bin"
+ANN_MANIFEST = "ann.json"
+CODES = "codes.bin"
+SCALES = "scales.bin"
+
+FILTER_OPERATORS = {
+    "$eq": lambda value, target: value == target,
+    "$ne": lambda value, target: value != target,
+    "$gt": lambda value, target: value > target,
+    "$gte": lambda value, target: value >= target,
+    "$lt": lambda value, target: value < target,
+    "$lte": lambda value, target: value <= target,
+    "$in": lambda value, target: value in target,
+    "$nin": lambda value, target: value not in target,
+}
+
+
+def normalize(vectors):
+    """
+    L2-normalizes the rows of a matrix so the inner product is the cosine similarity.
+
+    Args:
+        vectors (array-like): The (n, dim) vectors.
+
+    Returns:
+        np.ndarray: The normalized float32 vectors.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    Selects the k highest scores of each row.
+
+    Args:
+        scores (np.ndarray): The (q, n) scores.
+        k (int): The number of scores to select.
+
+    Returns:
+        tuple: The (q, k) column indexes and scores, highest first.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=np.float32)
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    selected = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-selected, axis=1)
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(selected, order, axis=1)
+
+
+def quantize_int8(vectors):
+    """
+    Quantizes vectors to int8 with a symmetric scale per row.
+
+    Args:
+        vectors (np.ndarray): The (n, dim) float32 vectors.
+
+    Returns:
+        tuple: The (n, dim) int8 codes and the (n,) float32 scales, so that vectors ~= codes * scales[:, None].
+    """
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    A LangChain vector store keeping the embeddings in a memory-mapped matrix and searching it with vectorized
+    batched exact search, or with an optional hnswlib index for large stores.
+
+    Attributes:
+        persist_directory (str): The directory of the store.
+        dtype (np.dtype): The dtype of the stored embeddings, float32 or float16.
+        dim (int): The dimension of the embeddings, None while the store is empty.
+        count (int): The number of committed rows, including deleted ones.
+        quantization (str): None, or "int8" when the first pass of the exact search runs on int8 codes.
+        rescore_factor (int): The candidates of the quantized first pass re-scored at full precision, per result.
+        exact (bool): Whether searches scan the stored embeddings at full precision, ignoring the ANN index and the
+            int8 codes, e.g. to measure their recall. False by default.
+    """
+
+    def __init__(self, persist_directory=DEFAULT_PERSIST_DIRECTORY, embedding_function=None, dtype="float32",
+                 ann_threshold=ANN_THRESHOLD, quantization=None, rescore_factor=RESCORE_FACTOR, read_only=False):
+        """
+        Opens the store, creating its directory if it does not exist.
+
+        Args:
+            persist_directory (str): The directory of the store.
+            embedding_function (Embeddings): The embeddings used for the text queries and added texts.
+            dtype (str): The dtype of the embeddings of a new store, "float32" or "float16".
+            ann_threshold (int): The number of live rows above which the ANN index is used.
+            quantization (str): None or "int8", the quantization of a new store. Use `quantize` for an existing one.
+            rescore_factor (int): The candidates of the quantized first pass re-scored at full precision, per result.
+            read_only (bool): Whether to refuse writes and follow the commits of the writer process instead.
+
+        Raises:
+            FileNotFoundError: If a read-only store does not exist.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization '{quantization}', expected one of {QUANTIZATIONS}")
+        self.persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self.ann_threshold = ann_threshold
+        self.rescore_factor = rescore_factor
+        self.exact = False
+        self.read_only = read_only
+        self._refresh_lock = threading.Lock()
+        # Guards the id and metadata indexes, updated by the writer while query threads of the same process read them.
+        self._index_lock = threading.Lock()
+        if read_only:
+            if self._read_manifest() is None:
+                raise FileNotFoundError(f"No vector store in '{persist_directory}' to open read-only")
+            self.load()
+            return
+        os.makedirs(persist_directory, exist_ok=True)
+        manifest = self._read_manifest()
+        if manifest is None:
+            manifest = {"dim": None, "dtype": np.dtype(dtype).name, "count": 0, "text_bytes": 0, "log_bytes": 0,
+                        "quantization": quantization}
+            self._write_manifest(manifest)
+        self.load()
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def _path(self, name):
+        return os.path.join(self.persist_directory, name)
+
+    def _read_manifest(self):
+        try:
+            with open(self._path(MANIFEST)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+    def _check_writable(self):
+        if self.read_only:
+            raise PermissionError(f"The vector store '{self.persist_directory}' is open read-only, writes go through the ingestion writer")
+
+    def _manifest_version(self):
+        # The writer replaces the manifest on each commit and swaps the directory on compaction or re-index.
+        manifest_stat = os.stat(self._path(MANIFEST))
+        return os.stat(self.persist_directory).st_ino, manifest_stat.st_ino, manifest_stat.st_mtime_ns
+
+    def _write_manifest(self, manifest):
+        self._check_writable()
+        tmp_path = self._path(f"{MANIFEST}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(tmp_path, self._path(MANIFEST))
+        self.manifest = manifest
+
+    def load(self):
+        """
+        Maps the committed part of the files of the store and rebuilds the id and metadata indexes from the log.
+        Only for a store no other thread is using yet, see `_reload`.
+        """
+        self._version = self._manifest_version()
+        self._checked = time.monotonic()
+        self.manifest = self._read_manifest()
+        self.dim = self.manifest["dim"]
+        self.dtype = np.dtype(self.manifest["dtype"])
+        self.count = self.manifest["count"]
+        self.quantization = self.manifest.get("quantization")
+        self._ids = []
+        self._id_to_row = {}
+        self._metadatas = []
+        self._live = np.zeros(self.count, dtype=bool)
+        self._postings = {}
+        self._map_files()
+
+        if self.manifest["log_bytes"]:
+            with open(self._path(METADATA_LOG), "rb") as log_file:
+                log = log_file.read(self.manifest["log_bytes"])
+            for line in log.splitlines():
+                self._apply_log_entry(json.loads(line))
+        self._load_ann_index()
+
+    def refresh(self, force=False):
+        """
+        Reloads a read-only store when the writer committed since it was loaded.
+
+        Args:
+            force (bool): Whether to check now rather than at most every REFRESH_INTERVAL seconds.
+
+        Returns:
+            bool: True if the store was reloaded.
+        """
+        if not force and time.monotonic() - self._checked < REFRESH_INTERVAL:
+            return False
+        with self._refresh_lock:
+            self._checked = time.monotonic()
+            try:
+                version = self._manifest_version()
+            except FileNotFoundError:
+                # The directory is being swapped, the next check finds the new one.
+                return False
+            if version == self._version:
+                return False
+            self._reload()
+        print(f"Reloaded vector store '{self.persist_directory}', {self.count_live()} chunks")
+        return True
+
+    def _reload(self):
+        # Load into a copy and swap its state in, so searches running meanwhile keep a consistent view.
+        fresh = object.__new__(type(self))
+        fresh.__dict__.update(self.__dict__)
+        fresh.load()
+        with self._index_lock:
+            self.__dict__.update(fresh.__dict__)
+
+    def _map_files(self):
+        count = self.manifest["count"]
+        if count:
+            matrix = np.memmap(self._path(EMBEDDINGS), dtype=self.dtype, mode="r", shape=(count, self.dim))
+            spans = np.memmap(self._path(SPANS), dtype=np.int64, mode="r", shape=(count, 2))
+            with open(self._path(TEXTS), "rb") as texts_file:
+                texts = mmap.mmap(texts_file.fileno(), 0, access=mmap.ACCESS_READ) if self.manifest["text_bytes"] else b""
+        else:
+            matrix = np.empty((0, self.dim or 0), dtype=self.dtype)
+            spans = np.empty((0, 2), dtype=np.int64)
+            texts = b""
+        if count and self.quantization == "int8":
+            codes = np.memmap(self._path(CODES), dtype=np.int8, mode="r", shape=(count, self.dim))
+            scales = np.memmap(self._path(SCALES), dtype=np.float32, mode="r", shape=(count,))
+        else:
+            codes = None
+            scales = None
+        # Assigned in the order searches read them, so a search running meanwhile never reads a row of an array
+        # from an array that does not have it yet. The new rows only become candidates once their log entries
+        # are applied, after this.
+        self._texts, self._spans, self._matrix, self._scales, self._codes = texts, spans, matrix, scales, codes
+        self.count = count
+
+    def _apply_log_entry(self, entry):
+        row = entry["row"]
+        if "id" in entry:
+            self._ids.append(entry["id"])
+            self._metadatas.append({})
+            self._id_to_row[entry["id"]] = row
+            self._live[row] = True
+        if entry.get("deleted"):
+            self._index_metadata(row, None)
+            self._live[row] = False
+            self._id_to_row.pop(self._ids[row], None)
+        elif "metadata" in entry:
+            self._index_metadata(row, entry["metadata"])
+
+    def _index_metadata(self, row, metadata):
+        for key, value in self._metadatas[row].items():
+            self._postings[key][value].discard(row)
+        self._metadatas[row] = metadata or {}
+        for key, value in self._metadatas[row].items():
+            self._postings.setdefault(key, {}).setdefault(value, set()).add(row)
+
+    def _append(self, name, committed_size, data):
+        self._check_writable()
+        with open(self._path(name), "ab") as append_file:
+            append_file.truncate(committed_size)
+            append_file.write(data)
+            append_file.flush()
+            os.fsync(append_file.fileno())
+
+    def _append_log(self, entries, apply=True):
+        data = b"".join(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n" for entry in entries)
+        self._append(METADATA_LOG, self.manifest["log_bytes"], data)
+        if apply:
+            self._apply_log_entries(entries)
+        return len(data)
+
+    def _apply_log_entries(self, entries, new_rows=0):
+        with self._index_lock:
+            if new_rows:
+                self._live = np.concatenate([self._live, np.zeros(new_rows, dtype=bool)])
+            for entry in entries:
+                self._apply_log_entry(entry)
+
+    def _load_ann_index(self):
+        self._ann = None
+        self._ann_count = 0
+        if hnswlib is None or not os.path.exists(self._path(ANN_MANIFEST)):
+            return
+        with open(self._path(ANN_MANIFEST)) as ann_manifest_file:
+            ann_manifest = json.load(ann_manifest_file)
+        if ann_manifest["count"] > self.count:
+            return
+        self._ann = hnswlib.Index(space="ip", dim=self.dim)
+        self._ann.load_index(self._path(ANN_INDEX), max_elements=ann_manifest["count"])
+        self._ann.set_ef(ann_manifest["ef_search"])
+        self._ann_count = ann_manifest["count"]
+
+    def build_ann_index(self, M=16, ef_construction=200, ef_search=64, batch_size=BLOCK_ROWS):
+        """
+        Builds the hnswlib index of the current rows. Rows added afterwards are searched exactly until it is rebuilt.
+
+        Args:
+            M (int): The number of links per node.
+            ef_construction (int): The size of the candidate list while building.
+            ef_search (int): The size of the candidate list while searching.
+            batch_size (int): The number of rows inserted per call.
+        """
+        if hnswlib is None:
+            raise ImportError("hnswlib is required to build the ANN index, install chroma-hnswlib or hnswlib")
+        self._check_writable()
+        start_time = time.time()
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=max(self.count, 1), M=M, ef_construction=ef_construction)
+        for start in range(0, self.count, batch_size):
+            rows = np.arange(start, min(start + batch_size, self.count))
+            index.add_items(np.asarray(self._matrix[rows], dtype=np.float32), rows)
+        index.save_index(self._path(ANN_INDEX))
+        with open(self._path(ANN_MANIFEST), "w") as ann_manifest_file:
+            json.dump({"count": self.count, "M": M, "ef_construction": ef_construction, "ef_search": ef_search}, ann_manifest_file)
+        self._load_ann_index()
+        print(f"Built ANN index of {self.count} rows in {time.time() - start_time:.2f} seconds")
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        """
+        Appends chunks with precomputed embeddings. Existing ids are replaced.
+
+        Args:
+            texts (list): The text of the chunks.
+            embeddings (list): The embeddings of the chunks.
+            metadatas (list, optional): The metadata of the chunks.
+            ids (list, optional): The ids of the chunks. Defaults to random uuids.
+
+        Returns:
+            list: The ids of the added chunks.
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        vectors = normalize(embeddings)
+        manifest = dict(self.manifest)
+        if manifest["dim"] is None:
+            manifest["dim"] = self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {vectors.shape[1]}")
+
+        replaced = [doc_id for doc_id in ids if doc_id in self._id_to_row]
+        if replaced:
+            self.delete(replaced)
+            manifest = dict(self.manifest)
+
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.array([len(text) for text in encoded], dtype=np.int64)
+        offsets = manifest["text_bytes"] + np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        itemsize = self.dtype.itemsize
+        self._append(EMBEDDINGS, self.count * self.dim * itemsize, vectors.astype(self.dtype).tobytes())
+        self._append(SPANS, self.count * 16, np.stack([offsets, lengths], axis=1).tobytes())
+        self._append(TEXTS, manifest["text_bytes"], b"".join(encoded))
+        if self.quantization == "int8":
+            codes, scales = quantize_int8(vectors)
+            self._append(CODES, self.count * self.dim, codes.tobytes())
+            self._append(SCALES, self.count * 4, scales.tobytes())
+
+        first_row = self.count
+        entries = [{"row": first_row + i, "id": doc_id, "metadata": metadata}
+                   for i, (doc_id, metadata) in enumerate(zip(ids, metadatas))]
+        manifest["log_bytes"] += self._append_log(entries, apply=False)
+        manifest["count"] = first_row + len(texts)
+        manifest["text_bytes"] += int(lengths.sum())
+        self._write_manifest(manifest)
+        self._map_files()
+        self._apply_log_entries(entries, new_rows=len(texts))
+        return ids
+
+    def quantize(self, quantization="int8", batch_size=BLOCK_ROWS):
+        """
+        Builds the int8 codes of an existing store, or drops them when quantization is None.
+
+        Args:
+            quantization (str): "int8" or None.
+            batch_size (int): The number of rows quantized per block.
+        """
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization '{quantization}', expected one of {QUANTIZATIONS}")
+        self._check_writable()
+        if quantization == "int8":
+            # Written aside and renamed into place, readers keep their mapping of the previous files until they reload.
+            tmp_paths = {name: self._path(f"{name}.{uuid.uuid4().hex}.tmp") for name in (CODES, SCALES)}
+            with open(tmp_paths[CODES], "wb") as codes_file, open(tmp_paths[SCALES], "wb") as scales_file:
+                for start in range(0, self.count, batch_size):
+                    codes, scales = quantize_int8(np.asarray(self._matrix[start:start + batch_size], dtype=np.float32))
+                    codes_file.write(codes.tobytes())
+                    scales_file.write(scales.tobytes())
+                for tmp_file in (codes_file, scales_file):
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+            for name, tmp_path in tmp_paths.items():
+                os.replace(tmp_path, self._path(name))
+        self._write_manifest(dict(self.manifest, quantization=quantization))
+        self.quantization = quantization
+        self._map_files()
+
+    def memory_footprint(self):
+        """
+        Returns:
+            dict: The bytes of the full-precision matrix and of the int8 codes with their scales, both kept on disk.
+        """
+        full_bytes = self.count * (self.dim or 0) * self.dtype.itemsize
+        quantized_bytes = self.count * ((self.dim or 0) + 4) if self.quantization == "int8" else 0
+        return {"full_precision_bytes": full_bytes, "quantized_bytes": quantized_bytes}
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if self._embedding_function is None:
+            raise ValueError("An embedding_function is required to add texts")
+        embeddings = self._embedding_function.embed_documents(texts)
+        return self.add_embeddings(texts, embeddings, metadatas, ids)
+
+    def delete(self, ids=None, **kwargs):
+        """
+        Deletes chunks by id. Their rows stay in the files until the store is compacted.
+
+        Args:
+            ids (list): The ids of the chunks to delete.
+
+        Returns:
+            bool: True if any chunk was deleted.
+        """
+        rows = [self._id_to_row[doc_id] for doc_id in ids or [] if doc_id in self._id_to_row]
+        if not rows:
+            return False
+        manifest = dict(self.manifest)
+        manifest["log_bytes"] += self._append_log([{"row": row, "deleted": True} for row in rows])
+        self._write_manifest(manifest)
+        return True
+
+    def update_metadatas(self, ids, metadatas):
+        """
+        Replaces the metadata of chunks.
+
+        Args:
+            ids (list): The ids of the chunks.
+            metadatas (list): Their new metadata.
+        """
+        entries = [{"row": self._id_to_row[doc_id], "metadata": metadata}
+                   for doc_id, metadata in zip(ids, metadatas) if doc_id in self._id_to_row]
+        if entries:
+            manifest = dict(self.manifest)
+            manifest["log_bytes"] += self._append_log(entries)
+            self._write_manifest(manifest)
+
+    def count_live(self):
+        """
+        Returns:
+            int: The number of chunks that have not been deleted.
+        """
+        return int(self._live.sum())
+
+    def _text(self, row):
+        offset, length = self._spans[row]
+        return self._texts[offset:offset + length].decode("utf-8")
+
+    def _document(self, row):
+        return Document(page_content=self._text(row), metadata=dict(self._metadatas[row]))
+
+    def _filter_rows(self, where):
+        """
+        Evaluates a Chroma style `where` clause against the metadata postings.
+
+        Args:
+            where (dict): The clause, e.g. {"$and": [{"topic": "divorcio"}, {"year": {"$gte": 2020}}]}.
+
+        Returns:
+            set: The rows matching the clause.
+        """
+        if "$and" in where:
+            clauses = [self._filter_rows(clause) for clause in where["$and"]]
+            return set.intersection(*clauses) if clauses else set()
+        if "$or" in where:
+            return set().union(*(self._filter_rows(clause) for clause in where["$or"]))
+        rows = None
+        for key, condition in where.items():
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            (operator, target), = condition.items()
+            if operator not in FILTER_OPERATORS:
+                raise ValueError(f"Unsupported filter operator '{operator}'")
+            compare = FILTER_OPERATORS[operator]
+            matched = set()
+            for value, value_rows in self._postings.get(key, {}).items():
+                try:
+                    if compare(value, target):
+                        matched |= value_rows
+                except TypeError:
+                    continue
+            rows = matched if rows is None else rows & matched
+        return rows if rows is not None else set()
+
+    def candidate_rows(self, where=None):
+        """
+        Returns:
+            np.ndarray or None: The sorted live rows matching the clause, or None when every live row is a candidate.
+        """
+        if not where:
+            return None
+        with self._index_lock:
+            rows = np.fromiter(self._filter_rows(where), dtype=np.int64)
+        rows.sort()
+        return rows[self._live[rows]]
+
+    def search_by_vectors(self, queries, k=4, where=None):
+        """
+        Finds the k most similar live chunks of each query embedding.
+
+        Args:
+            queries (array-like): The (q, dim) query embeddings.
+            k (int): The number of chunks to return per query.
+            where (dict, optional): A Chroma style metadata filter.
+
+        Returns:
+            tuple: The (q, k) rows and cosine similarities, most similar first. Missing results have row -1.
+        """
+        if self.read_only:
+            self.refresh()
+        queries = normalize(queries)
+        rows = self.candidate_rows(where)
+        if self.count == 0 or (rows is not None and len(rows) == 0):
+            return np.full((len(queries), 0), -1, dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        if self.exact:
+            return self._exact_search(queries, k, rows)
+        if self._ann is not None and (self.count_live() if rows is None else len(rows)) > self.ann_threshold:
+            # Filtered searches keep the index while enough rows match, smaller subsets are scanned exactly.
+            return self._ann_search(queries, k, rows)
+        if self._codes is not None:
+            candidates, _ = self._exact_search(queries, k * self.rescore_factor, rows, quantized=True)
+            return self._rescore(queries, candidates, k)
+        return self._exact_search(queries, k, rows)
+
+    def _rescore(self, queries, candidates, k):
+        unique_rows, positions = np.unique(candidates[candidates >= 0], return_inverse=True)
+        full_scores = queries @ np.asarray(self._matrix[unique_rows], dtype=np.float32).T
+        scores = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        valid = candidates >= 0
+        query_index = np.nonzero(valid)[0]
+        scores[valid] = full_scores[query_index, positions]
+        columns, best_scores = top_k(scores, k)
+        best_rows = np.take_along_axis(candidates, columns, axis=1)
+        best_rows[~np.isfinite(best_scores)] = -1
+        return best_rows, best_scores
+
+    def _exact_search(self, queries, k, rows=None, start_row=0, quantized=False):
+        matrix = self._codes if quantized else self._matrix
+        scales = self._scales
+        live_rows = self._live
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        # Rows mapped but not applied to the live mask yet are not searched.
+        total = min(len(matrix), len(live_rows)) - start_row if rows is None else len(rows)
+        block_size = max(1024, SEARCH_BLOCK_BYTES // (self.dim * 4))
+        for start in range(0, total, block_size):
+            if rows is None:
+                block_rows = np.arange(start_row + start, start_row + min(start + block_size, total))
+                block = matrix[block_rows[0]:block_rows[-1] + 1]
+                live = live_rows[block_rows]
+            else:
+                block_rows = rows[start:start + block_size]
+                block = matrix[block_rows]
+                live = None
+            scores = queries @ np.asarray(block, dtype=np.float32).T
+            if quantized:
+                scores *= scales[block_rows]
+            if live is not None:
+                scores[:, ~live] = -np.inf
+            columns, block_scores = top_k(scores, k)
+            merged_rows = np.concatenate([best_rows, block_rows[columns]], axis=1)
+            merged_scores = np.concatenate([best_scores, block_scores], axis=1)
+            columns, best_scores = top_k(merged_scores, k)
+            best_rows = np.take_along_axis(merged_rows, columns, axis=1)
+        best_rows[~np.isfinite(best_scores)] = -1
+        return best_rows, best_scores
+
+    def _ann_search(self, queries, k, rows=None):
+        allowed = self._live
+        if rows is not None:
+            # The candidate rows are live, the index only returns the ones among them.
+            allowed = np.zeros(len(allowed), dtype=bool)
+            allowed[rows] = True
+        ann_k = min(k, int(allowed[:self._ann_count].sum()))
+        if ann_k:
+            labels, distances = self._ann.knn_query(queries, k=ann_k, num_threads=1, filter=lambda label: bool(allowed[label]))
+            scores = 1 - distances
+        else:
+            labels, scores = np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        # Rows added after the index was built are searched exactly.
+        recent_rows = None
+        if rows is None:
+            if self.count > self._ann_count:
+                recent_rows, recent_scores = self._exact_search(queries, k, start_row=self._ann_count)
+        elif len(rows) and rows[-1] >= self._ann_count:
+            recent_rows, recent_scores = self._exact_search(queries, k, rows[np.searchsorted(rows, self._ann_count):])
+        if recent_rows is not None:
+            labels = np.concatenate([labels.astype(np.int64), recent_rows], axis=1)
+            scores = np.concatenate([scores, recent_scores], axis=1)
+        columns, best_scores = top_k(scores, k)
+        best_rows = np.take_along_axis(labels.astype(np.int64), columns, axis=1)
+        best_rows[~np.isfinite(best_scores)] = -1
+        return best_rows, best_scores
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None, **kwargs):
+        rows, scores = self.search_by_vectors([embedding], k, filter)
+        return [(self._document(row), float(score)) for row, score in zip(rows[0], scores[0]) if row >= 0]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # The scores are already cosine similarities of normalized embeddings.
+        return lambda score: score
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")):
+        """
+        Returns the live chunks in the same format as Chroma's `get`.
+
+        Args:
+            ids (list, optional): The ids of the chunks to return.
+            where (dict, optional): A Chroma style metadata filter.
+            limit (int, optional): The maximum number of chunks to return.
+            offset (int, optional): The number of matching chunks to skip.
+            include (tuple): The fields to return besides the ids: "documents", "metadatas" and "embeddings".
+
+        Returns:
+            dict: The ids and the requested fields of the chunks.
+        """
+        if self.read_only:
+            self.refresh()
+        if ids is not None:
+            rows = np.array([self._id_to_row[doc_id] for doc_id in ids if doc_id in self._id_to_row], dtype=np.int64)
+        else:
+            rows = np.flatnonzero(self._live)
+        if where:
+            rows = np.intersect1d(rows, self.candidate_rows(where))
+        rows = rows[offset or 0:]
+        if limit is not None:
+            rows = rows[:limit]
+        result = {"ids": [self._ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [self._text(row) for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [dict(self._metadatas[row]) for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = np.asarray(self._matrix[rows], dtype=np.float32)
+        return result
+
+    def compact(self):
+        """
+        Rewrites the store without its deleted rows and swaps it in place of the current directory.
+        """
+        self._check_writable()
+        live_rows = np.flatnonzero(self._live)
+        previous_count = self.count
+        compact_dir = f"{self.persist_directory.rstrip(os.sep)}.compact"
+        shutil.rmtree(compact_dir, ignore_errors=True)
+        compacted = LocalVectorStore(compact_dir, self._embedding_function, dtype=self.dtype.name, ann_threshold=self.ann_threshold,
+                                     quantization=self.quantization, rescore_factor=self.rescore_factor)
+        for start in range(0, len(live_rows), BLOCK_ROWS):
+            rows = live_rows[start:start + BLOCK_ROWS]
+            compacted.add_embeddings([self._text(row) for row in rows], np.asarray(self._matrix[rows], dtype=np.float32),
+                                     [self._metadatas[row] for row in rows], [self._ids[row] for row in rows])
+        swap_directories(compact_dir, self.persist_directory)
+        self._reload()
+        print(f"Compacted store from {previous_count} to {self.count} rows, rebuild the ANN index if it was used")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory=DEFAULT_PERSIST_DIRECTORY, **kwargs):
+        store = cls(persist_directory=persist_directory, embedding_function=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+def swap_directories(new_dir, target_dir):
+    """
+    Replaces a directory with another one, keeping the old one until the new one is in place.
+
+    Args:
+        new_dir (str): The directory to move into place.
+        target_dir (str): The directory to replace.
+    """
+    old_dir = f"{target_dir.rstrip(os.sep)}.old"
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(target_dir):
+        os.rename(target_dir, old_dir)
+    os.rename(new_dir, target_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def migrate_from_chroma(chroma_directory, target_directory=DEFAULT_PERSIST_DIRECTORY, collection_name="langchain",
+                        dtype="float32", batch_size=1000):
+    """
+    Copies the chunks, embeddings and metadata of a persisted Chroma collection into a new local store.
+
+    Args:
+        chroma_directory (str): The directory of the persisted Chroma store.
+        target_directory (str): The directory of the local store, replaced once the copy is complete.
+        collection_name (str): The name of the Chroma collection.
+        dtype (str): The dtype of the local store, "float32" or "float16".
+        batch_size (int): The number of chunks copied per call.
+
+    Returns:
+        LocalVectorStore: The migrated store.
+    """
+    import chromadb
+
+    start_time = time.time()
+    collection = chromadb.PersistentClient(path=chroma_directory).get_collection(collection_name)
+    migration_dir = f"{target_directory.rstrip(os.sep)}.migration"
+    shutil.rmtree(migration_dir, ignore_errors=True)
+    store = LocalVectorStore(migration_dir, dtype=dtype)
+    count = collection.count()
+    for offset in range(0, count, batch_size):
+        batch = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        store.add_embeddings(batch["documents"], batch["embeddings"], batch["metadatas"], batch["ids"])
+        print(f"Migrated {min(offset + batch_size, count)}/{count} chunks")
+    if store.count_live() != count:
+        raise RuntimeError(f"Migrated {store.count_live()} chunks instead of {count}, '{target_directory}' was left untouched")
+    swap_directories(migration_dir, target_directory)
+    print(f"Migration took {time.time() - start_time:.2f} seconds")
+    return LocalVectorStore(target_directory)
+
+
+def benchmark_quantization(store, k=6, num_queries=100, rescore_factors=(1, 2, 4, 8), noise=0.01, seed=0):
+    """
+    Compares the full-precision exact search of a store with the int8 first pass and full-precision re-scoring,
+    reporting the memory a search keeps hot, query latency and recall@k. The queries are stored embeddings with
+    a little gaussian noise, and the int8 codes are built in memory when the store is not quantized.
+
+    Each search path is called directly, so the ANN index of a large store does not answer in their place; it is
+    measured on its own row when the store has one.
+
+    Args:
+        store (LocalVectorStore): The store to benchmark.
+        k (int): The number of results per query.
+        num_queries (int): The number of sampled queries.
+        rescore_factors (tuple): The re-scored candidates per result to measure.
+        noise (float): The standard deviation of the noise added to the sampled embeddings.
+        seed (int): The seed of the query sample.
+
+    Returns:
+        list: One dict per configuration with the bytes a search reads for every query (the pages to keep in
+        memory), the full-precision bytes it reads per query, recall@k, mean and p95 latency in milliseconds.
+    """
+    live_rows = np.flatnonzero(store._live)
+    if len(live_rows) == 0:
+        print("The store is empty, nothing to benchmark")
+        return []
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(live_rows, size=min(num_queries, len(live_rows)), replace=False)
+    queries = normalize(np.asarray(store._matrix[sample], dtype=np.float32) + rng.normal(scale=noise, size=(len(sample), store.dim)))
+
+    original = (store._codes, store._scales)
+    codes, scales = store._codes, store._scales
+    if codes is None:
+        quantized = [quantize_int8(np.asarray(store._matrix[start:start + BLOCK_ROWS], dtype=np.float32))
+                     for start in range(0, store.count, BLOCK_ROWS)]
+        codes = np.concatenate([block_codes for block_codes, _ in quantized])
+        scales = np.concatenate([block_scales for _, block_scales in quantized])
+    full_bytes = store.count * store.dim * store.dtype.itemsize
+    row_bytes = store.dim * store.dtype.itemsize
+
+    def measure(label, search, resident_bytes, fetched_bytes):
+        found = []
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            rows, _ = search(query[None, :])
+            latencies.append(time.perf_counter() - start_time)
+            found.append(rows[0])
+        latencies_ms = np.array(latencies) * 1000
+        return {"search": label, "resident_bytes": resident_bytes, "fetched_bytes": fetched_bytes, "found": found,
+                "mean_ms": float(latencies_ms.mean()), "p95_ms": float(np.percentile(latencies_ms, 95))}
+
+    def rescore_search(rescore_factor):
+        def search(query):
+            candidates, _ = store._exact_search(query, k * rescore_factor, quantized=True)
+            return store._rescore(query, candidates, k)
+        return search
+
+    results = []
+    try:
+        results.append(measure("float32 exact" if store.dtype == np.float32 else f"{store.dtype.name} exact",
+                               lambda query: store._exact_search(query, k), full_bytes, full_bytes))
+        store._codes, store._scales = codes, scales
+        for rescore_factor in rescore_factors:
+            # The codes are scanned for every query, the float32 rows only for the candidates re-scored.
+            results.append(measure(f"int8 x{rescore_factor} rescore", rescore_search(rescore_factor),
+                                   store.count * (store.dim + 4), k * rescore_factor * row_bytes))
+    finally:
+        store._codes, store._scales = original
+    if store._ann is not None:
+        results.append(measure("hnsw ann", lambda query: store._ann_search(query, k),
+                               os.path.getsize(store._path(ANN_INDEX)), 0))
+
+    expected = results[0]["found"]
+    print(f"{'search':<20}{'resident MB':>13}{'fetched KB':>12}{f'recall@{k}':>11}{'mean ms':>10}{'p95 ms':>9}")
+    for row in results:
+        hits = sum(len(set(found[found >= 0]) & set(exact[exact >= 0])) for found, exact in zip(row.pop("found"), expected))
+        row["recall"] = hits / sum(len(exact[exact >= 0]) for exact in expected)
+        print(f"{row['search']:<20}{row['resident_bytes'] / 2 ** 20:>13.1f}{row['fetched_bytes'] / 2 ** 10:>12.1f}"
+              f"{row['recall']:>11.3f}{row['mean_ms']:>10.2f}{row['p95_ms']:>9.2f}")
+    codes_bytes = store.count * (store.dim + 4)
+    print(f"resident: pages read by every query. fetched: full-precision rows read per query, from disk when not cached.\n"
+          f"The int8 search saves {(full_bytes - codes_bytes) / 2 ** 20:.1f} MB of memory once the float32 pages are evicted, "
+          f"but the matrix is kept, so the codes add {codes_bytes / 2 ** 20:.1f} MB on disk "
+          f"({(full_bytes + codes_bytes) / 2 ** 20:.1f} MB in total).")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tools for the local memory-mapped vector store.")
+    parser.add_argument("command", choices=["migrate", "stats", "build_ann", "compact", "quantize", "benchmark_quantization"],
+                        help="migrate: copy the Chroma store, stats: report the store, build_ann: build the hnswlib index, compact: drop deleted rows, "
+                             "quantize: build (or with --quantization none drop) the int8 codes, benchmark_quantization: int8 vs full precision")
+    parser.add_argument("--persist-directory", default=DEFAULT_PERSIST_DIRECTORY)
+    parser.add_argument("--chroma-directory", default="abogacia_data")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, default=64)
+    parser.add_argument("--quantization", default="int8", choices=["int8", "none"])
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        local_store = migrate_from_chroma(args.chroma_directory, args.persist_directory, dtype=args.dtype)
+    else:
+        start = time.time()
+        local_store = LocalVectorStore(args.persist_directory)
+        print(f"Opened store in {(time.time() - start) * 1000:.1f} ms")
+    if args.command == "build_ann":
+        local_store.build_ann_index(M=args.M, ef_construction=args.ef_construction, ef_search=args.ef_search)
+    elif args.command == "compact":
+        local_store.compact()
+    elif args.command == "quantize":
+        local_store.quantize(None if args.quantization == "none" else args.quantization)
+    elif args.command == "benchmark_quantization":
+        benchmark_quantization(local_store, k=args.k, num_queries=args.queries)
+    print(f"rows: {local_store.count}, live: {local_store.count_live()}, dim: {local_store.dim}, dtype: {local_store.dtype.name}, "
+          f"quantization: {local_store.quantization}, ann index rows: {local_store._ann_count}, {local_store.memory_footprint()}")
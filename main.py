@@ -1,34 +1,274 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from typing import Dict
-from document_downloader import DocumentDownloader
-from utils_Chromadb import UtilsDB
-from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
-from utils_mongoDb import MongoDBUtils
-from Embedding_Chain_Bot import EmbeddingChainChatBot
-import openai
+from typing import Dict, Optional
+from collections import OrderedDict
 from dotenv import load_dotenv
+import asyncio
+import threading
+import time
 import os
 
+from admission_control import AdmissionController, AdmissionRejected
+
+# Heavy modules (langchain chains, OpenAI, pymongo, selenium, the document loaders) are imported by warm_up()
+# in the background or by the endpoints that need them, so uvicorn accepts requests as soon as this module loads.
 load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
-app = FastAPI()
+# Seconds a request waits for the warm-up before answering 503.
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 30))
+# Sessions live in MongoDB, so any worker can serve any session. Each worker keeps the chatbots of its most recently
+# used sessions and rebuilds the others from their MongoDB history.
+MAX_CACHED_CHATBOTS = int(os.getenv("MAX_CACHED_CHATBOTS", 256))
+# Only the ingestion writer downloads, ingests and deletes documents, the other workers open the vector store read-only.
+# With INGESTION_WRITER=auto (the default) the first worker to lock INGESTION_WRITER_LOCK is the writer, so one of the
+# workers of `uvicorn --workers N` writes; 1 requires the lock, 0 makes the process read-only.
+INGESTION_WRITER_MODE = os.getenv("INGESTION_WRITER", "auto")
+INGESTION_WRITER_LOCK = os.getenv("INGESTION_WRITER_LOCK", os.path.join("downloads", "ingestion_writer.lock"))
+# Memory of the chatbots: buffer, buffer_window (last turns) or buffer_summary (rolling summary plus last turns).
+CHAT_MEMORY_TYPE = os.getenv("CHAT_MEMORY_TYPE", "buffer_window")
+# Save each turn to the chat history after the answer is returned instead of before, off by default.
+CHAT_PERSIST_ASYNC = os.getenv("CHAT_PERSIST_ASYNC", "0") == "1"
+# Questions answered at once by this worker, questions waiting at once, questions of one session waiting at once and
+# seconds a question waits before it is answered with 429.
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", 8))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", 64))
+CHAT_MAX_SESSION_QUEUE = int(os.getenv("CHAT_MAX_SESSION_QUEUE", 2))
+CHAT_QUEUE_TIMEOUT = float(os.getenv("CHAT_QUEUE_TIMEOUT", 30))
+# Route the questions to their closest topics once `python topic_router.py build` has computed the centroids, off by
+# default until `retrieval_eval.py run --topics 0 2` shows routing keeps the recall of the golden set, and pre-warm the
+# caches with this many frequent questions per topic after the warm-up (0 disables it).
+TOPIC_ROUTING = os.getenv("TOPIC_ROUTING", "0") == "1"
+PREWARM_QUESTIONS_PER_TOPIC = int(os.getenv("PREWARM_QUESTIONS_PER_TOPIC", 5))
+# Trace allocations with tracemalloc and add the /admin/memory endpoints, off by default (it slows every allocation).
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "0") == "1"
+
+db_utils = None
+shared_vectordb = None
+topic_router = None
+query_embedding_cache = None
+# Set by elect_writer() when the worker starts.
+INGESTION_WRITER = False
+process_locks = []
+user_chatbots = OrderedDict()
+chatbots_lock = threading.Lock()
+warmup_done = threading.Event()
+warmup_state = {"status": "warming_up", "error": None, "timings": {}}
+admission = AdmissionController(CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_MAX_SESSION_QUEUE, CHAT_QUEUE_TIMEOUT)
+# Summary updates running after their answer was returned, referenced until they finish.
+memory_updates = set()
+
+
+def lock_file(path):
+    """
+    Takes an exclusive lock on a file, held until the process exits.
+
+    Args:
+        path (str): The path of the lock file, created with its directory if missing.
+
+    Returns:
+        bool: Whether the lock was taken, False if another process holds it.
+    """
+    import fcntl
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    lock = open(path, "a+")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return False
+    lock.truncate(0)
+    lock.write(str(os.getpid()))
+    lock.flush()
+    process_locks.append(lock)
+    return True
+
+
+def local_chroma_directory():
+    """
+    Returns:
+        str: The persisted Chroma directory this process opens, None for a Chroma server or the local backend.
+    """
+    from utils_Chromadb import DEFAULT_VECTOR_BACKEND
+    if os.getenv("VECTOR_BACKEND", DEFAULT_VECTOR_BACKEND) != "chroma" or os.getenv("CHROMA_HOST"):
+        return None
+    return os.getenv("VECTOR_STORE_DIRECTORY") or "abogacia_data"
+
+
+def elect_writer():
+    """
+    Decides whether this worker is the ingestion writer, see INGESTION_WRITER_MODE, and refuses to share a persisted
+    Chroma directory with another worker.
+
+    Raises:
+        RuntimeError: If another process uses the persisted Chroma directory, or holds the writer lock while
+            INGESTION_WRITER=1.
+    """
+    global INGESTION_WRITER
+    chroma_directory = local_chroma_directory()
+    if chroma_directory and not lock_file(f"{chroma_directory.rstrip(os.sep)}.lock"):
+        raise RuntimeError(f"Another worker uses the Chroma directory '{chroma_directory}', which only one process can "
+                           "use safely. Run a single worker or set CHROMA_HOST to a Chroma server.")
+    if INGESTION_WRITER_MODE == "0":
+        INGESTION_WRITER = False
+    else:
+        INGESTION_WRITER = lock_file(INGESTION_WRITER_LOCK)
+        if not INGESTION_WRITER and INGESTION_WRITER_MODE == "1":
+            raise RuntimeError(f"Another process holds the ingestion writer lock '{INGESTION_WRITER_LOCK}'")
+
+
+def warm_up():
+    """
+    Connects to MongoDB and opens the shared vector store, read-only unless this process is the ingestion writer.
+    Runs in a background thread started by the lifespan hook; /ready reports its progress.
+    """
+    timings = warmup_state["timings"]
+    start_time = time.perf_counter()
+    try:
+        import openai
+        from utils_mongoDb import MongoDBUtils
+        from utils_Chromadb import get_vectordb
+        from langchain_openai import OpenAIEmbeddings
+        global db_utils, shared_vectordb, topic_router, query_embedding_cache
+
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        db_utils = MongoDBUtils()
+        timings["mongodb_connected"] = round(time.perf_counter() - start_time, 3)
+
+        import Embedding_Chain_Bot  # noqa: F401 imports the langchain chains once, off the request path
+        timings["chatbot_imported"] = round(time.perf_counter() - start_time, 3)
+
+        shared_vectordb = get_vectordb(OpenAIEmbeddings(), read_only=not INGESTION_WRITER)
+        timings["vectordb_opened"] = round(time.perf_counter() - start_time, 3)
+
+        from embedding_cache import EmbeddingCache
+        from topic_router import load_router
+        query_embedding_cache = EmbeddingCache()
+        topic_router = load_router(embeddings=shared_vectordb.embeddings) if TOPIC_ROUTING else None
+        timings["topic_router_loaded"] = round(time.perf_counter() - start_time, 3)
+        warmup_state["status"] = "ready"
+        role = "ingestion writer" if INGESTION_WRITER else "read-only worker"
+        routing = f"routing to {len(topic_router.topics)} topics" if topic_router else "without topic routing"
+        print(f"Warm-up finished in {timings['topic_router_loaded']} seconds as {role}, {routing} (pid {os.getpid()})")
+    except Exception as e:
+        warmup_state["status"] = "failed"
+        warmup_state["error"] = str(e)
+        print("Warm-up failed:", e)
+    finally:
+        warmup_done.set()
+    if warmup_state["status"] == "ready" and PREWARM_QUESTIONS_PER_TOPIC > 0:
+        prewarm_caches()
+
+
+def prewarm_caches():
+    """
+    Embeds and searches the frequent questions of each topic, once the service is ready, so the first users asking
+    them wait for neither the embedding API nor the first reads of the vector store.
+    """
+    try:
+        from embedding_executor import EmbeddingExecutor
+        from topic_router import build_retriever, load_questions, prewarm
+        questions = load_questions(per_topic=PREWARM_QUESTIONS_PER_TOPIC)
+        if questions:
+            retriever = build_retriever(shared_vectordb, {"k": 6}, topic_router, query_embedding_cache)
+            prewarm(retriever, questions, EmbeddingExecutor(shared_vectordb.embeddings, cache=query_embedding_cache))
+    except Exception as e:
+        print("Pre-warming failed:", e)
+
+
+def wait_until_ready():
+    """
+    Blocks until the warm-up has finished.
+
+    Raises:
+        HTTPException: 503 if the warm-up is still running after WARMUP_TIMEOUT seconds or has failed.
+    """
+    if not warmup_done.wait(WARMUP_TIMEOUT):
+        raise HTTPException(status_code=503, detail="Service is warming up, please retry.", headers={"Retry-After": "5"})
+    if warmup_state["status"] != "ready":
+        raise HTTPException(status_code=503, detail=f"Warm-up failed: {warmup_state['error']}")
+
+
+def require_writer():
+    """
+    Raises:
+        HTTPException: 403 if this process is a read-only worker.
+    """
+    if not INGESTION_WRITER:
+        raise HTTPException(status_code=403, detail="This worker is read-only, send ingestion requests to the ingestion writer.")
 
-# Load existing chat sessions from MongoDB into user_chatbots
-db_utils = MongoDBUtils()
-user_chatbots = {}
 
-unique_session_ids = db_utils.get_unique_session_ids()
-for session_id in unique_session_ids:
-    user_chatbots[session_id] = EmbeddingChainChatBot(session_id=session_id)
-    print(f"Loaded existing user with session_id: {session_id}")
+def session_exists(session_id):
+    """
+    Checks whether a session was created, by this worker or any other one.
+
+    Args:
+        session_id (str): The id of the session.
+
+    Returns:
+        bool: True if this worker caches the chatbot of the session or the session has a chat history in MongoDB.
+    """
+    with chatbots_lock:
+        if session_id in user_chatbots:
+            return True
+    return db_utils.session_exists(session_id)
+
+
+def get_chatbot(session_id):
+    """
+    Returns the EmbeddingChainChatBot of a session, building it with the shared vector store when it is not one of
+    the MAX_CACHED_CHATBOTS most recently used. Its memory is read from MongoDB, so a rebuilt chatbot continues the
+    conversation.
+
+    Args:
+        session_id (str): The id of the session.
+
+    Returns:
+        EmbeddingChainChatBot: The chatbot of the session.
+    """
+    with chatbots_lock:
+        if session_id in user_chatbots:
+            user_chatbots.move_to_end(session_id)
+            return user_chatbots[session_id]
+        from Embedding_Chain_Bot import EmbeddingChainChatBot
+        chatbot = EmbeddingChainChatBot(session_id=session_id, memory_type=CHAT_MEMORY_TYPE, vectordb=shared_vectordb,
+                                        topic_router=topic_router, embedding_cache=query_embedding_cache,
+                                        persist_async=CHAT_PERSIST_ASYNC)
+        user_chatbots[session_id] = chatbot
+        while len(user_chatbots) > MAX_CACHED_CHATBOTS:
+            # Not closed here, a request may still be using it.
+            user_chatbots.popitem(last=False)
+        print(f"Loaded user with session_id: {session_id}")
+        return chatbot
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Before the warm-up, so the role is known to require_writer() and a shared Chroma directory stops the worker.
+    elect_writer()
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+if MEMORY_PROFILING:
+    import memory_profiling
+    memory_profiling.install(app, lambda: dict(user_chatbots),
+                             lambda: [shared_vectordb, getattr(shared_vectordb, "embeddings", None), topic_router,
+                                      query_embedding_cache, db_utils])
 
 class DownloadRequest(BaseModel):
     temas_legales: Dict[str, int] = Field(
         default={"Divorcio": 10, "PQR": 2, "Abandono de bienes": 10, "Abandono de menores": 10},
         description="A dictionary where the keys are legal topics and the values are the number of documents to download for each topic."
     )
+    incremental: bool = Field(
+        default=False,
+        description="Only download the rulings published since the last run, the values then cap the new documents of each topic."
+    )
 
 class DeleteRequest(BaseModel):
     filename: str
@@ -36,19 +276,60 @@ class DeleteRequest(BaseModel):
 class SessionInput(BaseModel):
     session_id: str
     
+class RetrievalFilters(BaseModel):
+    """
+    Pydantic model for the optional metadata filters pushed down into the vector search.
+    """
+    topic: Optional[str] = Field(default=None, description="Legal topic the ruling was downloaded for, e.g. 'Divorcio'.")
+    court: Optional[str] = Field(default=None, description="Court of the ruling, e.g. 'CSJ'.")
+    chamber: Optional[str] = Field(default=None, description="Chamber of the court: 'civil', 'laboral' or 'penal'.")
+    year: Optional[int] = Field(default=None, description="Year of the ruling.")
+    doc_id: Optional[str] = Field(default=None, description="Providencia number of the ruling, e.g. 'STC1234-2020'.")
+
 class QuestionInput(BaseModel):
     """
     Pydantic model for incoming question input.
     """
     query: str
     session_id: str
+    filters: Optional[RetrievalFilters] = None
     
 
+@app.get("/health")
+async def health():
+    return {"status": "alive"}
+
+@app.get("/ready")
+async def ready():
+    """
+    Reports the warm-up: 200 once MongoDB and the vector store are open, 503 before or if it failed.
+    """
+    status_code = 200 if warmup_state["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=warmup_state)
+
+@app.get("/stats/coalescing")
+def coalescing_stats():
+    """
+    Reports the embeddings, searches and LLM calls of this worker shared between identical concurrent questions.
+    """
+    import single_flight
+    return {"pid": os.getpid(), "groups": single_flight.stats()}
+
+@app.get("/stats/admission")
+async def admission_stats():
+    """
+    Reports the questions running and waiting in this worker, the rejected ones and the time they waited.
+    """
+    return {"pid": os.getpid(), **admission.stats()}
+
 @app.post("/download_documents/")
-async def download_documents(request: DownloadRequest):
+def download_documents(request: DownloadRequest):
+    require_writer()
+    from document_downloader import DocumentDownloader
     try:
         downloader = DocumentDownloader(
-            topics=request.temas_legales
+            topics=request.temas_legales,
+            incremental=request.incremental
         )
         downloader.run()
         return {"status": "success", "message": "Documents downloaded successfully."}
@@ -56,55 +337,104 @@ async def download_documents(request: DownloadRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/delete_document/")
-async def delete_document(request: DeleteRequest):
+def delete_document(request: DeleteRequest):
+    require_writer()
+    wait_until_ready()
+    from utils_Chromadb import UtilsDB
     try:
-        load_dotenv()
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        vectordb = Chroma(persist_directory="abogacia_data", embedding_function=OpenAIEmbeddings())
-        utils_db = UtilsDB(vectordb)
+        utils_db = UtilsDB(shared_vectordb)
         result = utils_db.delete_DB_document_and_file(request.filename)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.post("/load_chat_history")
-async def load_chat_history(session_input: SessionInput):
+def load_chat_history(session_input: SessionInput):
+    wait_until_ready()
     session_id = session_input.session_id
       # Retrieve the EmbeddingChainChatBot instance for the user or create a new instance if it doesn't exist
-    if session_id not in user_chatbots:
-        user_chatbots[session_id] = EmbeddingChainChatBot(session_id=session_id)
+    if not session_exists(session_id):
+        chain_chatbot = get_chatbot(session_id)
         print("new user created with session_id: ",session_id)
-        chain_chatbot = user_chatbots[session_id]
         chain_chatbot.memory.chat_memory.add_ai_message("Hello, I'm AbogacIA Chatbot. \n How can i Help You today?")
         chat_history = chain_chatbot.load_chat_history()
 
     else:        
-        chain_chatbot = user_chatbots[session_id]        
+        chain_chatbot = get_chatbot(session_id)        
         chat_history = chain_chatbot.load_chat_history()
 
     return {"chat_history": chat_history}
 
 @app.post("/ask_chain_bot")
-def ask_chain_bot(question_input: QuestionInput):
+async def ask_chain_bot(question_input: QuestionInput):
+    # Waiting questions hold no thread, one question per session runs at a time.
+    session_id = question_input.session_id
+    try:
+        await admission.acquire(session_id)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    start_time = time.perf_counter()
+    chatbot = None
+    try:
+        result, chatbot = await run_in_threadpool(answer_question, question_input)
+        return result
+    finally:
+        if chatbot is None:
+            admission.release(session_id, time.perf_counter() - start_time)
+        else:
+            # The rolling summary is extended once the answer has been sent. The session keeps its slot meanwhile, so
+            # its next question does not use the memory of the chatbot while the update reads and writes it.
+            task = asyncio.create_task(update_memory_and_release(chatbot, session_id, time.perf_counter() - start_time))
+            memory_updates.add(task)
+            task.add_done_callback(memory_updates.discard)
+
+
+async def update_memory_and_release(chatbot, session_id, service_time):
+    """
+    Updates the summary of a session after its answer was returned, then frees the admission slot of the session.
+
+    Args:
+        chatbot (EmbeddingChainChatBot): The chatbot of the session.
+        session_id (str): The id of the session.
+        service_time (float): The seconds the answer took.
+    """
+    try:
+        await run_in_threadpool(chatbot.update_memory)
+    except Exception as e:
+        print(f"Failed to update the memory of session {session_id}: {e}")
+    finally:
+        admission.release(session_id, service_time)
+
+
+def answer_question(question_input: QuestionInput):
+    """
+    Returns:
+        tuple: The response, and the chatbot whose summary must be updated once it is sent, None if there is none.
+    """
     question = question_input.query
     session_id = question_input.session_id
+    wait_until_ready()
 
-    # Check if session_id exists in user_chatbots
-    if session_id not in user_chatbots:
+    # Check if session_id was created by this worker or exists in MongoDB
+    if not session_exists(session_id):
         error_message = f"Session with session_id '{session_id}' not found. Please create a new session."
-        return {"error": error_message,"answer": ""}
+        return {"error": error_message,"answer": ""}, None
 
-    chain_chatbot = user_chatbots[session_id]
+    chain_chatbot = get_chatbot(session_id)
+    update = None
     
     response = "Please enter a valid question"  # Default response if query is not provided or an error occurs
     if question != "":
-        embedding_chain_bot_response = chain_chatbot.ask_model(question, True)
+        filters = question_input.filters.model_dump(exclude_none=True) if question_input.filters else None
+        embedding_chain_bot_response = chain_chatbot.ask_model(question, True, filters=filters)
         if embedding_chain_bot_response != "":
             response = embedding_chain_bot_response
+        if chain_chatbot.memory_type == "buffer_summary":
+            update = chain_chatbot
 
     print("Question:", question)
     print("Answer:", response)
-    return {"answer": response,"error": ""}
+    return {"answer": response,"error": ""}, update
 
 
 
@@ -112,4 +442,9 @@ def ask_chain_bot(question_input: QuestionInput):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Several workers need the app as an import string, each one imports main.py and warms up on its own.
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    if workers > 1 and local_chroma_directory():
+        raise SystemExit(f"WEB_CONCURRENCY={workers} workers cannot share the Chroma directory '{local_chroma_directory()}', "
+                         "set CHROMA_HOST to a Chroma server or VECTOR_BACKEND=local.")
+    uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", 8000)), workers=workers)
@@ -0,0 +1,338 @@
+"""
+Opt-in memory profiling of the API and of the ingestion: tracemalloc snapshots, the allocations of each endpoint and
+of each ingested document, and the size of the objects each cached session keeps alive.
+
+Nothing here runs unless MEMORY_PROFILING=1: main.py then starts tracemalloc, measures every request and adds the
+admin endpoints, otherwise it does not import this module. `track` blocks, used around the ingestion of a document,
+return at once while tracemalloc is off.
+
+Usage:
+    python memory_profiling.py top downloads/memory_snapshots/1700000000-42.snap
+    python memory_profiling.py diff downloads/memory_snapshots/1700000000-42.snap downloads/memory_snapshots/1700003600-42.snap
+    python memory_profiling.py ingest downloads/Divorcio/SC3727-2021.pdf --parse-only
+"""
+import gc
+import linecache
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from contextlib import contextmanager
+
+DEFAULT_SNAPSHOT_DIRECTORY = os.path.join("downloads", "memory_snapshots")
+# Frames kept per allocation, more frames give longer tracebacks and a slower, larger trace.
+TRACE_FRAMES = 10
+# Objects visited per size measurement, bounds the time of the admin endpoint with many sessions.
+MAX_OBJECTS = 200000
+
+_SKIPPED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType,
+                  types.CodeType, types.FrameType)
+_lock = threading.Lock()
+_blocks = {}
+# Blocks running, and blocks started since tracemalloc.reset_peak, to keep only the peaks of blocks that ran alone.
+_active = 0
+_started = 0
+
+
+def start(frames=TRACE_FRAMES):
+    """
+    Starts tracing the allocations of the process, if they are not traced yet.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+        print(f"Memory profiling enabled, tracing {frames} frames per allocation (pid {os.getpid()})")
+
+
+def rss_bytes():
+    """
+    Returns:
+        int: The resident set size of the process, its peak where /proc is not available.
+    """
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _begin():
+    global _active, _started
+    with _lock:
+        if _active == 0:
+            tracemalloc.reset_peak()
+            _started = 0
+        _active += 1
+        _started += 1
+        return _started, tracemalloc.get_traced_memory()[0], time.perf_counter()
+
+
+def _end(name, token):
+    global _active
+    started, before, start_time = token
+    current, peak = tracemalloc.get_traced_memory()
+    with _lock:
+        alone = started == 1 and _started == 1
+        _active -= 1
+        stats = _blocks.setdefault(name, {"calls": 0, "retained_bytes": 0, "max_retained_bytes": 0,
+                                          "max_peak_bytes": 0, "seconds": 0.0})
+        stats["calls"] += 1
+        stats["retained_bytes"] += current - before
+        stats["max_retained_bytes"] = max(stats["max_retained_bytes"], current - before)
+        if alone:
+            stats["max_peak_bytes"] = max(stats["max_peak_bytes"], peak - before)
+        stats["seconds"] += time.perf_counter() - start_time
+
+
+@contextmanager
+def track(name):
+    """
+    Records the memory a block of code keeps allocated and, when no other block ran meanwhile, its peak.
+
+    Args:
+        name (str): The name the block is reported under, e.g. "add_db_doc".
+    """
+    if not tracemalloc.is_tracing():
+        yield
+        return
+    token = _begin()
+    try:
+        yield
+    finally:
+        _end(name, token)
+
+
+def block_stats():
+    """
+    Returns:
+        dict: Per block, its calls, the bytes it kept allocated in total and at most, its highest peak above the
+        memory traced when it started, measured only when it ran alone, and its seconds.
+    """
+    with _lock:
+        return {name: dict(stats) for name, stats in sorted(_blocks.items(), key=lambda item: -item[1]["retained_bytes"])}
+
+
+def deep_size(obj, exclude_ids=(), max_objects=MAX_OBJECTS):
+    """
+    Adds up the sizes of the objects reachable from `obj`, without classes, modules, functions and the excluded objects.
+
+    Args:
+        obj: The object.
+        exclude_ids (set): The ids of objects shared by every session, e.g. the vector store, not counted nor visited.
+        max_objects (int): The objects visited at most.
+
+    Returns:
+        tuple: The bytes and whether the walk stopped at `max_objects`.
+    """
+    seen = set(exclude_ids)
+    pending = [obj]
+    size = 0
+    while pending:
+        if len(seen) - len(exclude_ids) >= max_objects:
+            return size, True
+        current = pending.pop()
+        if id(current) in seen or isinstance(current, _SKIPPED_TYPES):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current, 0)
+        pending.extend(gc.get_referents(current))
+    return size, False
+
+
+def session_sizes(chatbots, shared=(), limit=10):
+    """
+    Measures the objects each cached chatbot keeps alive besides the objects shared by every session.
+
+    Args:
+        chatbots (dict): Session id to its EmbeddingChainChatBot.
+        shared (list): The shared objects, e.g. the vector store, the topic router and the caches.
+        limit (int): The largest sessions reported.
+
+    Returns:
+        dict: The number of sessions, the bytes of all of them and, for the largest ones, the bytes of their memory,
+        retriever, engine (which holds the memory and retriever) and of the whole chatbot.
+    """
+    exclude_ids = {id(obj) for obj in shared if obj is not None}
+    sessions = []
+    for session_id, chatbot in list(chatbots.items()):
+        sizes = {"session_id": session_id}
+        for name in ("memory", "retriever", "engine"):
+            sizes[name] = deep_size(getattr(chatbot, name, None), exclude_ids)[0]
+        sizes["total"], sizes["truncated"] = deep_size(chatbot, exclude_ids)
+        sessions.append(sizes)
+    sessions.sort(key=lambda sizes: -sizes["total"])
+    return {"sessions": len(sessions), "total_bytes": sum(sizes["total"] for sizes in sessions), "largest": sessions[:limit]}
+
+
+def _filter(snapshot):
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def take_snapshot(directory=DEFAULT_SNAPSHOT_DIRECTORY):
+    """
+    Saves a tracemalloc snapshot of the process.
+
+    Returns:
+        tuple: The path of the snapshot and the snapshot.
+
+    Raises:
+        RuntimeError: If tracemalloc is not tracing.
+    """
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("Memory profiling is off, set MEMORY_PROFILING=1")
+    snapshot = _filter(tracemalloc.take_snapshot())
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{int(time.time())}-{os.getpid()}.snap")
+    snapshot.dump(path)
+    return path, snapshot
+
+
+def format_stat(stat):
+    """
+    Returns:
+        dict: The size, count and allocation site of a tracemalloc Statistic or StatisticDiff.
+    """
+    frame = stat.traceback[0]
+    formatted = {"site": f"{frame.filename}:{frame.lineno}", "line": linecache.getline(frame.filename, frame.lineno).strip(),
+                 "size_bytes": stat.size, "count": stat.count}
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        formatted["size_diff_bytes"] = stat.size_diff
+        formatted["count_diff"] = stat.count_diff
+    return formatted
+
+
+def top(snapshot, limit=20, key_type="lineno"):
+    """
+    Returns:
+        list: The `limit` allocation sites holding the most memory in the snapshot.
+    """
+    return [format_stat(stat) for stat in snapshot.statistics(key_type)[:limit]]
+
+
+def diff(old_path, new_path, limit=20, key_type="lineno"):
+    """
+    Compares two snapshots of the same process.
+
+    Returns:
+        list: The `limit` allocation sites whose memory grew or shrank the most, largest change first.
+    """
+    old = tracemalloc.Snapshot.load(old_path)
+    new = tracemalloc.Snapshot.load(new_path)
+    return [format_stat(stat) for stat in new.compare_to(old, key_type)[:limit]]
+
+
+def report(chatbots=None, shared=(), sessions=10):
+    """
+    Returns:
+        dict: The RSS and traced memory of the process, the stats of the tracked blocks and the session sizes.
+    """
+    current, peak = tracemalloc.get_traced_memory()
+    result = {"pid": os.getpid(), "tracing": tracemalloc.is_tracing(), "rss_bytes": rss_bytes(),
+              "traced_bytes": current, "traced_peak_bytes": peak, "blocks": block_stats()}
+    if chatbots is not None:
+        result["sessions"] = session_sizes(chatbots, shared, sessions)
+    return result
+
+
+def install(app, chatbots, shared):
+    """
+    Starts tracemalloc, tracks every request under its method and route, and adds the admin endpoints:
+    GET /admin/memory (the report) and POST /admin/memory/snapshot (saves a snapshot and lists its top sites).
+
+    Args:
+        app (FastAPI): The application.
+        chatbots (callable): Returns the cached chatbots by session id.
+        shared (callable): Returns the objects shared by every session.
+    """
+    from fastapi import HTTPException, Request
+
+    start()
+
+    @app.middleware("http")
+    async def track_request(request: Request, call_next):
+        token = _begin()
+        try:
+            return await call_next(request)
+        finally:
+            # Named after the route once routed, so unknown paths share one entry.
+            route = request.scope.get("route")
+            _end(f"{request.method} {route.path if route is not None else '(no route)'}", token)
+
+    @app.get("/admin/memory")
+    def memory_report(sessions: int = 10):
+        return report(chatbots(), shared(), sessions)
+
+    @app.post("/admin/memory/snapshot")
+    def memory_snapshot(limit: int = 20):
+        try:
+            path, snapshot = take_snapshot()
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return {"path": path, "rss_bytes": rss_bytes(), "top": top(snapshot, limit)}
+
+
+def _print_stats(stats):
+    for stat in stats:
+        change = f" ({stat['size_diff_bytes'] / 1024:+.1f} KiB, {stat['count_diff']:+d} blocks)" if "size_diff_bytes" in stat else ""
+        print(f"{stat['size_bytes'] / 1024:10.1f} KiB {stat['count']:8d} blocks{change}  {stat['site']}  {stat['line']}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or compare tracemalloc snapshots, or profile the ingestion of a document.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    top_parser = subparsers.add_parser("top", help="list the allocation sites of a snapshot")
+    top_parser.add_argument("snapshot")
+    diff_parser = subparsers.add_parser("diff", help="list the allocation sites that changed between two snapshots")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    ingest_parser = subparsers.add_parser("ingest", help="ingest a document with UtilsDB.add_db_doc under tracemalloc")
+    ingest_parser.add_argument("path")
+    ingest_parser.add_argument("--parse-only", action="store_true", help="only extract and split the text, do not embed nor store it")
+    for subparser in (top_parser, diff_parser, ingest_parser):
+        subparser.add_argument("--limit", type=int, default=20)
+        subparser.add_argument("--key-type", choices=["lineno", "filename", "traceback"], default="lineno")
+    args = parser.parse_args()
+
+    if args.command == "top":
+        _print_stats(top(tracemalloc.Snapshot.load(args.snapshot), args.limit, args.key_type))
+    elif args.command == "diff":
+        _print_stats(diff(args.old, args.new, args.limit, args.key_type))
+    else:
+        from dotenv import load_dotenv
+        from text_extraction import batched, iter_chunks
+        from utils_Chromadb import UtilsDB, document_metadata_from_path, get_vectordb
+
+        load_dotenv()
+        # Imported and opened before tracing, so only the allocations of the ingestion are reported.
+        import docx2txt  # noqa: F401
+        import pymupdf  # noqa: F401
+        from langchain_core.documents import Document  # noqa: F401
+        from langchain_text_splitters import CharacterTextSplitter  # noqa: F401
+        utils_db = None if args.parse_only else UtilsDB(get_vectordb())
+        rss_before = rss_bytes()
+        start()
+        before = _filter(tracemalloc.take_snapshot())
+        with track(args.path):
+            if args.parse_only:
+                chunks = sum(len(batch) for batch in batched(iter_chunks(args.path, document_metadata_from_path(args.path))))
+                print(f"{chunks} chunks")
+            else:
+                utils_db.add_db_doc(args.path)
+        stats = block_stats()[args.path]
+        print(f"peak {stats['max_peak_bytes'] / 1e6:.1f} MB traced, {stats['retained_bytes'] / 1e6:.1f} MB retained, "
+              f"RSS {rss_before / 1e6:.0f} -> {rss_bytes() / 1e6:.0f} MB in {stats['seconds']:.2f} seconds")
+        after = _filter(tracemalloc.take_snapshot())
+        _print_stats([format_stat(stat) for stat in after.compare_to(before, args.key_type)[:args.limit]])
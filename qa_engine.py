@@ -0,0 +1,540 @@
+"""
+Question answering engine shared by the chatbots: a turn goes through explicit stages, each timed, each swappable.
+
+    history    reads the conversation memory of the session
+    condense   rewrites a follow-up question into a standalone one
+    retrieve   searches the vector store for the standalone question
+    rerank     filters or reorders the retrieved chunks
+    pack       builds the context of the prompt from the chunks
+    generate   answers from the context, the history and the question
+    persist    stores the question and the answer in the memory
+
+The two presets reproduce the two chatbots: `chain_engine` (EmbeddingChainChatBot, condensing with an LLM call
+before searching) and `direct_engine` (EmbeddingChatBot, searching the question as asked and dropping chunks below a
+relevance threshold). When the condense stage does not read the history, the history is read while the question is
+searched, and with `persist_async` the turn is stored after the answer is returned; the history of the next turn
+waits for it, but the search of the next turn does not.
+
+Usage:
+    python qa_engine.py benchmark --configs chain direct chain_async direct_async --dry-run
+"""
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import get_buffer_string
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+
+STAGES = ("history", "condense", "retrieve", "rerank", "pack", "generate", "persist")
+
+CONDENSE_TEMPLATE = """
+            Given a chat history and the latest user question \
+            which might reference the chat history, formulate a standalone question \
+            which can be understood without the chat history. Do NOT answer the question, \
+            just reformulate it if needed and otherwise return it as is.
+            Return the standalone question in the same language as the input
+
+            Chat History:
+            {chat_history}
+            Follow Up Input: {question}
+            Standalone question:"""
+
+CHAIN_ANSWER_TEMPLATE = """
+                     \
+
+                    instructions:
+                    - You are a lawyer expert assistant that helps to solve, instruct and assist to a lawyer in different juridical cases . \
+                    - You give recommendations, build documents, and continuously ask how you can help.
+                    - provide complete informative answers, Focus on providing helpful and relevant information,
+                    - Always Answer the Question in the same language as the user question.
+                    - you return the helpful answer directly
+                    - if you are asked for a document, letter, email or similar, please return the document template with all the required information.
+
+                    use the context as reference that may help in the juridical case, however if you dont consider it useful information still try to help the person
+                    remember that the new user question can be related with the chat history.
+                    Context that may help to answer question:\n{context}
+
+                    Chat History:\n{chat_history}
+
+                    Answer the User question:\n{question}
+
+                    """
+
+DIRECT_SYSTEM_MESSAGE = "You are a lawyer expert assistant that helps to solve, instruct and assist to a lawyer in different juridical cases "
+
+DIRECT_ANSWER_TEMPLATE = """
+
+
+                    - You give recommendations, build documents, and continuously ask how you can help.
+                    - provide complete informative answers, Focus on providing helpful and relevant information,
+                    - Always Answer the Question in the same language as the user question.
+                    - you return the helpful answer directly
+                    - if you are asked for a document, letter, email or similar, please return the document template with all the required information.
+
+                    use the context as reference that may help in the juridical case, however if you dont consider it useful information still try to help the person
+                    remember that the new user question can be related with the chat history.
+
+                    Context to answer question:\n{context}
+
+                    Chat History:\n{chat_history}
+
+                    Answer the User question:\n{question}
+                    """
+
+SAMPLE_QUESTIONS = [
+    "Solicita asesoría sobre los derechos y obligaciones en casos de abandono de menores.",
+    "¿Cómo proceder legalmente ante un caso de abandono de bienes por parte de un cónyuge?",
+    "Necesito orientación sobre el proceso de divorcio y los pasos legales a seguir.",
+    "Genera una carta para solicitar la custodia de un menor ante el juzgado.",
+    "Ayúdame a redactar un documento de conciliación en un proceso de divorcio.",
+    "Quiero presentar una petición ante el juzgado de familia, ¿qué información necesito incluir?",
+    "¿Cuáles son los requisitos legales para establecer una pensión alimenticia?",
+    "Proporciona orientación sobre cómo responder a una solicitud de paternidad.",
+    "Necesito redactar una carta de notificación sobre el incumplimiento de visitas a menores.",
+    "¿Qué documentos son necesarios para iniciar un proceso de adopción?",
+    "¿Cómo solicitar una modificación de medidas en un proceso de divorcio?",
+    "Ayúdame a redactar una queja formal ante la entidad reguladora.",
+    "Genera un documento para solicitar la revisión de una sentencia judicial.",
+    "Solicita información sobre los derechos de visita en casos de custodia compartida.",
+    "¿Qué pasos debo seguir para realizar una separación de bienes?",
+    "Ayúdame a redactar una carta de reclamación por incumplimiento de contrato.",
+    "Necesito orientación sobre cómo presentar una demanda por violencia intrafamiliar.",
+    "¿Qué información debo incluir en una solicitud de medidas cautelares?",
+    "Genera un documento para solicitar la liquidación de bienes gananciales.",
+    "Solicita asistencia para redactar una carta de autorización para representación legal.",
+]
+
+# Threads reading histories and persisting turns in the background, shared by the engines of every session.
+_background = ThreadPoolExecutor(max_workers=8, thread_name_prefix="qa-engine")
+
+
+class Turn:
+    """
+    A question going through the stages.
+
+    Attributes:
+        question (str): The question as asked.
+        filters (dict): The metadata filters of the search.
+        history (list): The messages of the memory.
+        standalone_question (str): The question searched.
+        documents (list): The chunks and their relevance, None when the store does not return it.
+        context (str): The context of the prompt.
+        answer (str): The answer.
+        timings (dict): The seconds of each stage.
+    """
+
+    def __init__(self, question, filters=None):
+        self.question = question
+        self.filters = filters
+        self.history = []
+        self.standalone_question = question
+        self.documents = []
+        self.context = ""
+        self.answer = ""
+        self.timings = {}
+
+    @property
+    def source_documents(self):
+        return [document for document, _ in self.documents]
+
+
+# History stages.
+
+class MemoryHistory:
+    """
+    Reads the messages of a LangChain memory: buffer, window or RollingSummaryMemory.
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+
+    def __call__(self, turn):
+        turn.history = self.memory.load_memory_variables({"question": turn.question})[self.memory.memory_key]
+
+
+# Condense stages.
+
+def format_history(messages, ai_prefix="Assistant"):
+    """
+    Returns:
+        str: The messages as "Human: ..." and "<ai_prefix>: ..." lines, skipping empty ones.
+    """
+    return get_buffer_string([message for message in messages if message.content], ai_prefix=ai_prefix)
+
+
+class KeepQuestion:
+    """
+    Searches the question as asked.
+    """
+
+    needs_history = False
+
+    def __call__(self, turn):
+        turn.standalone_question = turn.question
+
+
+class LLMCondense:
+    """
+    Rewrites the question with the history into a standalone question, when there is a history.
+    """
+
+    needs_history = True
+
+    def __init__(self, llm, prompt=None):
+        self.llm = llm
+        self.prompt = prompt or PromptTemplate.from_template(CONDENSE_TEMPLATE)
+
+    def __call__(self, turn):
+        if not turn.history:
+            turn.standalone_question = turn.question
+            return
+        prompt = self.prompt.format_prompt(chat_history=format_history(turn.history), question=turn.question)
+        turn.standalone_question = self.llm.invoke(prompt.to_messages()).content
+
+
+# Retrieve stages.
+
+class RetrieverSearch:
+    """
+    Searches with a retriever, e.g. the CoalescingRetriever or TopicRoutedRetriever of the chatbots, whose filters
+    are set per question. The chunks come without relevance.
+    """
+
+    def __init__(self, retriever, k):
+        self.retriever = retriever
+        self.k = k
+
+    def __call__(self, turn):
+        from utils_Chromadb import build_metadata_filter
+
+        search_kwargs = {"k": self.k}
+        where = build_metadata_filter(turn.filters)
+        if where:
+            search_kwargs["filter"] = where
+        self.retriever.search_kwargs = search_kwargs
+        turn.documents = [(document, None) for document in self.retriever.invoke(turn.standalone_question)]
+
+
+class ScoredSearch:
+    """
+    Searches the vector store for the chunks and their relevance, from 0 to 1.
+    """
+
+    def __init__(self, vectordb, k):
+        self.vectordb = vectordb
+        self.k = k
+
+    def __call__(self, turn):
+        from utils_Chromadb import build_metadata_filter
+
+        turn.documents = self.vectordb.similarity_search_with_relevance_scores(
+            turn.standalone_question, k=self.k, filter=build_metadata_filter(turn.filters))
+
+
+# Rerank stages.
+
+class KeepOrder:
+    def __call__(self, turn):
+        pass
+
+
+class RelevanceThreshold:
+    """
+    Drops the chunks whose relevance is below the threshold, keeping those without relevance.
+    """
+
+    def __init__(self, threshold=0.6):
+        self.threshold = threshold
+
+    def __call__(self, turn):
+        turn.documents = [(document, score) for document, score in turn.documents if score is None or score >= self.threshold]
+
+
+# Pack stages.
+
+class StuffContext:
+    """
+    Joins the text of the chunks, stopping before `max_chars` characters.
+    """
+
+    def __init__(self, separator="\n\n", max_chars=None):
+        self.separator = separator
+        self.max_chars = max_chars
+
+    def __call__(self, turn):
+        parts = []
+        size = 0
+        for document, _ in turn.documents:
+            if self.max_chars is not None and size + len(document.page_content) > self.max_chars and parts:
+                break
+            parts.append(document.page_content)
+            size += len(document.page_content) + len(self.separator)
+        turn.context = self.separator.join(parts)
+
+
+# Generate stages.
+
+class Generate:
+    """
+    Answers with a chat model from a prompt with the context, the chat history and the question.
+    """
+
+    def __init__(self, llm, prompt, ai_prefix="Assistant", question="standalone"):
+        """
+        Args:
+            llm (BaseChatModel): The chat model.
+            prompt (BasePromptTemplate): The prompt, with the variables context, chat_history and question.
+            ai_prefix (str): The prefix of the answers in the chat history.
+            question (str): "standalone" to answer the standalone question, "asked" for the question as asked.
+        """
+        self.llm = llm
+        self.prompt = prompt
+        self.ai_prefix = ai_prefix
+        self.question = question
+
+    def __call__(self, turn):
+        question = turn.standalone_question if self.question == "standalone" else turn.question
+        prompt = self.prompt.format_prompt(context=turn.context, chat_history=format_history(turn.history, self.ai_prefix),
+                                           question=question)
+        turn.answer = self.llm.invoke(prompt.to_messages()).content
+
+
+# Persist stages.
+
+class MemoryPersist:
+    """
+    Stores the question and the answer in a LangChain memory.
+    """
+
+    def __init__(self, memory):
+        self.memory = memory
+
+    def __call__(self, turn):
+        self.memory.save_context({"question": turn.question}, {"answer": turn.answer})
+
+
+class QAEngine:
+    """
+    Runs the stages of a turn and times each of them.
+
+    Attributes:
+        stages (dict): The stage of each name of STAGES.
+        persist_async (bool): Whether turns are persisted in the background after the answer is returned.
+    """
+
+    def __init__(self, history, condense, retrieve, rerank, pack, generate, persist, persist_async=False):
+        self.stages = {"history": history, "condense": condense, "retrieve": retrieve, "rerank": rerank,
+                       "pack": pack, "generate": generate, "persist": persist}
+        self.persist_async = persist_async
+        self._persisting = None
+        self._lock = threading.Lock()
+
+    def replace(self, **stages):
+        """
+        Swaps stages, e.g. engine.replace(rerank=RelevanceThreshold(0.7)).
+        """
+        unknown = set(stages) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}, expected some of {STAGES}")
+        self.stages.update(stages)
+
+    def _run(self, name, turn):
+        start_time = time.perf_counter()
+        self.stages[name](turn)
+        turn.timings[name] = time.perf_counter() - start_time
+
+    def wait_persisted(self):
+        """
+        Waits until the last turn is persisted.
+        """
+        with self._lock:
+            persisting = self._persisting
+        if persisting is not None:
+            persisting.result()
+
+    def _read_history(self, turn):
+        start_time = time.perf_counter()
+        self.wait_persisted()
+        self._run("history", turn)
+        # The wait for the previous turn is part of the history stage.
+        turn.timings["history"] = time.perf_counter() - start_time
+
+    def _persist(self, turn):
+        try:
+            self._run("persist", turn)
+        except Exception as e:
+            # Not raised, the answer is already returned and the next turns must not fail for it.
+            print(f"Failed to persist the turn '{turn.question[:40]}': {e}")
+
+    def ask(self, question, filters=None):
+        """
+        Answers a question.
+
+        Args:
+            question (str): The question.
+            filters (dict, optional): Metadata filters (topic, court, chamber, year, doc_id) of the search.
+
+        Returns:
+            Turn: The turn, with its answer, chunks and the seconds of each stage. With `persist_async` its persist
+            time is only known once `wait_persisted` returns.
+        """
+        turn = Turn(question, filters)
+        start_time = time.perf_counter()
+        if getattr(self.stages["condense"], "needs_history", True):
+            self._read_history(turn)
+            history = None
+        else:
+            # The history, and the persisting of the previous turn it waits for, overlap the search.
+            history = _background.submit(self._read_history, turn)
+        for name in ("condense", "retrieve", "rerank", "pack"):
+            self._run(name, turn)
+        if history is not None:
+            history.result()
+        self._run("generate", turn)
+        if self.persist_async:
+            with self._lock:
+                self._persisting = _background.submit(self._persist, turn)
+        else:
+            self._run("persist", turn)
+        turn.timings["total"] = time.perf_counter() - start_time
+        return turn
+
+
+def chain_engine(memory, retriever, llm, k=6, persist_async=False, condense_llm=None, condense_prompt=None, answer_prompt=None):
+    """
+    Engine of EmbeddingChainChatBot: condenses the follow-up questions with an LLM call, searches with the retriever
+    and answers the standalone question with the chain prompt.
+
+    Args:
+        memory (BaseChatMemory): The memory of the session.
+        retriever (VectorStoreRetriever): The retriever.
+        llm (BaseChatModel): The chat model answering, and condensing unless `condense_llm` is given.
+        k (int): The chunks retrieved.
+        persist_async (bool): Whether turns are persisted after the answer is returned.
+        condense_llm (BaseChatModel, optional): The chat model condensing the questions.
+        condense_prompt (BasePromptTemplate, optional): The condense prompt. Defaults to CONDENSE_TEMPLATE.
+        answer_prompt (BasePromptTemplate, optional): The answer prompt. Defaults to CHAIN_ANSWER_TEMPLATE.
+    """
+    answer_prompt = answer_prompt or PromptTemplate.from_template(CHAIN_ANSWER_TEMPLATE)
+    return QAEngine(MemoryHistory(memory), LLMCondense(condense_llm or llm, condense_prompt), RetrieverSearch(retriever, k),
+                    KeepOrder(), StuffContext(), Generate(llm, answer_prompt), MemoryPersist(memory), persist_async)
+
+
+def direct_engine(memory, vectordb, llm, k=6, threshold=0.6, persist_async=False):
+    """
+    Engine of EmbeddingChatBot: searches the question as asked, drops the chunks below the relevance threshold and
+    answers with a system message and the direct prompt.
+
+    Args:
+        memory (BaseChatMemory): The memory of the session.
+        vectordb (VectorStore): The vector store.
+        llm (BaseChatModel): The chat model.
+        k (int): The chunks retrieved.
+        threshold (float): The minimum relevance of a chunk.
+        persist_async (bool): Whether turns are persisted after the answer is returned.
+    """
+    prompt = ChatPromptTemplate.from_messages([("system", DIRECT_SYSTEM_MESSAGE), ("human", DIRECT_ANSWER_TEMPLATE)])
+    return QAEngine(MemoryHistory(memory), KeepQuestion(), ScoredSearch(vectordb, k), RelevanceThreshold(threshold),
+                    StuffContext(), Generate(llm, prompt, ai_prefix="AI System", question="asked"),
+                    MemoryPersist(memory), persist_async)
+
+
+def benchmark(engine_factory, questions, repeat=1):
+    """
+    Asks the questions in turn to a new engine and collects the time of each stage.
+
+    Args:
+        engine_factory (callable): Returns a new engine, with an empty memory.
+        questions (list): The questions, asked as one conversation.
+        repeat (int): The conversations.
+
+    Returns:
+        dict: Per stage, and for the answer latency, the mean and p95 milliseconds.
+    """
+    timings = {name: [] for name in STAGES + ("total",)}
+    for _ in range(repeat):
+        engine = engine_factory()
+        turns = [engine.ask(question) for question in questions]
+        engine.wait_persisted()
+        for turn in turns:
+            for name, seconds in turn.timings.items():
+                timings[name].append(seconds * 1000)
+
+    def summary(values):
+        values = sorted(values)
+        return {"mean_ms": statistics.mean(values), "p95_ms": values[min(len(values) - 1, int(0.95 * len(values)))]} \
+            if values else None
+
+    return {name: summary(values) for name, values in timings.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    import openai
+    from dotenv import load_dotenv
+    from langchain.chains.conversation.memory import ConversationBufferWindowMemory
+
+    from single_flight import CoalescingChatOpenAI
+    from topic_router import build_retriever
+    from utils_Chromadb import get_vectordb
+
+    configurations = {
+        "chain": (chain_engine, False),
+        "chain_async": (chain_engine, True),
+        "direct": (direct_engine, False),
+        "direct_async": (direct_engine, True),
+    }
+    parser = argparse.ArgumentParser(description="Compare the stage timings of the engine configurations.")
+    parser.add_argument("command", choices=["benchmark"])
+    parser.add_argument("--configs", nargs="+", choices=sorted(configurations), default=sorted(configurations))
+    parser.add_argument("--questions", type=int, default=5, help="sample questions asked per conversation")
+    parser.add_argument("--repeat", type=int, default=1, help="conversations per configuration")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="answer with a canned chat model and keep the history in memory, only the search is real")
+    args = parser.parse_args()
+
+    load_dotenv()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    vectordb = get_vectordb(read_only=True)
+    questions = SAMPLE_QUESTIONS[:args.questions]
+    if args.dry_run:
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        llm = FakeListChatModel(responses=["Respuesta de prueba."])
+    else:
+        llm = CoalescingChatOpenAI(temperature=0.5, model_name="gpt-3.5-turbo-0125")
+    histories = []
+
+    def new_memory():
+        if args.dry_run:
+            from langchain_core.chat_history import InMemoryChatMessageHistory
+            history = InMemoryChatMessageHistory()
+        else:
+            from langchain_mongodb import MongoDBChatMessageHistory
+            history = MongoDBChatMessageHistory(
+                connection_string=os.getenv("CONNECTION_STRING"), session_id=f"benchmark-{os.getpid()}-{len(histories)}",
+                database_name=os.getenv("MONGODD_NAME"), collection_name=os.getenv("COLLECTION_NAME"))
+        histories.append(history)
+        return ConversationBufferWindowMemory(k=2, memory_key="chat_history", input_key="question", output_key="answer",
+                                              return_messages=True, chat_memory=history)
+
+    def engine_factory(factory, persist_async):
+        if factory is chain_engine:
+            return lambda: chain_engine(new_memory(), build_retriever(vectordb, {"k": 6}), llm, persist_async=persist_async)
+        return lambda: direct_engine(new_memory(), vectordb, llm, persist_async=persist_async)
+
+    results = {name: benchmark(engine_factory(*configurations[name]), questions, args.repeat) for name in args.configs}
+    # The benchmark conversations are not kept.
+    for history in histories:
+        history.clear()
+
+    print(f"{'stage':10}" + "".join(f"{name:>18}" for name in args.configs))
+    for stage in STAGES + ("total",):
+        cells = []
+        for name in args.configs:
+            summary = results[name][stage]
+            cells.append(f"{summary['mean_ms']:8.1f} /{summary['p95_ms']:7.1f}" if summary else "-")
+        print(f"{stage:10}" + "".join(f"{cell:>18}" for cell in cells))
+    print("mean / p95 ms per turn; total is the answer latency, an async persist runs after it")
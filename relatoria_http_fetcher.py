@@ -0,0 +1,591 @@
+"""
+Fetches rulings from the relatoria of the Corte Suprema de Justicia with plain HTTP requests, reproducing the
+JSF (PrimeFaces) form posts the browser sends: the search of `searchForm:temaInput`, the `resultForm` pagination
+and the PDF export of the current result. Each topic gets its own cookie jar and ViewState, while all topics share
+one pooled connection transport and are fetched concurrently.
+
+Responses can be recorded with `record_dir` and replayed by relatoria_replay_server.py to develop and test the
+fetcher without hitting the site.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+import httpx
+
+from crawl_scheduler import CrawlScheduler
+from crawl_state import DUPLICATE, FAILED, STORED, CrawlStateStore, result_id, result_position
+from document_catalog import DocumentCatalog, doc_id_from_filename, document_identifiers
+
+RELATORIA_URL = "http://consultajurisprudencial.ramajudicial.gov.co:8080/WebRelatoria/csj/index.xhtml"
+VIEW_STATE = "javax.faces.ViewState"
+# Component ids of the result page, the same ones DocumentDownloader clicks through Selenium.
+SEARCH_INPUT_ID = "searchForm:temaInput"
+SEARCH_BUTTON_TEXT = "Buscar"
+PAGE_TEXT_ID = "resultForm:pagText2"
+NEXT_BUTTON_ID = "resultForm:j_idt248"
+PDF_OPTION_ID = "resultForm:j_idt268"
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+
+class RelatoriaFetchError(Exception):
+    """
+    Raised when a response of the relatoria does not have the expected content.
+    """
+
+
+class JsfPageParser(HTMLParser):
+    """
+    Collects the forms, their submitted fields, the buttons and the text of the elements with an id of a JSF page.
+
+    Attributes:
+        forms (dict): Form id to {"action": str, "fields": dict of the name and value of each submitted field}.
+        buttons (list): Dicts with the id, name, form and text of each button.
+        texts (dict): Element id to its text content.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.forms = {}
+        self.buttons = []
+        self.texts = {}
+        self._form = None
+        self._button = None
+        self._open_ids = []
+        self._select = None
+        self._textarea = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "form":
+            self._form = attrs.get("id") or attrs.get("name")
+            self.forms[self._form] = {"action": attrs.get("action", ""), "fields": {}}
+        fields = self.forms[self._form]["fields"] if self._form in self.forms else None
+        if tag == "input" and fields is not None and attrs.get("name"):
+            input_type = attrs.get("type", "text").lower()
+            if input_type in ("checkbox", "radio") and "checked" not in attrs:
+                pass
+            elif input_type not in ("submit", "button", "image", "file", "reset"):
+                fields[attrs["name"]] = attrs.get("value", "")
+        elif tag == "select" and fields is not None and attrs.get("name"):
+            self._select = attrs["name"]
+            fields.setdefault(self._select, "")
+        elif tag == "option" and self._select and fields is not None and "selected" in attrs:
+            fields[self._select] = attrs.get("value", "")
+        elif tag == "textarea" and fields is not None and attrs.get("name"):
+            self._textarea = attrs["name"]
+            fields[self._textarea] = ""
+        elif tag == "button":
+            self._button = {"id": attrs.get("id"), "name": attrs.get("name"), "form": self._form, "text": ""}
+            self.buttons.append(self._button)
+        if tag not in VOID_TAGS:
+            self._open_ids.append((tag, attrs.get("id")))
+            if attrs.get("id"):
+                self.texts.setdefault(attrs["id"], "")
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+        elif tag == "select":
+            self._select = None
+        elif tag == "textarea":
+            self._textarea = None
+        elif tag == "button":
+            self._button = None
+        for index in range(len(self._open_ids) - 1, -1, -1):
+            if self._open_ids[index][0] == tag:
+                del self._open_ids[index:]
+                break
+
+    def handle_data(self, data):
+        if self._button is not None:
+            self._button["text"] += data
+        if self._textarea and self._form in self.forms:
+            self.forms[self._form]["fields"][self._textarea] += data
+        for _, element_id in self._open_ids:
+            if element_id:
+                self.texts[element_id] += data
+
+
+def parse_page(html):
+    parser = JsfPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+def parse_partial_response(xml_text):
+    """
+    Parses a JSF partial response.
+
+    Args:
+        xml_text (str): The body of the response.
+
+    Returns:
+        dict: The id of each updated component to its new markup.
+
+    Raises:
+        RelatoriaFetchError: If the response reports an error or is not a partial response.
+    """
+    try:
+        root = ET.fromstring(xml_text)
+    except ET.ParseError as error:
+        raise RelatoriaFetchError(f"Invalid partial response: {error}") from error
+    error = root.find(".//error")
+    if error is not None:
+        raise RelatoriaFetchError(f"JSF error: {ET.tostring(error, encoding='unicode')}")
+    if root.find(".//redirect") is not None:
+        raise RelatoriaFetchError("The session expired, the server redirected the request")
+    return {update.get("id"): update.text or "" for update in root.iter("update")}
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def result_description(page):
+    """
+    Returns the text describing the current ruling, read the same way from the HTTP responses and, through
+    `result_text_from_html`, from the browser, so both crawls give a result the same `result_id`.
+
+    Args:
+        page (JsfPageParser): The parsed page.
+
+    Returns:
+        str: The normalized text of the result form without the "Resultado: N de M" counter.
+    """
+    text = normalize_text(page.texts.get("resultForm", ""))
+    counter = normalize_text(page.texts.get(PAGE_TEXT_ID, ""))
+    return normalize_text(text.replace(counter, " ")) if counter else text
+
+
+def result_text_from_html(html):
+    """
+    Args:
+        html (str): The markup of the result form, e.g. its outerHTML in the browser.
+
+    Returns:
+        str: The text describing the current ruling, see `result_description`.
+    """
+    return result_description(parse_page(html))
+
+
+def filename_from_response(response, fallback):
+    disposition = response.headers.get("content-disposition", "")
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)|filename=\"?([^\";]+)\"?", disposition, re.IGNORECASE)
+    if match:
+        filename = os.path.basename((match.group(1) or match.group(2)).strip())
+        if filename:
+            return filename if filename.lower().endswith(".pdf") else f"{filename}.pdf"
+    return f"{fallback}.pdf"
+
+
+class RelatoriaSession:
+    """
+    One browsing session of the relatoria: its cookies, ViewState and the markup of the current result page.
+
+    Attributes:
+        client (httpx.AsyncClient): The client holding the cookies of the session.
+        url (str): The url of the search page.
+        view_state (str): The current JSF ViewState.
+        page (JsfPageParser): The parsed markup of the current page.
+        scheduler (CrawlScheduler): Paces and retries the requests, None to send them directly.
+        topic (str): The topic the requests are counted for.
+    """
+
+    def __init__(self, client, url, recorder=None, scheduler=None, topic=None):
+        self.client = client
+        self.url = url
+        self.recorder = recorder
+        self.scheduler = scheduler
+        self.topic = topic
+        self.view_state = None
+        self.page = None
+        self.form_actions = {}
+
+    async def _request(self, method, url, label, retries=None, **kwargs):
+        async def send():
+            response = await self.client.request(method, url, **kwargs)
+            if self.recorder:
+                self.recorder.record(method, url, label, response, self.topic)
+            response.raise_for_status()
+            return response
+
+        if self.scheduler is None:
+            return await send()
+        return await self.scheduler.request(self.topic, send, retries)
+
+    def _update_page(self, html):
+        page = parse_page(html)
+        if self.page is None:
+            self.page = page
+        else:
+            self.page.forms.update(page.forms)
+            self.page.buttons = page.buttons + [button for button in self.page.buttons if button["form"] not in page.forms]
+            self.page.texts.update(page.texts)
+        for form_id, form in page.forms.items():
+            self.form_actions[form_id] = urljoin(self.url, form["action"] or self.url)
+            if VIEW_STATE in form["fields"]:
+                self.view_state = form["fields"][VIEW_STATE]
+
+    async def open(self):
+        """
+        Loads the search page, which sets the session cookie and the first ViewState.
+        """
+        response = await self._request("GET", self.url, "open")
+        self._update_page(response.text)
+        if not self.view_state:
+            raise RelatoriaFetchError("The search page has no ViewState")
+
+    def _form_fields(self, form_id):
+        if form_id not in self.page.forms:
+            raise RelatoriaFetchError(f"The page has no form '{form_id}'")
+        fields = dict(self.page.forms[form_id]["fields"])
+        fields[form_id] = form_id
+        fields[VIEW_STATE] = self.view_state
+        return fields
+
+    async def ajax_submit(self, form_id, source_id, extra_fields=None, render="@all", retries=None):
+        """
+        Sends a PrimeFaces AJAX post of a form as if `source_id` had been clicked and applies the partial response.
+
+        Args:
+            form_id (str): The id of the submitted form.
+            source_id (str): The id of the clicked component.
+            extra_fields (dict, optional): Fields overriding the current values of the form.
+            render (str): The components to render.
+            retries (int, optional): The retries of the post, see `CrawlScheduler.request`.
+        """
+        data = self._form_fields(form_id)
+        data.update(extra_fields or {})
+        data.update({
+            "javax.faces.partial.ajax": "true",
+            "javax.faces.source": source_id,
+            "javax.faces.partial.execute": "@all",
+            "javax.faces.partial.render": render,
+            source_id: source_id,
+        })
+        headers = {"Faces-Request": "partial/ajax", "X-Requested-With": "XMLHttpRequest"}
+        response = await self._request("POST", self.form_actions[form_id], source_id, retries, data=data, headers=headers)
+        for component_id, markup in parse_partial_response(response.text).items():
+            if VIEW_STATE in component_id:
+                self.view_state = markup.strip()
+            else:
+                self._update_page(markup)
+
+    async def search(self, topic):
+        """
+        Searches a topic, leaving the session on its first result.
+
+        Args:
+            topic (str): The topic to search for.
+        """
+        button = next((button for button in self.page.buttons
+                       if button["form"] == "searchForm" and normalize_text(button["text"]) == SEARCH_BUTTON_TEXT), None)
+        if button is None:
+            raise RelatoriaFetchError(f"The search page has no '{SEARCH_BUTTON_TEXT}' button")
+        await self.ajax_submit("searchForm", button["id"] or button["name"], {SEARCH_INPUT_ID: topic})
+
+    async def next_page(self):
+        """
+        Moves the session to the next result. The post is not retried: the server may have moved the session before
+        the answer timed out, and posting again would skip a result. A failed paging fails the topic, whose next
+        run resumes from the crawl state.
+        """
+        await self.ajax_submit("resultForm", NEXT_BUTTON_ID, render="resultForm", retries=0)
+
+    def current_page(self):
+        """
+        Returns:
+            int: The number of the current result, or None if it cannot be read.
+        """
+        position = result_position(normalize_text(self.page.texts.get(PAGE_TEXT_ID, "")))
+        return position[0] if position else None
+
+    def is_last_page(self):
+        """
+        Returns:
+            bool: Whether the current result is the last one of the search.
+        """
+        position = result_position(normalize_text(self.page.texts.get(PAGE_TEXT_ID, "")))
+        return position is not None and position[0] >= position[1]
+
+    def result_text(self):
+        """
+        Returns:
+            str: The text describing the current ruling, see `result_description`.
+        """
+        return result_description(self.page)
+
+    def result_hash(self):
+        return result_id(self.result_text())
+
+    async def download_pdf(self):
+        """
+        Exports the current result as PDF, the non-AJAX post of the PDF option of the download menu.
+
+        Returns:
+            tuple: The filename and bytes of the PDF.
+        """
+        data = self._form_fields("resultForm")
+        data[PDF_OPTION_ID] = PDF_OPTION_ID
+        response = await self._request("POST", self.form_actions["resultForm"], PDF_OPTION_ID, data=data)
+        if not response.content.startswith(b"%PDF"):
+            raise RelatoriaFetchError(f"Expected a PDF, got '{response.headers.get('content-type')}'")
+        return filename_from_response(response, self.result_hash()), response.content
+
+
+class ResponseRecorder:
+    """
+    Saves every response of the fetcher so relatoria_replay_server.py can replay them.
+
+    Attributes:
+        record_dir (str): The directory of the recorded exchanges.
+    """
+
+    def __init__(self, record_dir):
+        self.record_dir = record_dir
+        self.counter = 0
+        os.makedirs(record_dir, exist_ok=True)
+
+    def record(self, method, url, label, response, topic=None):
+        self.counter += 1
+        body_file = f"{self.counter:05d}.bin"
+        with open(os.path.join(self.record_dir, body_file), "wb") as body:
+            body.write(response.content)
+        exchange = {
+            "method": method,
+            "path": urlparse(str(url)).path,
+            "source": label,
+            "topic": topic,
+            "status": response.status_code,
+            "headers": {name: response.headers[name] for name in ("content-type", "content-disposition") if name in response.headers},
+            "body_file": body_file,
+        }
+        with open(os.path.join(self.record_dir, "exchanges.jsonl"), "a", encoding="utf-8") as exchanges:
+            exchanges.write(json.dumps(exchange) + "\n")
+
+
+class RelatoriaHttpFetcher:
+    """
+    Downloads the rulings of several topics concurrently over HTTP.
+
+    Attributes:
+        url (str): The url of the search page of the relatoria.
+        max_concurrent_topics (int): The number of topics fetched at the same time.
+        timeout (float): The timeout of each request in seconds.
+        max_stale_pages (int): The consecutive unchanged page numbers after which a topic is considered exhausted.
+        crawl_state (CrawlStateStore): The cursor and seen results of each topic, None to fetch every result.
+        incremental (bool): Whether to stop a topic at the results fetched by earlier runs.
+        stop_after_seen (int): The consecutive seen results after which an incremental crawl stops.
+        catalog (DocumentCatalog): The rulings already ingested under any topic, None to download every result.
+        scheduler (CrawlScheduler): Adapts the concurrent requests and delay to the site and retries transient failures.
+    """
+
+    def __init__(self, url=RELATORIA_URL, max_concurrent_topics=4, timeout=30, transport=None, record_dir=None,
+                 max_stale_pages=3, crawl_state=None, incremental=False, stop_after_seen=3, catalog=None,
+                 scheduler=None):
+        """
+        Args:
+            url (str): The url of the search page, e.g. the replay server for tests.
+            max_concurrent_topics (int): The number of topics fetched at the same time.
+            timeout (float): The timeout of each request in seconds.
+            transport (httpx.AsyncBaseTransport, optional): The transport shared by the sessions, e.g. httpx.MockTransport.
+            record_dir (str, optional): The directory where the responses are recorded.
+            max_stale_pages (int): The consecutive unchanged page numbers after which a topic is considered exhausted.
+            crawl_state (CrawlStateStore, optional): The cursor and seen results of each topic. Seen results are
+                skipped without downloading them.
+            incremental (bool): Whether to only fetch the results newer than earlier runs, the relatoria lists the
+                most recent rulings first.
+            stop_after_seen (int): The consecutive seen results after which an incremental crawl stops.
+            catalog (DocumentCatalog, optional): The rulings already ingested under any topic. Results whose
+                providencia number (else radicado, else hash) is in the catalog are not downloaded.
+            scheduler (CrawlScheduler, optional): The pacing of the requests. Defaults to up to `max_concurrent_topics`
+                concurrent requests.
+        """
+        self.url = url
+        self.max_concurrent_topics = max_concurrent_topics
+        self.timeout = timeout
+        self.transport = transport
+        self.recorder = ResponseRecorder(record_dir) if record_dir else None
+        self.max_stale_pages = max_stale_pages
+        self.crawl_state = crawl_state
+        self.incremental = incremental
+        self.stop_after_seen = stop_after_seen
+        self.catalog = catalog
+        self.scheduler = scheduler or CrawlScheduler(max_concurrency=max_concurrent_topics)
+
+    def _client(self, transport):
+        return httpx.AsyncClient(transport=transport, timeout=self.timeout, follow_redirects=True,
+                                 headers={"User-Agent": USER_AGENT})
+
+    async def fetch_topic(self, transport, topic, num_documents, store_document):
+        """
+        Searches a topic and exports its results as PDF until `num_documents` new documents are stored.
+
+        Args:
+            transport (httpx.AsyncBaseTransport): The pooled transport.
+            topic (str): The topic to search for.
+            num_documents (int): The number of new documents to store.
+            store_document (callable): Coroutine function (topic, filename, content) returning True if the document was new.
+
+        Returns:
+            int: The number of new documents stored.
+        """
+        stored = 0
+        if num_documents <= 0:
+            return stored
+        state = self.crawl_state
+        if state:
+            resume_page = state.start_run(topic)
+            if resume_page and not self.incremental:
+                print(f"Resuming topic '{topic}', results up to page {resume_page} were seen by earlier runs")
+        exhausted = False
+        async with self._client(transport) as client:
+            session = RelatoriaSession(client, self.url, self.recorder, self.scheduler, topic)
+            await session.open()
+            await session.search(topic)
+            current_page = None
+            stale_pages = 0
+            seen_streak = 0
+            while stored < num_documents:
+                page = session.current_page()
+                if page is None:
+                    raise RelatoriaFetchError(f"No results page for topic '{topic}'")
+                if page == current_page:
+                    stale_pages += 1
+                    if stale_pages >= self.max_stale_pages:
+                        print(f"Stopped fetching topic '{topic}', the page did not change after {page}")
+                        exhausted = True
+                        break
+                else:
+                    stale_pages = 0
+                    current_page = page
+                    current_id = session.result_hash()
+                    if state and state.is_seen(topic, current_id):
+                        # Paging is a small AJAX post, only the PDF export of unseen results is worth its cost.
+                        seen_streak += 1
+                        if self.incremental and seen_streak >= self.stop_after_seen:
+                            print(f"Stopped fetching topic '{topic}' at page {page}, reached the results of earlier runs")
+                            break
+                    else:
+                        seen_streak = 0
+                        identifiers = document_identifiers(session.result_text())
+                        known_doc_id = self.catalog.lookup(identifiers) if self.catalog is not None else None
+                        if known_doc_id:
+                            # Ingested under another topic, or by an earlier crawl before the crawl state existed.
+                            print(f"Skipping '{known_doc_id}' for topic '{topic}', it is already ingested")
+                            self.catalog.add_topic(known_doc_id, topic)
+                            if state:
+                                state.mark_result(topic, current_id, page, DUPLICATE)
+                        else:
+                            try:
+                                filename, content = await session.download_pdf()
+                            except (httpx.HTTPError, RelatoriaFetchError) as error:
+                                if state:
+                                    state.mark_result(topic, current_id, page, FAILED, error=repr(error))
+                                raise
+                            is_new = await store_document(topic, filename, content)
+                            if self.catalog is not None:
+                                self.catalog.register(doc_id_from_filename(filename), topic, identifiers)
+                            if state:
+                                state.mark_result(topic, current_id, page, STORED if is_new else DUPLICATE, filename)
+                            if is_new:
+                                stored += 1
+                    if state:
+                        state.save_page(topic, page)
+                if stored < num_documents:
+                    if session.is_last_page():
+                        print(f"Stopped fetching topic '{topic}', page {page} is its last result")
+                        exhausted = True
+                        break
+                    await session.next_page()
+        if state:
+            state.finish_run(topic, exhausted)
+        return stored
+
+    async def fetch_topics(self, topics, store_document):
+        """
+        Fetches several topics concurrently.
+
+        Args:
+            topics (dict): Topic to the number of new documents to store.
+            store_document (callable): Coroutine function (topic, filename, content) returning True if the document was new.
+
+        Returns:
+            dict: Topic to the number of documents stored, or to the exception that stopped it.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrent_topics)
+        transport = self.transport or httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=self.max_concurrent_topics * 2, max_keepalive_connections=self.max_concurrent_topics),
+            retries=2,
+        )
+
+        async def fetch(topic, num_documents):
+            async with semaphore:
+                start_time = time.time()
+                try:
+                    stored = await self.fetch_topic(transport, topic, num_documents, store_document)
+                except RelatoriaFetchError as error:
+                    self.scheduler.record_error(topic, error)
+                    raise
+                elapsed = time.time() - start_time
+                print(f"Fetched {stored} documents for topic '{topic}' in {elapsed:.1f} seconds "
+                      f"({stored / elapsed * 60 if elapsed else 0:.1f} documents per minute)")
+                return stored
+
+        try:
+            results = await asyncio.gather(*(fetch(topic, num) for topic, num in topics.items()), return_exceptions=True)
+        finally:
+            if self.transport is None:
+                await transport.aclose()
+        return dict(zip(topics, results))
+
+    def run(self, topics, store_document):
+        """
+        Synchronous entry point of `fetch_topics`.
+        """
+        return asyncio.run(self.fetch_topics(topics, store_document))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fetch rulings of the relatoria over HTTP without storing them in the vector database.")
+    parser.add_argument("topics", nargs="+", help="topics to search for")
+    parser.add_argument("--num", type=int, default=5, help="documents per topic")
+    parser.add_argument("--out", default="downloads_http", help="directory where the PDFs are written")
+    parser.add_argument("--url", default=RELATORIA_URL, help="search page, e.g. the replay server")
+    parser.add_argument("--record", help="directory where the responses are recorded for the replay server")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--state", help="crawl state file, to skip the results fetched by earlier runs")
+    parser.add_argument("--incremental", action="store_true", help="stop each topic at the results of earlier runs")
+    parser.add_argument("--catalog", help="catalog file, to skip the rulings already fetched under any topic")
+    args = parser.parse_args()
+
+    async def save(topic, filename, content):
+        topic_dir = os.path.join(args.out, topic.replace(" ", "_").lower())
+        os.makedirs(topic_dir, exist_ok=True)
+        path = os.path.join(topic_dir, filename)
+        if os.path.exists(path):
+            return False
+        with open(path, "wb") as pdf:
+            pdf.write(content)
+        return True
+
+    crawl_state = CrawlStateStore(args.state) if args.state else None
+    fetcher = RelatoriaHttpFetcher(args.url, max_concurrent_topics=args.concurrency, record_dir=args.record,
+                                   crawl_state=crawl_state, incremental=args.incremental,
+                                   catalog=DocumentCatalog(args.catalog) if args.catalog else None)
+    start = time.time()
+    results = fetcher.run({topic: args.num for topic in args.topics}, save)
+    fetched = sum(result for result in results.values() if isinstance(result, int))
+    print(results)
+    fetcher.scheduler.report()
+    print(f"{fetched} documents in {time.time() - start:.1f} seconds")
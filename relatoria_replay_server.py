@@ -0,0 +1,138 @@
+"""
+Local server replaying the responses recorded by RelatoriaHttpFetcher (`record_dir`), to develop and test the HTTP
+fetcher without the relatoria site. Requests are matched by topic, method, path and the JSF component that triggered
+them (`javax.faces.source`, or the PDF option for exports). The server gives each client session a cookie and learns
+its topic from its search, so topics recorded concurrently are replayed concurrently, each session getting the
+responses of its own topic in recording order; the last one is repeated once they run out.
+
+Usage:
+    python relatoria_replay_server.py recordings/divorcio --port 8099
+    python relatoria_http_fetcher.py Divorcio --url http://127.0.0.1:8099/WebRelatoria/csj/index.xhtml
+"""
+import argparse
+import json
+import os
+import threading
+import uuid
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from relatoria_http_fetcher import PDF_OPTION_ID, SEARCH_INPUT_ID
+
+SESSION_COOKIE = "replay_session"
+
+
+def load_exchanges(record_dir):
+    """
+    Returns:
+        dict: (topic, method, path, source) to the list of recorded exchanges, in recording order. Recordings made
+            before the topic was recorded have the topic None.
+    """
+    exchanges = defaultdict(list)
+    with open(os.path.join(record_dir, "exchanges.jsonl"), encoding="utf-8") as exchanges_file:
+        for line in exchanges_file:
+            exchange = json.loads(line)
+            exchanges[(exchange.get("topic"), exchange["method"], exchange["path"], exchange["source"])].append(exchange)
+    return exchanges
+
+
+def request_source(method, body):
+    if method == "GET":
+        return "open"
+    fields = parse_qs(body)
+    if "javax.faces.source" in fields:
+        return fields["javax.faces.source"][0]
+    if PDF_OPTION_ID in fields:
+        return PDF_OPTION_ID
+    return None
+
+
+def find_key(exchanges, topic, request_key):
+    """
+    Returns:
+        tuple: The recorded key of a request of `topic`, falling back to the recordings without topic, and for a
+            session whose topic is not known yet (the search page) to the first topic recorded. None if not recorded.
+    """
+    for key in ((topic, *request_key), (None, *request_key)):
+        if key in exchanges:
+            return key
+    if topic is None:
+        return next((key for key in exchanges if key[1:] == request_key), None)
+    return None
+
+
+def make_handler(record_dir):
+    exchanges = load_exchanges(record_dir)
+    session_topics = {}
+    served = defaultdict(int)
+    lock = threading.Lock()
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def _session_id(self):
+            cookie = SimpleCookie(self.headers.get("Cookie", ""))
+            return cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+
+        def _replay(self, method):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode("utf-8") if length else ""
+            session_id = self._session_id()
+            new_session = session_id is None
+            if new_session:
+                session_id = uuid.uuid4().hex
+            request_key = (method, urlparse(self.path).path, request_source(method, body))
+            with lock:
+                searched = parse_qs(body).get(SEARCH_INPUT_ID) if method == "POST" else None
+                if searched:
+                    session_topics[session_id] = searched[0]
+                key = find_key(exchanges, session_topics.get(session_id), request_key)
+                if key is None:
+                    self.send_error(404, f"No recorded response for {request_key} of topic {session_topics.get(session_id)!r}")
+                    return
+                recorded = exchanges[key]
+                # Each session replays its topic from the first recorded response.
+                exchange = recorded[min(served[session_id, key], len(recorded) - 1)]
+                served[session_id, key] += 1
+            with open(os.path.join(record_dir, exchange["body_file"]), "rb") as body_file:
+                content = body_file.read()
+            self.send_response(exchange["status"])
+            for name, value in exchange["headers"].items():
+                self.send_header(name, value)
+            if new_session:
+                self.send_header("Set-Cookie", f"{SESSION_COOKIE}={session_id}; Path=/")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self._replay("GET")
+
+        def do_POST(self):
+            self._replay("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    return ReplayHandler
+
+
+def serve(record_dir, host="127.0.0.1", port=8099):
+    """
+    Creates the replay server, call `serve_forever()` (or run it in a thread) to start it.
+
+    Returns:
+        ThreadingHTTPServer: The server.
+    """
+    return ThreadingHTTPServer((host, port), make_handler(record_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded relatoria responses.")
+    parser.add_argument("record_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    args = parser.parse_args()
+    server = serve(args.record_dir, args.host, args.port)
+    print(f"Replaying {args.record_dir} on http://{args.host}:{args.port}")
+    server.serve_forever()
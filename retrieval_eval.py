@@ -0,0 +1,341 @@
+"""
+Evaluation of the retrieval against a golden set: the sample questions of the chatbots and the rulings a good search
+returns for them (`retrieval_golden_set.json`).
+
+Every configuration of the grid (k, relevance threshold, re-ranking, topic routing and, for the local store, ANN
+ef_search, exact search and int8 re-scoring) is run over the reviewed questions and measured by recall@k (the share of
+expected rulings among the retrieved chunks), MRR (the inverse rank of the first chunk of an expected ruling) and the
+search latency. The question embeddings are read from the embedding cache, so after the first run nothing is sent to
+the API and every run searches the same vectors. The configurations are printed by latency, the Pareto optimal ones
+(no other configuration is faster with at least their recall@k and MRR) marked, with the fastest one keeping
+`--quality` of the best recall@k.
+
+Usage:
+    python retrieval_eval.py propose
+    python retrieval_eval.py run --k 4 6 10 --threshold 0 0.6 --rerank none dedupe --topics 0 2 --ef-search 32 64 128
+"""
+import itertools
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+
+from embedding_cache import EmbeddingCache, model_name
+from local_vector_store import LocalVectorStore
+from topic_router import load_router, routed_filter
+from utils_Chromadb import build_metadata_filter
+
+DEFAULT_GOLDEN_SET_PATH = "retrieval_golden_set.json"
+# Chunks read per question when proposing the expected rulings, and the rulings proposed.
+PROPOSE_CHUNKS = 30
+PROPOSE_RULINGS = 3
+# Candidates fetched per result by the "dedupe" re-ranking, which keeps the best chunk of each ruling.
+DEDUPE_FETCH_FACTOR = 3
+
+
+def load_golden_set(path=DEFAULT_GOLDEN_SET_PATH):
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_golden_set(golden_set, path=DEFAULT_GOLDEN_SET_PATH):
+    with open(f"{path}.part", "w", encoding="utf-8") as file:
+        json.dump(golden_set, file, ensure_ascii=False, indent=2)
+        file.write("\n")
+    os.replace(f"{path}.part", path)
+
+
+def ruling_id(metadata):
+    """
+    Returns:
+        str: The doc_id of a chunk, the file name of its source for chunks stored before the metadata backfill.
+    """
+    metadata = metadata or {}
+    if metadata.get("doc_id"):
+        return metadata["doc_id"]
+    return os.path.splitext(os.path.basename(metadata.get("source", "")))[0]
+
+
+def embed_questions(questions, vectordb, cache):
+    """
+    Embeds the questions, reading the ones embedded before from the cache and storing the others.
+
+    Returns:
+        np.ndarray: The embedding of each question.
+    """
+    model = model_name(vectordb.embeddings)
+    embeddings = cache.get_many(model, questions)
+    missing = [question for question, embedding in zip(questions, embeddings) if embedding is None]
+    if missing:
+        from embedding_executor import EmbeddingExecutor
+        EmbeddingExecutor(vectordb.embeddings, cache=cache).embed_documents(missing)
+        embeddings = cache.get_many(model, questions)
+        print(f"Embedded {len(missing)} questions, the next runs read them from '{cache.path}'")
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def search(vectordb, embedding, k, where=None):
+    """
+    Returns:
+        list: The k most similar chunks of a Chroma store or a LocalVectorStore and their relevance, from 0 to 1.
+    """
+    if isinstance(vectordb, LocalVectorStore):
+        return vectordb.similarity_search_by_vector_with_score(embedding, k, where)
+    relevance = vectordb._select_relevance_score_fn()
+    # The Chroma method returns distances despite its name.
+    results = vectordb.similarity_search_by_vector_with_relevance_scores(embedding.tolist(), k=k, filter=where)
+    return [(document, relevance(distance)) for document, distance in results]
+
+
+class Retrieval:
+    """
+    One retrieval configuration, applied to a vector store while it searches.
+
+    Attributes:
+        k (int): The chunks retrieved.
+        threshold (float): The relevance below which chunks are dropped, as in EmbeddingChatBot.
+        rerank (str): "none", or "dedupe" to fetch more candidates and keep the best chunk of each ruling.
+        topics (int): The closest topics the search is restricted to, 0 to search every topic.
+        ef_search (int): The ANN candidate list of a LocalVectorStore with an ANN index, None to keep the built one.
+        exact (bool): Whether a LocalVectorStore scans every chunk at full precision, without its ANN index or int8 codes.
+        rescore_factor (int): The int8 candidates re-scored per result by a quantized LocalVectorStore, None to keep it.
+    """
+
+    def __init__(self, k=6, threshold=0.0, rerank="none", topics=0, ef_search=None, exact=False, rescore_factor=None):
+        self.k = k
+        self.threshold = threshold
+        self.rerank = rerank
+        self.topics = topics
+        self.ef_search = ef_search
+        self.exact = exact
+        self.rescore_factor = rescore_factor
+
+    def describe(self):
+        """
+        Returns:
+            dict: The settings of the configuration that differ from the defaults, and k.
+        """
+        default = Retrieval()
+        return {name: value for name, value in vars(self).items() if name == "k" or value != getattr(default, name)}
+
+    def apply(self, vectordb):
+        """
+        Sets the index parameters of a LocalVectorStore.
+
+        Returns:
+            callable: Restores the previous parameters.
+        """
+        if not isinstance(vectordb, LocalVectorStore):
+            return lambda: None
+        exact, rescore_factor = vectordb.exact, vectordb.rescore_factor
+        ann_ef = vectordb._ann.ef if vectordb._ann is not None else None
+        vectordb.exact = self.exact
+        if self.rescore_factor is not None:
+            vectordb.rescore_factor = self.rescore_factor
+        if self.ef_search is not None and vectordb._ann is not None:
+            vectordb._ann.set_ef(self.ef_search)
+
+        def restore():
+            vectordb.exact, vectordb.rescore_factor = exact, rescore_factor
+            if ann_ef is not None and vectordb._ann is not None:
+                vectordb._ann.set_ef(ann_ef)
+
+        return restore
+
+    def retrieve(self, vectordb, embedding, where=None, router=None):
+        """
+        Returns:
+            list: The retrieved chunks and their relevance, most relevant first.
+        """
+        fetch_k = self.k * DEDUPE_FETCH_FACTOR if self.rerank == "dedupe" else self.k
+        results = None
+        if self.topics and router is not None:
+            routed = routed_filter(router, embedding, where, self.topics)
+            if routed:
+                results = search(vectordb, embedding, fetch_k, routed)
+                if len(results) < fetch_k:
+                    results = None
+        if results is None:
+            results = search(vectordb, embedding, fetch_k, where)
+        if self.rerank == "dedupe":
+            best = {}
+            for document, relevance in results:
+                best.setdefault(ruling_id(document.metadata), (document, relevance))
+            results = list(best.values())
+        return [(document, score) for document, score in results[:self.k] if score >= self.threshold]
+
+
+def score(results, expected):
+    """
+    Returns:
+        tuple: The recall@k and the reciprocal rank of the first expected ruling among the retrieved chunks.
+    """
+    retrieved = [ruling_id(document.metadata) for document, _ in results]
+    recall = len(set(retrieved) & set(expected)) / len(expected)
+    rank = next((position for position, doc_id in enumerate(retrieved, 1) if doc_id in expected), None)
+    return recall, 1 / rank if rank else 0.0
+
+
+def evaluate(vectordb, items, embeddings, configurations, router=None, repeat=3):
+    """
+    Runs every configuration over the golden questions.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        items (list): The reviewed questions of the golden set.
+        embeddings (np.ndarray): The embedding of each question.
+        configurations (list): The Retrieval configurations.
+        router (TopicRouter, optional): The router of the configurations with topic routing.
+        repeat (int): The searches timed per question, their median is its latency.
+
+    Returns:
+        list: Per configuration, its settings, mean recall@k, MRR, and mean and p95 latency in milliseconds.
+    """
+    rows = []
+    wheres = [build_metadata_filter(item.get("filters")) for item in items]
+    for configuration in configurations:
+        restore = configuration.apply(vectordb)
+        try:
+            # One unmeasured pass loads the pages and caches the configuration needs.
+            for embedding, where in zip(embeddings, wheres):
+                configuration.retrieve(vectordb, embedding, where, router)
+            recalls, reciprocal_ranks, latencies = [], [], []
+            for item, embedding, where in zip(items, embeddings, wheres):
+                timings = []
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    results = configuration.retrieve(vectordb, embedding, where, router)
+                    timings.append(time.perf_counter() - start_time)
+                recall, reciprocal_rank = score(results, item["expected_doc_ids"])
+                recalls.append(recall)
+                reciprocal_ranks.append(reciprocal_rank)
+                latencies.append(statistics.median(timings) * 1000)
+        finally:
+            restore()
+        latencies.sort()
+        rows.append({"configuration": configuration.describe(), "recall": statistics.mean(recalls),
+                     "mrr": statistics.mean(reciprocal_ranks), "latency_ms": statistics.mean(latencies),
+                     "p95_ms": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]})
+    return rows
+
+
+def mark_pareto(rows):
+    """
+    Marks the rows no other row beats on latency, recall and MRR at once.
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other["latency_ms"] <= row["latency_ms"] and other["recall"] >= row["recall"] and other["mrr"] >= row["mrr"]
+            and (other["latency_ms"], other["recall"], other["mrr"]) != (row["latency_ms"], row["recall"], row["mrr"])
+            for other in rows)
+    return rows
+
+
+def recommend(rows, quality=0.98):
+    """
+    Returns:
+        dict: The fastest row whose recall@k is at least `quality` of the best one.
+    """
+    best_recall = max(row["recall"] for row in rows)
+    return min((row for row in rows if row["recall"] >= quality * best_recall), key=lambda row: row["latency_ms"])
+
+
+def print_table(rows, recommended):
+    print(f"{'':2}{'recall@k':>9}{'MRR':>7}{'mean ms':>9}{'p95 ms':>8}  configuration")
+    for row in sorted(rows, key=lambda row: row["latency_ms"]):
+        marker = ">" if row is recommended else ("*" if row["pareto"] else "")
+        settings = ", ".join(f"{name}={value}" for name, value in row["configuration"].items())
+        print(f"{marker:2}{row['recall']:9.3f}{row['mrr']:7.3f}{row['latency_ms']:9.2f}{row['p95_ms']:8.2f}  {settings}")
+    print("* Pareto optimal, > fastest configuration keeping the quality")
+
+
+def propose(vectordb, golden_set, embeddings, chunks=PROPOSE_CHUNKS, rulings=PROPOSE_RULINGS):
+    """
+    Fills the expected rulings of the unreviewed questions with the rulings of their most similar chunks, found by an
+    exact search, for a lawyer to review and correct.
+
+    Returns:
+        int: The questions proposed.
+    """
+    exact = Retrieval(k=chunks, rerank="dedupe", exact=True)
+    restore = exact.apply(vectordb)
+    proposed = 0
+    try:
+        for item, embedding in zip(golden_set["questions"], embeddings):
+            if item.get("reviewed"):
+                continue
+            results = exact.retrieve(vectordb, embedding, build_metadata_filter(item.get("filters")))
+            item["expected_doc_ids"] = [ruling_id(document.metadata) for document, _ in results[:rulings]]
+            proposed += 1
+            print(f"{item['question']}\n    {', '.join(item['expected_doc_ids']) or 'no rulings found'}")
+    finally:
+        restore()
+    return proposed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import openai
+    from dotenv import load_dotenv
+
+    from utils_Chromadb import get_vectordb
+
+    parser = argparse.ArgumentParser(description="Evaluate retrieval configurations against the golden set.")
+    parser.add_argument("command", choices=["propose", "run"])
+    parser.add_argument("--golden-set", default=DEFAULT_GOLDEN_SET_PATH)
+    parser.add_argument("--k", type=int, nargs="+", default=[6], help="chunks retrieved")
+    parser.add_argument("--threshold", type=float, nargs="+", default=[0.0], help="minimum relevance of a chunk")
+    parser.add_argument("--rerank", nargs="+", choices=["none", "dedupe"], default=["none"],
+                        help="dedupe keeps the best chunk of each ruling among 3k candidates")
+    parser.add_argument("--topics", type=int, nargs="+", default=[0], help="closest topics searched, 0 for all")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[None], help="ANN candidate list (local store)")
+    parser.add_argument("--exact", choices=["no", "yes", "both"], default="no", help="scan every chunk instead of the ANN index (local store)")
+    parser.add_argument("--rescore-factor", type=int, nargs="+", default=[None], help="int8 candidates re-scored per result (local store)")
+    parser.add_argument("--repeat", type=int, default=3, help="searches timed per question")
+    parser.add_argument("--quality", type=float, default=0.98, help="share of the best recall@k the recommendation keeps")
+    parser.add_argument("--report", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    vectordb = get_vectordb(read_only=True)
+    golden_set = load_golden_set(args.golden_set)
+    cache = EmbeddingCache()
+
+    if args.command == "propose":
+        embeddings = embed_questions([item["question"] for item in golden_set["questions"]], vectordb, cache)
+        proposed = propose(vectordb, golden_set, embeddings)
+        save_golden_set(golden_set, args.golden_set)
+        print(f"Proposed the rulings of {proposed} questions in '{args.golden_set}', review them and set \"reviewed\": true")
+    else:
+        items = [item for item in golden_set["questions"] if item.get("reviewed") and item["expected_doc_ids"]]
+        if not items:
+            raise SystemExit(f"No reviewed questions in '{args.golden_set}', run the propose command and review them first")
+        print(f"Evaluating {len(items)} of {len(golden_set['questions'])} questions, the others are not reviewed")
+        embeddings = embed_questions([item["question"] for item in items], vectordb, cache)
+        router = load_router(embeddings=vectordb.embeddings) if any(args.topics) else None
+        if any(args.topics) and router is None:
+            raise SystemExit("Topic routing needs the centroids, run python topic_router.py build")
+        local = isinstance(vectordb, LocalVectorStore)
+        if not local and (args.ef_search != [None] or args.rescore_factor != [None] or args.exact != "no"):
+            print("Ignoring --ef-search, --exact and --rescore-factor, they only apply to the local store")
+        exact_values = {"no": [False], "yes": [True], "both": [False, True]}[args.exact] if local else [False]
+        configurations = {}
+        for k, threshold, rerank, topics, ef_search, exact, rescore_factor in itertools.product(
+                args.k, args.threshold, args.rerank, args.topics, args.ef_search, exact_values, args.rescore_factor):
+            # ef_search has no effect on an exact search, nor the index parameters on Chroma.
+            configuration = Retrieval(k, threshold, rerank, topics, ef_search if local and not exact else None, exact,
+                                      rescore_factor if local else None)
+            configurations.setdefault(json.dumps(configuration.describe(), sort_keys=True), configuration)
+        configurations = list(configurations.values())
+        rows = mark_pareto(evaluate(vectordb, items, embeddings, configurations, router, args.repeat))
+        recommended = recommend(rows, args.quality)
+        print_table(rows, recommended)
+        if args.report:
+            with open(args.report, "w") as report_file:
+                json.dump({"questions": len(items), "results": rows, "recommended": recommended["configuration"]},
+                          report_file, indent=2)
+    cache.close()
@@ -0,0 +1,179 @@
+"""
+Single-flight coalescing of identical concurrent calls: while a call with a key is running, later calls with the same
+key wait for it and share its result (or its exception) instead of running again. Only concurrent calls are
+coalesced, a call made after the first one finished runs again, so nothing is cached.
+
+The chatbots coalesce three layers, each counted in its own group:
+
+    embedding   the embedding of a query, keyed by model and text
+    search      the vector search of a query, keyed by store, query, k and filter
+    llm         a chat completion, keyed by model, temperature and the exact prompt messages
+
+so a burst of students asking the same templated question makes one embedding request, one search and one call per
+LLM step. `stats()` reports, per group, the calls made, executed and coalesced by this process.
+"""
+import copy
+import json
+import threading
+from collections import Counter
+from typing import Any
+
+from langchain_core.messages import messages_to_dict
+from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_openai import ChatOpenAI
+
+from embedding_cache import model_name
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls of one group.
+
+    Attributes:
+        name (str): The name of the group.
+        counts (Counter): The calls, executed and coalesced calls of the group.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Runs `function`, or waits for the running call with the same key and returns a copy of its result.
+
+        Args:
+            key (str): The key of the call, equal for calls that can share a result.
+            function (callable): The call.
+            *args: The arguments of the call.
+            **kwargs: The keyword arguments of the call.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            Exception: The exception of the call, raised in every coalesced caller.
+        """
+        with self._lock:
+            self.counts["calls"] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.counts["coalesced"] += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.counts["executed"] += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Each caller gets its own copy, the chains set attributes on the results they return.
+            return copy.deepcopy(call.result)
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        Returns:
+            dict: The calls, executed and coalesced calls of the group, the upstream calls saved and the calls in flight.
+        """
+        with self._lock:
+            calls = self.counts["calls"]
+            return {
+                "calls": calls,
+                "executed": self.counts["executed"],
+                "coalesced": self.counts["coalesced"],
+                "coalesced_ratio": self.counts["coalesced"] / calls if calls else 0.0,
+                "in_flight": len(self._calls),
+            }
+
+
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+def group(name):
+    """
+    Returns:
+        SingleFlight: The group with this name, shared by every chatbot of the process.
+    """
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+
+def stats():
+    """
+    Returns:
+        dict: The stats of every group of this process, by name.
+    """
+    with _groups_lock:
+        groups = dict(_groups)
+    return {name: single_flight.stats() for name, single_flight in sorted(groups.items())}
+
+
+def _key(*parts):
+    return json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+
+
+class CoalescingRetriever(VectorStoreRetriever):
+    """
+    Similarity search retriever whose query embeddings and searches are coalesced across the chatbots of the process.
+    With an EmbeddingCache, the embeddings of the questions asked before are read from it instead of the API.
+    """
+
+    embedding_cache: Any = None
+
+    def _compute_embedding(self, model, query):
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get_many(model, [query])[0]
+            if cached is not None:
+                return cached
+        embedding = self.vectorstore.embeddings.embed_query(query)
+        if self.embedding_cache is not None:
+            self.embedding_cache.put_many(model, [query], [embedding])
+        return embedding
+
+    def _embed_query(self, query):
+        model = model_name(self.vectorstore.embeddings)
+        return group("embedding").do(_key(model, query), self._compute_embedding, model, query)
+
+    def _search(self, query, search_kwargs):
+        search_kwargs = dict(search_kwargs)
+        k = search_kwargs.pop("k", 4)
+        return self.vectorstore.similarity_search_by_vector(self._embed_query(query), k=k, **search_kwargs)
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        if self.search_type != "similarity":
+            return super()._get_relevant_documents(query, run_manager=run_manager)
+        key = _key(id(self.vectorstore), query, self.search_kwargs)
+        return group("search").do(key, self._search, query, self.search_kwargs)
+
+
+class CoalescingChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI whose identical concurrent completions, same model, temperature and prompt messages, make one request.
+    """
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = _key(self.model_name, self.temperature, stop, kwargs, messages_to_dict(messages))
+        return group("llm").do(key, super()._generate, messages, stop, run_manager, **kwargs)
@@ -0,0 +1,140 @@
+"""
+Measures the cold start of the API against its budget: the import time of main.py, the time until uvicorn
+answers the first request and the time until the warm-up reports ready.
+
+Usage:
+    python startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+# Budgets in seconds, on a warm filesystem cache.
+IMPORT_BUDGET_SECONDS = 1.5
+FIRST_REQUEST_BUDGET_SECONDS = 3.0
+READY_BUDGET_SECONDS = 15.0
+
+
+def measure_import_time(runs=5):
+    """
+    Imports main.py in fresh interpreters.
+
+    Args:
+        runs (int): The number of interpreters started.
+
+    Returns:
+        float: The median import time in seconds.
+    """
+    code = "import time; start = time.perf_counter(); import main; print(time.perf_counter() - start)"
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        timings.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(timings)
+
+
+def slowest_imports(top=10):
+    """
+    Returns:
+        list: The (cumulative microseconds, module) of the slowest modules imported directly by main.py, from `python -X importtime`.
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        # Nested imports are indented by two spaces per level, after the separator space.
+        rows.append(((len(module) - len(module.lstrip()) - 1) // 2, int(cumulative), module.strip()))
+    # A module is reported after its imports, so the direct imports of main are the depth 1 rows preceding it.
+    main_index = max(index for index, (depth, _, module) in enumerate(rows) if depth == 0 and module == "main")
+    imports = []
+    for depth, cumulative, module in reversed(rows[:main_index]):
+        if depth == 0:
+            break
+        if depth == 1:
+            imports.append((cumulative, module))
+    return sorted(imports, reverse=True)[:top]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout, expected_status=200):
+    """
+    Polls a URL until it answers with the expected status.
+
+    Returns:
+        bool: True if it did before the timeout.
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == expected_status:
+                    return True
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def measure_server_start(timeout=60):
+    """
+    Starts uvicorn and measures the time until /health answers and until /ready answers 200.
+
+    Returns:
+        tuple: The seconds until the first request and until ready, None when not reached before the timeout.
+    """
+    port = free_port()
+    start_time = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy())
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        first_request = time.perf_counter() - start_time if wait_for(f"{base_url}/health", timeout) else None
+        ready = time.perf_counter() - start_time if wait_for(f"{base_url}/ready", timeout) else None
+        if ready is None:
+            try:
+                urllib.request.urlopen(f"{base_url}/ready", timeout=1)
+            except urllib.error.HTTPError as error:
+                print("Not ready:", json.loads(error.read()))
+        return first_request, ready
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the import time and time to first request of main.py.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--skip-ready", action="store_true", help="do not fail when the warm-up (MongoDB, vector store) is not reachable")
+    args = parser.parse_args()
+
+    import_time = measure_import_time(args.runs)
+    first_request, ready = measure_server_start(args.timeout)
+    print("Slowest imports of main.py:")
+    for cumulative, module in slowest_imports():
+        print(f"  {cumulative / 1000:8.1f} ms  {module}")
+
+    results = [("import main", import_time, IMPORT_BUDGET_SECONDS), ("first request", first_request, FIRST_REQUEST_BUDGET_SECONDS)]
+    if not args.skip_ready:
+        results.append(("ready", ready, READY_BUDGET_SECONDS))
+    over_budget = False
+    for name, seconds, budget in results:
+        within = seconds is not None and seconds <= budget
+        over_budget = over_budget or not within
+        measured = f"{seconds:.3f} s" if seconds is not None else "timeout"
+        print(f"{name:<14}{measured:>12}  budget {budget:.1f} s  {'OK' if within else 'OVER BUDGET'}")
+    sys.exit(1 if over_budget else 0)
@@ -0,0 +1,134 @@
+"""
+Conversation memory made of a rolling summary and the last turns of a session, both read from MongoDB.
+
+Each question reads one small summary document and the last `k` turns of the chat history, instead of the whole
+history. The summary is extended after the answer has been returned, by `update_summary` in a background task: the
+turns that left the window since the last update are folded into it with one LLM call, so no request waits for a
+summarization.
+"""
+import json
+import os
+import time
+from typing import Any
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.messages import SystemMessage, get_buffer_string, messages_from_dict
+
+DEFAULT_SUMMARY_COLLECTION = "chat_summaries"
+
+
+class SummaryStore:
+    """
+    MongoDB collection with one document per session: its summary and the number of messages folded into it.
+
+    Attributes:
+        collection (pymongo.collection.Collection): The collection of the summaries.
+    """
+
+    def __init__(self, database, collection_name=None):
+        """
+        Args:
+            database (pymongo.database.Database): The database of the chat history.
+            collection_name (str, optional): The collection. Defaults to SUMMARY_COLLECTION or "chat_summaries".
+        """
+        self.collection = database[collection_name or os.getenv("SUMMARY_COLLECTION", DEFAULT_SUMMARY_COLLECTION)]
+
+    def get(self, session_id):
+        """
+        Returns:
+            dict: The summary and summarized message count of the session, empty for a new session.
+        """
+        document = self.collection.find_one({"_id": session_id}) or {}
+        return {"summary": document.get("summary", ""), "summarized": document.get("summarized", 0)}
+
+    def save(self, session_id, summary, summarized, previous_summarized):
+        """
+        Stores a new summary unless another worker extended the summary of the session meanwhile.
+
+        Args:
+            session_id (str): The id of the session.
+            summary (str): The new summary.
+            summarized (int): The messages folded into the new summary.
+            previous_summarized (int): The messages folded into the summary it extends.
+
+        Returns:
+            bool: True if the summary was stored.
+        """
+        from pymongo.errors import DuplicateKeyError
+
+        try:
+            # Without a matching document the upsert inserts one, which fails if the session has another summary.
+            result = self.collection.update_one(
+                {"_id": session_id, "summarized": previous_summarized},
+                {"$set": {"summary": summary, "summarized": summarized, "updated": time.time()}}, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return result.matched_count > 0 or result.upserted_id is not None
+
+
+class RollingSummaryMemory(BaseChatMemory):
+    """
+    Memory returning the summary of a session followed by its last `k` turns.
+
+    The chat history must be a MongoDBChatMessageHistory, whose messages are read directly from its collection.
+    """
+
+    llm: Any
+    summary_store: Any
+    k: int = 2
+    memory_key: str = "chat_history"
+    # Messages outside the window that trigger a summary update, one turn by default.
+    summarize_every: int = 2
+
+    @property
+    def memory_variables(self):
+        return [self.memory_key]
+
+    def _history_filter(self):
+        return {self.chat_memory.session_id_key: self.chat_memory.session_id}
+
+    def _read_messages(self, skip=0, limit=0, newest_first=False):
+        cursor = self.chat_memory.collection.find(self._history_filter(), {self.chat_memory.history_key: 1})
+        cursor = cursor.sort("_id", -1 if newest_first else 1).skip(skip).limit(limit)
+        items = [json.loads(document[self.chat_memory.history_key]) for document in cursor]
+        return messages_from_dict(items[::-1] if newest_first else items)
+
+    def load_memory_variables(self, inputs):
+        """
+        Reads the summary and the last `k` turns of the session.
+
+        Returns:
+            dict: The messages, or their text when `return_messages` is False, under `memory_key`.
+        """
+        summary = self.summary_store.get(self.chat_memory.session_id)["summary"]
+        messages = self._read_messages(limit=self.k * 2, newest_first=True) if self.k > 0 else []
+        if summary:
+            messages = [SystemMessage(content=f"Summary of the earlier conversation: {summary}")] + messages
+        return {self.memory_key: messages if self.return_messages else get_buffer_string(messages)}
+
+    def update_summary(self):
+        """
+        Folds the messages that left the window since the last update into the summary of the session.
+
+        Returns:
+            bool: True if the summary was updated.
+        """
+        session_id = self.chat_memory.session_id
+        state = self.summary_store.get(session_id)
+        total = self.chat_memory.collection.count_documents(self._history_filter())
+        outside_window = total - self.k * 2
+        if outside_window - state["summarized"] < self.summarize_every:
+            return False
+        new_messages = self._read_messages(skip=state["summarized"], limit=outside_window - state["summarized"])
+        start_time = time.perf_counter()
+        prompt = SUMMARY_PROMPT.format(summary=state["summary"], new_lines=get_buffer_string(new_messages))
+        summary = self.llm.invoke(prompt).content
+        updated = self.summary_store.save(session_id, summary, state["summarized"] + len(new_messages), state["summarized"])
+        print(f"Summary of session {session_id} {'updated' if updated else 'already updated by another worker'} "
+              f"with {len(new_messages)} messages in {time.perf_counter() - start_time:.2f} seconds")
+        return updated
+
+    def clear(self):
+        super().clear()
+        self.summary_store.collection.delete_one({"_id": self.chat_memory.session_id})
@@ -0,0 +1,51 @@
+"""
+Imports two firm documents with the same name from different folders and checks they stay separate documents, in the
+catalog and in the vector store, and that deleting one leaves the other.
+
+Run with `python -m pytest test_bulk_import.py`.
+"""
+from bulk_import import BulkImporter, import_doc_id
+from document_catalog import DocumentCatalog
+from local_vector_store import LocalVectorStore
+from utils_Chromadb import UtilsDB
+
+
+class FakeEmbeddings:
+    """
+    Embeds every text with the same vector, enough to store and delete chunks.
+    """
+    tokens = 0
+
+    def embed_documents(self, texts):
+        return [[1.0, 0.0, 0.0] for _ in texts]
+
+    def report(self):
+        return {}
+
+
+def test_files_with_the_same_name_are_separate_documents(tmp_path):
+    root = tmp_path / "archive"
+    paths = []
+    for folder, text in (("a", "Contrato de arrendamiento del local."), ("b", "Contrato de compraventa del lote.")):
+        (root / folder).mkdir(parents=True)
+        path = root / folder / "contrato.txt"
+        path.write_text(text)
+        paths.append(str(path))
+    store = LocalVectorStore(str(tmp_path / "store"), FakeEmbeddings())
+    catalog = DocumentCatalog(str(tmp_path / "catalog.db"))
+    utils_db = UtilsDB(store, catalog=catalog, embedding_executor=FakeEmbeddings())
+
+    report = BulkImporter(str(root), utils_db, topic="contratos", workers=1).run()
+
+    assert report["files"] == 2
+    doc_ids = [import_doc_id(path) for path in paths]
+    assert len(set(doc_ids)) == 2
+    assert [catalog.file(path)["doc_id"] for path in paths] == doc_ids
+    stored = store.get(include=("metadatas",))["metadatas"]
+    assert sorted(metadata["doc_id"] for metadata in stored) == sorted(doc_ids)
+
+    utils_db.delete_DB_document_and_file(paths[0])
+
+    assert catalog.file(paths[0]) is None
+    assert catalog.file(paths[1])["doc_id"] == doc_ids[1]
+    assert [metadata["source"] for metadata in store.get(include=("metadatas",))["metadatas"]] == [paths[1]]
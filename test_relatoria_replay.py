@@ -0,0 +1,110 @@
+"""
+Fetches two topics concurrently from a fake relatoria while recording them, then fetches them again from
+relatoria_replay_server.py and checks each topic gets its own rulings.
+
+Run with `python -m pytest test_relatoria_replay.py`.
+"""
+import asyncio
+import threading
+import uuid
+from urllib.parse import parse_qs
+
+import httpx
+
+from relatoria_http_fetcher import NEXT_BUTTON_ID, PDF_OPTION_ID, SEARCH_INPUT_ID, RelatoriaHttpFetcher
+from relatoria_replay_server import serve
+
+PATH = "/WebRelatoria/csj/index.xhtml"
+RULINGS = {
+    "Divorcio": ["SC100-2021", "SC101-2021", "SC102-2020"],
+    "PQR": ["STC200-2022", "STC201-2022"],
+}
+SEARCH_PAGE = f"""<html><body>
+<form id="searchForm" action="{PATH}">
+<input type="text" name="{SEARCH_INPUT_ID}" value="">
+<input type="hidden" name="javax.faces.ViewState" value="view-0">
+<button id="searchForm:buscar" name="searchForm:buscar"><span>Buscar</span></button>
+</form>
+<form id="resultForm" action="{PATH}"><input type="hidden" name="javax.faces.ViewState" value="view-0"></form>
+</body></html>"""
+
+
+def result_form(topic, position):
+    rulings = RULINGS[topic]
+    return (f'<form id="resultForm" action="{PATH}">'
+            f'<span id="resultForm:pagText2">Resultado: {position + 1} de {len(rulings)}</span>'
+            f'<div id="resultForm:providencia">Providencia: {rulings[position]}</div>'
+            f'<div id="resultForm:tema">Tema: {topic}</div>'
+            f'<button id="{NEXT_BUTTON_ID}" name="{NEXT_BUTTON_ID}"></button></form>')
+
+
+def partial_response(markup, view_state):
+    return ('<?xml version="1.0" encoding="UTF-8"?><partial-response><changes>'
+            f'<update id="resultForm"><![CDATA[{markup}]]></update>'
+            f'<update id="j_id1:javax.faces.ViewState:0"><![CDATA[{view_state}]]></update>'
+            '</changes></partial-response>')
+
+
+class FakeRelatoria:
+    """
+    Serves the search page, the searches, the paging and the PDF exports of RULINGS, keeping the topic and result
+    of each JSESSIONID, and answers slowly so the topics interleave.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    async def __call__(self, request):
+        await asyncio.sleep(0.01)
+        if request.method == "GET":
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = None
+            return httpx.Response(200, text=SEARCH_PAGE, headers={"content-type": "text/html",
+                                                                  "set-cookie": f"JSESSIONID={session_id}; Path=/"})
+        session_id = request.headers["cookie"].split("JSESSIONID=")[1].split(";")[0]
+        fields = {name: values[0] for name, values in parse_qs(request.content.decode()).items()}
+        if PDF_OPTION_ID in fields:
+            topic, position = self.sessions[session_id]
+            ruling = RULINGS[topic][position]
+            return httpx.Response(200, content=f"%PDF-1.4 {ruling}".encode(), headers={
+                "content-type": "application/pdf", "content-disposition": f'attachment; filename="{ruling}.pdf"'})
+        if fields.get("javax.faces.source") == NEXT_BUTTON_ID:
+            topic, position = self.sessions[session_id]
+            position = min(position + 1, len(RULINGS[topic]) - 1)
+        else:
+            topic, position = fields[SEARCH_INPUT_ID], 0
+        self.sessions[session_id] = (topic, position)
+        return httpx.Response(200, text=partial_response(result_form(topic, position), f"view-{position + 1}"),
+                              headers={"content-type": "text/xml"})
+
+
+def fetch(fetcher):
+    stored = {}
+
+    async def store_document(topic, filename, content):
+        stored.setdefault(topic, {})[filename] = content
+        return True
+
+    results = fetcher.run({topic: len(rulings) for topic, rulings in RULINGS.items()}, store_document)
+    assert results == {topic: len(rulings) for topic, rulings in RULINGS.items()}
+    return stored
+
+
+def test_replay_serves_each_topic_its_own_recording(tmp_path):
+    record_dir = str(tmp_path / "recording")
+    recorded = fetch(RelatoriaHttpFetcher(f"http://relatoria.test{PATH}", max_concurrent_topics=2,
+                                          transport=httpx.MockTransport(FakeRelatoria()), record_dir=record_dir))
+    assert {topic: sorted(files) for topic, files in recorded.items()} == \
+        {topic: sorted(f"{ruling}.pdf" for ruling in rulings) for topic, rulings in RULINGS.items()}
+
+    server = serve(record_dir, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        for _ in range(3):
+            replayed = fetch(RelatoriaHttpFetcher(f"http://127.0.0.1:{server.server_address[1]}{PATH}",
+                                                  max_concurrent_topics=2))
+            assert replayed == recorded
+    finally:
+        server.shutdown()
+        server.server_close()
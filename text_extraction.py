@@ -0,0 +1,227 @@
+"""
+Streams the text of a document page by page instead of loading every page as a Document first, so the memory of an
+ingestion depends on the largest page and the batch size, not on the length of the ruling. The extracted text of a
+pdf or docx is cached next to it (`<file>.txt`, pages separated by form feeds) and read back from the cache while the
+document is unchanged, so re-chunking does not parse the document again.
+"""
+import itertools
+import os
+
+# Pages of the cached text are separated by a form feed, as in the output of `pdftotext`.
+PAGE_SEPARATOR = "\f"
+CACHE_SUFFIX = ".txt"
+CACHED_EXTENSIONS = (".pdf", ".docx", ".doc")
+SUPPORTED_EXTENSIONS = CACHED_EXTENSIONS + (".txt",)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 30
+# Chunks embedded and stored together by `UtilsDB.add_db_doc`.
+BATCH_SIZE = 256
+READ_SIZE = 1 << 16
+# MuPDF keeps the objects of every page it loaded until the document is closed, reopening it every few hundred pages
+# bounds the memory of long rulings.
+PAGES_PER_OPEN = 200
+
+
+def cache_path(path):
+    """
+    Returns:
+        str: The path of the cached text of a pdf or docx, e.g. `SC3727-2021.pdf.txt`.
+    """
+    return path + CACHE_SUFFIX
+
+
+def is_cache_file(path):
+    """
+    Returns:
+        bool: Whether `path` is the cached text of a pdf or docx rather than a text document.
+    """
+    return path.lower().endswith(CACHE_SUFFIX) and path[:-len(CACHE_SUFFIX)].lower().endswith(CACHED_EXTENSIONS)
+
+
+def _cache_is_fresh(path):
+    cache = cache_path(path)
+    return os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path)
+
+
+def _read_cache(path):
+    """
+    Yields the pages of a cached text, reading it in blocks so only one page is held at a time.
+    """
+    with open(cache_path(path), encoding="utf-8") as cache_file:
+        page = ""
+        while True:
+            block = cache_file.read(READ_SIZE)
+            if not block:
+                break
+            page += block
+            *pages, page = page.split(PAGE_SEPARATOR)
+            yield from pages
+        yield page
+
+
+def _parse_pages(path):
+    """
+    Yields the pages of a document, one page of a pdf in memory at a time, the whole text of a docx or txt.
+    """
+    lower_path = path.lower()
+    if lower_path.endswith(".pdf"):
+        import pymupdf
+
+        with pymupdf.open(path) as pdf:
+            total_pages = pdf.page_count
+        for start in range(0, total_pages, PAGES_PER_OPEN):
+            with pymupdf.open(path) as pdf:
+                for number in range(start, min(start + PAGES_PER_OPEN, total_pages)):
+                    yield pdf.load_page(number).get_text()
+    elif lower_path.endswith((".docx", ".doc")):
+        import docx2txt
+
+        yield docx2txt.process(path)
+    elif lower_path.endswith(".txt"):
+        with open(path, encoding="utf-8", errors="replace") as text_file:
+            yield text_file.read()
+    else:
+        raise ValueError(f"File format of '{path}' not supported")
+
+
+def _parse_and_cache(path):
+    """
+    Yields the pages of a document while writing them to its cache, which is only put in place once complete. The
+    cache is best effort: when it cannot be written, e.g. in a read-only archive or a full disk, the pages are still
+    yielded and the document is parsed again next time.
+    """
+    cache = cache_path(path)
+    partial = cache + ".part"
+    try:
+        cache_file = open(partial, "w", encoding="utf-8")
+    except OSError as error:
+        print(f"Not caching the text of '{path}': {error}")
+        yield from _parse_pages(path)
+        return
+    try:
+        for number, text in enumerate(_parse_pages(path)):
+            # A form feed inside a page would split it in two when the cache is read.
+            text = text.replace(PAGE_SEPARATOR, "\n")
+            if cache_file is not None:
+                try:
+                    cache_file.write(text if number == 0 else PAGE_SEPARATOR + text)
+                except OSError as error:
+                    print(f"Not caching the text of '{path}': {error}")
+                    _close_quietly(cache_file)
+                    cache_file = None
+            yield text
+        if cache_file is not None:
+            try:
+                cache_file.close()
+                cache_file = None
+                os.replace(partial, cache)
+            except OSError as error:
+                print(f"Not caching the text of '{path}': {error}")
+    finally:
+        _close_quietly(cache_file)
+        if os.path.exists(partial):
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+
+
+def _close_quietly(cache_file):
+    if cache_file is not None:
+        try:
+            cache_file.close()
+        except OSError:
+            pass
+
+
+def iter_pages(path, use_cache=True):
+    """
+    Yields the text of each page of a document.
+
+    Args:
+        path (str): The path of a pdf, docx or txt file.
+        use_cache (bool): Whether to read and write the cached text of pdf and docx files.
+
+    Yields:
+        str: The text of a page, the whole text for docx and txt files.
+
+    Raises:
+        ValueError: If the file format is not supported.
+    """
+    if not use_cache or not path.lower().endswith(CACHED_EXTENSIONS):
+        yield from _parse_pages(path)
+    elif _cache_is_fresh(path):
+        yield from _read_cache(path)
+    else:
+        yield from _parse_and_cache(path)
+
+
+def page_count(path):
+    """
+    Returns:
+        int: The pages of a pdf, read from its page tree without extracting text, 1 for other documents.
+    """
+    if not path.lower().endswith(".pdf"):
+        return 1
+    import pymupdf
+
+    with pymupdf.open(path) as pdf:
+        return pdf.page_count
+
+
+def iter_chunks(path, metadata=None, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, use_cache=True):
+    """
+    Splits a document into chunks as its pages are read.
+
+    Args:
+        path (str): The path of a pdf, docx or txt file.
+        metadata (dict, optional): Metadata added to every chunk.
+        chunk_size (int): The characters of a chunk.
+        chunk_overlap (int): The characters shared by consecutive chunks.
+        use_cache (bool): Whether to read and write the cached text of pdf and docx files.
+
+    Yields:
+        Document: A chunk with the source, page and total_pages of the page it comes from and `metadata`.
+    """
+    from langchain_core.documents import Document
+    from langchain_text_splitters import CharacterTextSplitter
+
+    splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    total_pages = page_count(path)
+    for number, text in enumerate(iter_pages(path, use_cache)):
+        page_metadata = {"source": path, "file_path": path, "page": number, "total_pages": total_pages, **(metadata or {})}
+        for chunk in splitter.split_text(text):
+            yield Document(page_content=chunk, metadata=dict(page_metadata))
+
+
+def batched(iterable, size=BATCH_SIZE):
+    """
+    Yields lists of up to `size` items of an iterable without consuming it ahead.
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def remove_cache(path):
+    """
+    Deletes the cached text of a document, if any.
+    """
+    if os.path.exists(cache_path(path)):
+        os.remove(cache_path(path))
+
+
+if __name__ == "__main__":
+    import argparse
+    import resource
+    import time
+
+    parser = argparse.ArgumentParser(description="Extract and chunk a document as the ingestion does, printing the peak memory.")
+    parser.add_argument("path")
+    parser.add_argument("--no-cache", action="store_true", help="parse the document even if its text is cached")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    chunks = sum(len(batch) for batch in batched(iter_chunks(args.path, use_cache=not args.no_cache)))
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{chunks} chunks in {time.perf_counter() - start_time:.2f} seconds, peak RSS {peak_mb:.0f} MB")
@@ -0,0 +1,367 @@
+"""
+Routing of questions to the topics the rulings were downloaded for, from precomputed topic centroids.
+
+The offline `build` command averages the normalized embeddings of the chunks of each topic into a centroid, saved
+with NumPy next to the downloads, and lists the questions asked most often per topic in the chat history. At query
+time the embedding of a question is compared with the centroids by one dot product, and the vector search only runs
+over the chunks of the closest topics, a `{"topic": {"$in": [...]}}` filter. When the closest topics hold fewer
+chunks than requested the search runs over the whole store.
+
+At startup `prewarm` embeds the frequent questions, through the embedding cache so they are only sent to the API
+once, and searches them, which loads the pages of the vector store the first questions need.
+
+Usage:
+    python topic_router.py build
+    python topic_router.py route "¿Cómo solicitar la custodia de un menor?"
+    python topic_router.py stats
+"""
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Any
+
+import numpy as np
+
+from embedding_cache import iter_store, model_name
+from single_flight import CoalescingRetriever
+
+DEFAULT_CENTROIDS_PATH = os.path.join("downloads", "topic_centroids.npz")
+DEFAULT_QUESTIONS_PATH = os.path.join("downloads", "frequent_questions.json")
+# Topics a question is routed to.
+TOP_TOPICS = 2
+# Most recent chat messages read to find the frequent questions, and the questions kept per topic.
+HISTORY_MESSAGES = 20000
+QUESTIONS_PER_TOPIC = 5
+
+
+def compute_centroids(vectordb):
+    """
+    Averages the normalized embeddings of the chunks of each topic, chunks without a topic are skipped.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+
+    Returns:
+        tuple: The topics, their normalized centroids as a float32 matrix and their number of chunks.
+    """
+    sums = {}
+    counts = Counter()
+    for batch in iter_store(vectordb, ("metadatas", "embeddings")):
+        for metadata, embedding in zip(batch["metadatas"], batch["embeddings"]):
+            topic = (metadata or {}).get("topic")
+            if not topic:
+                continue
+            vector = np.asarray(embedding, dtype=np.float64)
+            norm = np.linalg.norm(vector)
+            if norm == 0:
+                continue
+            if topic not in sums:
+                sums[topic] = np.zeros_like(vector)
+            sums[topic] += vector / norm
+            counts[topic] += 1
+    topics = sorted(sums)
+    if not topics:
+        return [], np.zeros((0, 0), dtype=np.float32), []
+    centroids = np.stack([sums[topic] / np.linalg.norm(sums[topic]) for topic in topics]).astype(np.float32)
+    return topics, centroids, [counts[topic] for topic in topics]
+
+
+class TopicRouter:
+    """
+    Routes question embeddings to their closest topic centroids.
+
+    Attributes:
+        topics (list): The topics.
+        centroids (np.ndarray): The normalized centroid of each topic.
+        counts (list): The chunks of each topic.
+        model (str): The embedding model of the centroids.
+    """
+
+    def __init__(self, topics, centroids, counts=None, model=None):
+        self.topics = list(topics)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.counts = list(counts) if counts is not None else [0] * len(self.topics)
+        self.model = model
+
+    @classmethod
+    def load(cls, path=DEFAULT_CENTROIDS_PATH):
+        """
+        Raises:
+            FileNotFoundError: If the centroids were not built.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["topics"].tolist(), data["centroids"], data["counts"].tolist(), str(data["model"]))
+
+    def save(self, path=DEFAULT_CENTROIDS_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.part", "wb") as file:
+            np.savez(file, topics=np.array(self.topics), centroids=self.centroids, counts=np.array(self.counts),
+                     model=np.array(self.model or ""))
+        os.replace(f"{path}.part", path)
+
+    def route(self, embedding, top_n=TOP_TOPICS):
+        """
+        Args:
+            embedding (list): The embedding of the question.
+            top_n (int): The topics returned.
+
+        Returns:
+            list: The closest topics and their cosine similarity, closest first.
+        """
+        if not self.topics:
+            return []
+        vector = np.asarray(embedding, dtype=np.float32)
+        scores = self.centroids @ (vector / (np.linalg.norm(vector) or 1.0))
+        top_n = min(top_n, len(self.topics))
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best])]
+        return [(self.topics[index], float(scores[index])) for index in best]
+
+    def topic_filter(self, embedding, top_n=TOP_TOPICS):
+        """
+        Returns:
+            dict or None: The `where` clause restricting a search to the closest topics, None without centroids.
+        """
+        topics = [topic for topic, _ in self.route(embedding, top_n)]
+        if not topics:
+            return None
+        return {"topic": topics[0]} if len(topics) == 1 else {"topic": {"$in": topics}}
+
+
+def _has_topic_condition(where):
+    if not where:
+        return False
+    if "topic" in where:
+        return True
+    return any(_has_topic_condition(clause) for key in ("$and", "$or") for clause in where.get(key, []))
+
+
+def routed_filter(router, embedding, where=None, top_topics=TOP_TOPICS):
+    """
+    Restricts a `where` clause to the topics closest to a question, unless it already filters by topic.
+
+    Returns:
+        dict or None: The routed clause, None when the search is not routed.
+    """
+    if _has_topic_condition(where):
+        return None
+    topic_filter = router.topic_filter(embedding, top_topics)
+    if not topic_filter:
+        return None
+    return {"$and": [where, topic_filter]} if where else topic_filter
+
+
+class TopicRoutedRetriever(CoalescingRetriever):
+    """
+    CoalescingRetriever searching only the chunks of the topics closest to the question, unless the search is
+    already filtered by topic.
+    """
+
+    router: Any
+    top_topics: int = TOP_TOPICS
+
+    def _search(self, query, search_kwargs):
+        search_kwargs = dict(search_kwargs)
+        k = search_kwargs.pop("k", 4)
+        embedding = self._embed_query(query)
+        where = search_kwargs.pop("filter", None)
+        routed = routed_filter(self.router, embedding, where, self.top_topics)
+        if routed:
+            documents = self.vectorstore.similarity_search_by_vector(embedding, k=k, filter=routed, **search_kwargs)
+            if len(documents) >= k:
+                return documents
+        return self.vectorstore.similarity_search_by_vector(embedding, k=k, filter=where, **search_kwargs)
+
+
+def build_retriever(vectordb, search_kwargs, router=None, embedding_cache=None, top_topics=TOP_TOPICS):
+    """
+    Returns:
+        CoalescingRetriever: A TopicRoutedRetriever with a router, a CoalescingRetriever of the whole store otherwise.
+    """
+    if router is None:
+        return CoalescingRetriever(vectorstore=vectordb, search_kwargs=search_kwargs, embedding_cache=embedding_cache)
+    return TopicRoutedRetriever(vectorstore=vectordb, search_kwargs=search_kwargs, embedding_cache=embedding_cache,
+                                router=router, top_topics=top_topics)
+
+
+def load_router(path=DEFAULT_CENTROIDS_PATH, embeddings=None):
+    """
+    Loads the topic centroids if they were built with the model of `embeddings`.
+
+    Returns:
+        TopicRouter or None: The router, None if the centroids are missing or were built with another model.
+    """
+    if not os.path.exists(path):
+        return None
+    router = TopicRouter.load(path)
+    if embeddings is not None and router.model and router.model != model_name(embeddings):
+        print(f"Ignoring the topic centroids of '{path}', built with {router.model} instead of {model_name(embeddings)}")
+        return None
+    return router
+
+
+def frequent_questions(collection, limit=HISTORY_MESSAGES):
+    """
+    Counts the user questions of the most recent chat messages.
+
+    Args:
+        collection (pymongo.collection.Collection): The chat history collection of MongoDBChatMessageHistory.
+        limit (int): The most recent messages read.
+
+    Returns:
+        Counter: The number of times each question was asked.
+    """
+    questions = Counter()
+    for document in collection.find({}, {"History": 1}).sort("_id", -1).limit(limit):
+        message = json.loads(document["History"])
+        if message.get("type") == "human":
+            question = message["data"]["content"].strip()
+            if question:
+                questions[question] += 1
+    return questions
+
+
+def questions_by_topic(router, questions, embeddings, per_topic=QUESTIONS_PER_TOPIC, min_count=2):
+    """
+    Groups the questions asked at least `min_count` times by their closest topic, keeping the most frequent ones.
+
+    Args:
+        router (TopicRouter): The router.
+        questions (Counter): The number of times each question was asked.
+        embeddings (list): The embedding of each question of `questions`, in its order.
+        per_topic (int): The questions kept per topic.
+        min_count (int): The times a question must have been asked.
+
+    Returns:
+        dict: Topic to its questions and their count, most frequent first.
+    """
+    by_topic = defaultdict(list)
+    for (question, count), embedding in zip(questions.items(), embeddings):
+        if count < min_count:
+            continue
+        routes = router.route(embedding, 1)
+        if routes:
+            by_topic[routes[0][0]].append({"question": question, "count": count})
+    return {topic: sorted(items, key=lambda item: -item["count"])[:per_topic] for topic, items in sorted(by_topic.items())}
+
+
+def load_questions(path=DEFAULT_QUESTIONS_PATH, per_topic=QUESTIONS_PER_TOPIC):
+    """
+    Returns:
+        list: The `per_topic` most frequent questions of each topic, empty if they were not listed.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        by_topic = json.load(file)
+    return [item["question"] for items in by_topic.values() for item in items[:per_topic]]
+
+
+def prewarm(retriever, questions, embedding_executor=None):
+    """
+    Embeds and searches the frequent questions, so the first users asking them wait for neither.
+
+    Args:
+        retriever (CoalescingRetriever): The retriever of the chatbots, with the shared embedding cache.
+        questions (list): The questions.
+        embedding_executor (EmbeddingExecutor, optional): Embeds the questions missing from the cache in batches,
+            with the cache of the retriever.
+
+    Returns:
+        float: The seconds the warm-up took.
+    """
+    start_time = time.perf_counter()
+    if embedding_executor is not None and questions:
+        embedding_executor.embed_documents(questions)
+    for question in questions:
+        retriever.invoke(question)
+    elapsed = time.perf_counter() - start_time
+    print(f"Pre-warmed {len(questions)} frequent questions in {elapsed:.2f} seconds")
+    return elapsed
+
+
+def build(vectordb, executor, collection=None, centroids_path=DEFAULT_CENTROIDS_PATH,
+          questions_path=DEFAULT_QUESTIONS_PATH, per_topic=QUESTIONS_PER_TOPIC):
+    """
+    Computes the topic centroids of the store and, with a chat history collection, the frequent questions per topic.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        executor (EmbeddingExecutor): Embeds the frequent questions, with the embedding cache.
+        collection (pymongo.collection.Collection, optional): The chat history collection.
+        centroids_path (str): The file of the centroids.
+        questions_path (str): The file of the frequent questions.
+        per_topic (int): The questions kept per topic.
+
+    Returns:
+        TopicRouter: The router of the new centroids.
+    """
+    start_time = time.perf_counter()
+    topics, centroids, counts = compute_centroids(vectordb)
+    router = TopicRouter(topics, centroids, counts, model_name(vectordb.embeddings))
+    router.save(centroids_path)
+    print(f"Saved the centroids of {len(topics)} topics ({sum(counts)} chunks) to '{centroids_path}' "
+          f"in {time.perf_counter() - start_time:.2f} seconds")
+
+    if collection is not None:
+        questions = frequent_questions(collection)
+        embeddings = executor.embed_documents(list(questions)) if questions else []
+        by_topic = questions_by_topic(router, questions, embeddings, per_topic)
+        os.makedirs(os.path.dirname(os.path.abspath(questions_path)), exist_ok=True)
+        with open(questions_path, "w", encoding="utf-8") as file:
+            json.dump(by_topic, file, ensure_ascii=False, indent=2)
+        print(f"Saved {sum(len(items) for items in by_topic.values())} frequent questions of {len(by_topic)} topics "
+              f"to '{questions_path}'")
+    return router
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the topic centroids and frequent questions, or route a question.")
+    parser.add_argument("command", choices=["build", "route", "stats"])
+    parser.add_argument("question", nargs="?", help="the question to route")
+    parser.add_argument("--centroids", default=DEFAULT_CENTROIDS_PATH)
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS_PATH)
+    parser.add_argument("--top", type=int, default=TOP_TOPICS, help="topics a question is routed to")
+    parser.add_argument("--per-topic", type=int, default=QUESTIONS_PER_TOPIC, help="frequent questions kept per topic")
+    parser.add_argument("--skip-questions", action="store_true", help="only compute the centroids")
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        router = TopicRouter.load(args.centroids)
+        print(f"{len(router.topics)} topics embedded with {router.model}")
+        for topic, count in sorted(zip(router.topics, router.counts), key=lambda item: -item[1]):
+            print(f"{topic}: {count} chunks")
+    else:
+        import openai
+        from dotenv import load_dotenv
+
+        from embedding_cache import EmbeddingCache
+        from embedding_executor import EmbeddingExecutor
+        from utils_Chromadb import get_vectordb
+
+        load_dotenv()
+        openai.api_key = os.getenv("OPENAI_API_KEY")
+        vectordb = get_vectordb(read_only=args.command == "route")
+        cache = EmbeddingCache()
+        if args.command == "build":
+            collection = None
+            if not args.skip_questions:
+                from utils_mongoDb import MongoDBUtils
+                collection = MongoDBUtils().collection
+            build(vectordb, EmbeddingExecutor(vectordb.embeddings, cache=cache), collection, args.centroids,
+                  args.questions, args.per_topic)
+        else:
+            router = TopicRouter.load(args.centroids)
+            retriever = build_retriever(vectordb, {"k": 6}, router, cache, args.top)
+            start_time = time.perf_counter()
+            embedding = retriever._embed_query(args.question)
+            for topic, score in router.route(embedding, args.top):
+                print(f"{topic}: {score:.3f}")
+            documents = retriever.invoke(args.question)
+            print(f"{len(documents)} chunks in {time.perf_counter() - start_time:.2f} seconds")
+            for document in documents:
+                print(f"  {document.metadata.get('topic')}  {document.metadata.get('source')}")
+        cache.close()
@@ -1,16 +1,220 @@
 import os
-from langchain_community.document_loaders import PyMuPDFLoader, Docx2txtLoader, TextLoader
-from langchain.text_splitter import CharacterTextSplitter
-import tiktoken
+import re
 import time
-import openai
+import uuid
 from dotenv import load_dotenv
-from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
-    
+
+# The document loaders, text splitter, tiktoken, Chroma and OpenAI clients are imported where they are used,
+# so importing this module from main.py does not load them before the endpoints that need them.
+
+# Court whose relatoria the crawler downloads from (Corte Suprema de Justicia).
+COURT = "CSJ"
+# Chamber ("sala") of the Corte Suprema encoded in the providencia prefix (SC, STL, AP...).
+CHAMBERS = {"C": "civil", "L": "laboral", "P": "penal"}
+METADATA_FILTER_KEYS = ("topic", "court", "chamber", "year", "doc_id")
+# Vector store behind UtilsDB and the chatbots: "chroma" (abogacia_data) or "local" (memory-mapped, abogacia_local).
+DEFAULT_VECTOR_BACKEND = "chroma"
+# The collection a rebuild or re-index is written to before it replaces the collection of the store.
+REBUILD_SUFFIX = "_rebuild"
+
+
+def get_vectordb(embedding_function=None, backend=None, persist_directory=None, read_only=False):
+    """
+    Opens the vector store selected by the VECTOR_BACKEND environment variable.
+
+    With CHROMA_HOST set, the Chroma store is the collection of a Chroma server (CHROMA_PORT, default 8000) shared by
+    every worker and node, instead of the persisted directory that only one process can use safely.
+
+    Args:
+        embedding_function (Embeddings, optional): The embeddings of the store. Defaults to OpenAIEmbeddings.
+        backend (str, optional): "chroma" or "local". Defaults to VECTOR_BACKEND.
+        persist_directory (str, optional): The directory of the store. Defaults to VECTOR_STORE_DIRECTORY or the backend default.
+        read_only (bool): Whether the process only searches the store. A read-only local store refuses writes and
+            follows the commits of the ingestion writer.
+
+    Returns:
+        VectorStore: The Chroma store or the LocalVectorStore.
+    """
+    backend = backend or os.getenv("VECTOR_BACKEND", DEFAULT_VECTOR_BACKEND)
+    persist_directory = persist_directory or os.getenv("VECTOR_STORE_DIRECTORY")
+    if embedding_function is None:
+        from langchain_openai import OpenAIEmbeddings
+        embedding_function = OpenAIEmbeddings()
+    if backend == "local":
+        from local_vector_store import DEFAULT_PERSIST_DIRECTORY, LocalVectorStore
+        return LocalVectorStore(persist_directory or DEFAULT_PERSIST_DIRECTORY, embedding_function=embedding_function,
+                                quantization=os.getenv("VECTOR_QUANTIZATION") or None, read_only=read_only)
+    if backend != "chroma":
+        raise ValueError(f"Unknown vector backend '{backend}', expected 'chroma' or 'local'")
+    import chromadb
+    from langchain_community.vectorstores import Chroma
+    if os.getenv("CHROMA_HOST"):
+        client = chromadb.HttpClient(host=os.getenv("CHROMA_HOST"), port=int(os.getenv("CHROMA_PORT", 8000)))
+    else:
+        client = chromadb.PersistentClient(path=persist_directory or "abogacia_data")
+    # Opening the store creates its collection when missing, which would hide the rebuilt one.
+    finish_interrupted_swap(client, Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME)
+    return Chroma(client=client, embedding_function=embedding_function)
+
+
+def finish_interrupted_swap(client, name):
+    """
+    Renames the rebuilt collection of a rebuild or re-index that stopped after deleting the old collection and before
+    renaming the new one.
+
+    Args:
+        client (chromadb.ClientAPI): The Chroma client.
+        name (str): The name of the collection of the store.
+
+    Returns:
+        bool: Whether an interrupted swap was finished.
+    """
+    names = [collection.name for collection in client.list_collections()]
+    if name in names or f"{name}{REBUILD_SUFFIX}" not in names:
+        return False
+    print(f"Finishing interrupted rebuild of '{name}'")
+    client.get_collection(f"{name}{REBUILD_SUFFIX}").modify(name=name)
+    return True
+
+
+def vectordb_count(vectordb):
+    """
+    Returns:
+        int: The number of chunks stored in a Chroma store or a LocalVectorStore.
+    """
+    if hasattr(vectordb, "count_live"):
+        return vectordb.count_live()
+    return vectordb._collection.count()
+
+
+def add_embedded_texts(vectordb, texts, embeddings, metadatas, ids=None):
+    """
+    Stores chunks with precomputed embeddings in a Chroma store or a LocalVectorStore.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        texts (list): The text of the chunks.
+        embeddings (list): The embeddings of the chunks.
+        metadatas (list): The metadata of the chunks.
+        ids (list, optional): The ids of the chunks. Defaults to random uuids.
+
+    Returns:
+        list: The ids of the chunks.
+    """
+    ids = ids or [str(uuid.uuid4()) for _ in texts]
+    if hasattr(vectordb, "add_embeddings"):
+        return vectordb.add_embeddings(texts, embeddings, metadatas, ids)
+    batch_size = vectordb._client.get_max_batch_size()
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        vectordb._collection.upsert(ids=ids[start:end], embeddings=embeddings[start:end],
+                                    metadatas=metadatas[start:end], documents=texts[start:end])
+    return ids
+
+
+def delete_source_chunks(vectordb, source):
+    """
+    Deletes the chunks of a file from a Chroma store or a LocalVectorStore.
+
+    Args:
+        vectordb (VectorStore): The Chroma store or the LocalVectorStore.
+        source (str): The path of the file, the "source" metadata of its chunks.
+
+    Returns:
+        int: The number of chunks deleted.
+    """
+    ids = vectordb.get(where={"source": source}, include=[])["ids"]
+    if ids:
+        vectordb.delete(ids)
+    return len(ids)
+
+
+def sanitize_topic(topic):
+    """
+    Sanitizes the topic by replacing spaces with underscores and converting to lowercase.
+
+    Args:
+        topic (str): The topic to sanitize.
+
+    Returns:
+        str: The sanitized topic.
+    """
+    return topic.replace(" ", "_").lower()
+
+
+def document_metadata_from_path(path, topic=None):
+    """
+    Derives the chunk metadata (topic, court, chamber, year and document id) of a downloaded ruling from its path.
+
+    Rulings live in `downloads/<topic>/<providencia>.pdf`, where the providencia number looks like
+    `SC3727-2021` or `STC1234-2020`.
+
+    Args:
+        path (str): The path of the document.
+        topic (str, optional): The topic of the document. Defaults to the folder name under `downloads`.
+
+    Returns:
+        dict: The metadata of the document, without the keys that could not be derived.
+    """
+    parts = os.path.normpath(path).split(os.sep)
+    doc_id = os.path.splitext(parts[-1])[0]
+    metadata = {"doc_id": doc_id}
+
+    if topic is None and "downloads" in parts[:-1]:
+        topic_index = len(parts) - 1 - parts[::-1].index("downloads")
+        if topic_index + 1 < len(parts) - 1:
+            topic = parts[topic_index + 1]
+    if topic:
+        metadata["topic"] = sanitize_topic(topic)
+        metadata["court"] = COURT
+
+    match = re.match(r"^(?:S|A)T?([CLP])\d+", doc_id, re.IGNORECASE)
+    if match:
+        metadata["chamber"] = CHAMBERS[match.group(1).upper()]
+    years = re.findall(r"(?<!\d)(?:19|20)\d{2}(?!\d)", doc_id)
+    if years:
+        metadata["year"] = int(years[-1])
+    return metadata
+
+
+def build_metadata_filter(filters):
+    """
+    Builds a Chroma `where` clause from a dictionary of metadata filters.
+
+    Args:
+        filters (dict): Metadata keys and the values they must be equal to, e.g. {"topic": "Divorcio", "year": 2021}.
+
+    Returns:
+        dict or None: The `where` clause to push down into the vector search, or None if there are no filters.
+    """
+    if not filters:
+        return None
+    conditions = []
+    for key, value in filters.items():
+        if value is None:
+            continue
+        if key not in METADATA_FILTER_KEYS:
+            raise ValueError(f"Unsupported filter '{key}', expected one of {METADATA_FILTER_KEYS}")
+        if key == "topic":
+            value = sanitize_topic(value)
+        elif key == "year":
+            value = int(value)
+        conditions.append({key: value})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
 class UtilsDB():
-    def __init__(self, vectordb:Chroma):
+    def __init__(self, vectordb, catalog=None, embedding_executor=None):
         self.vectordb = vectordb
+        # DocumentCatalog of the downloaded files, opened on the first deletion when not given.
+        self.catalog = catalog
+        # EmbeddingExecutor of the chunks, created from the embeddings of the store and the embedding cache on the first
+        # ingestion when not given.
+        self._embedding_executor = embedding_executor
         self.total_token_count = 0
         self.docs_counter = 0
         
@@ -25,27 +229,34 @@ class UtilsDB():
         Returns:
             dict: A dictionary containing the status and message of the deletion process.
         """
+        from document_catalog import DocumentCatalog, doc_id_from_filename
+        from text_extraction import remove_cache
+
         file_deleted = False
         db_deleted = False
+        if self.catalog is None:
+            self.catalog = DocumentCatalog()
 
-        # Search for the file in the downloaded folders
-        for root, dirs, files in os.walk("./downloads"):
-            if filename in files:
-                file_to_delete = os.path.join(root, filename)
-                os.remove(file_to_delete)
-                file_deleted = True
-                print(f"File '{file_to_delete}' deleted from the folder.")
-                break
+        # Look the file up in the catalog of the downloaded folders
+        entry = self.catalog.file(filename)
+        if entry and entry["path"] and os.path.exists(entry["path"]):
+            os.remove(entry["path"])
+            remove_cache(entry["path"])
+            file_deleted = True
+            print(f"File '{entry['path']}' deleted from the folder.")
 
         if not file_deleted:
             print(f"File '{filename}' not found in the folder.")
 
-        # Retrieve all documents from the database and filter by filename
-        all_documents = self.vectordb.get()
-        matching_ids = [
-            doc_id for doc_id, metadata in zip(all_documents['ids'], all_documents['metadatas'])
-            if metadata['source'].endswith(filename)
-        ]
+        # Query the chunks of the document by their source path, or by document id for chunks stored elsewhere
+        doc_id = entry["doc_id"] if entry else doc_id_from_filename(filename)
+        matching_ids = []
+        if entry and entry["path"]:
+            matching_ids = self.vectordb.get(where={"source": entry["path"]}, include=[])["ids"]
+        if not matching_ids:
+            matching_ids = self.vectordb.get(where={"doc_id": doc_id}, include=[])["ids"]
+        if entry:
+            self.catalog.remove(doc_id)
 
         if matching_ids:
             self.vectordb.delete(matching_ids)
@@ -54,7 +265,7 @@ class UtilsDB():
         else:
             print(f"Document with filename '{filename}' not found in the database.")
 
-        print(f"There are {self.vectordb._collection.count()} documents in the collection after deleting.")
+        print(f"There are {vectordb_count(self.vectordb)} documents in the collection after deleting.")
 
         if file_deleted and db_deleted:
             return {"status": "success", "message": f"Document '{filename}' deleted successfully from both the folder and the database."}
@@ -67,29 +278,36 @@ class UtilsDB():
 
 
 
-    def add_db_doc(self, filename):
+    def add_db_doc(self, filename, metadata=None):
+        """
+        Splits a document into chunks and stores them in the vector database.
+
+        Args:
+            filename (str): The path of the pdf, docx or txt file to store.
+            metadata (dict, optional): Metadata added to every chunk. Defaults to the metadata derived from the path.
+
+        Returns:
+            str: A message with the number of chunks in the database.
+        """
         print("filename",filename)
+        from memory_profiling import track
+        from text_extraction import SUPPORTED_EXTENSIONS, batched, iter_chunks
         if filename:
             doc_path = filename
-            if doc_path.endswith(".pdf"):
-                loader = PyMuPDFLoader(doc_path)
-            elif doc_path.endswith('.docx') or doc_path.endswith('.doc'):
-                loader = Docx2txtLoader(doc_path)
-            elif doc_path.endswith('.txt'):
-                loader = TextLoader(doc_path)
-            else:
+            if not doc_path.endswith(SUPPORTED_EXTENSIONS):
                 print("file format not supported")
                 return
-            
-            doc = loader.load()
 
-            # Implementing the text splitter
-            text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=30)
-            documents_split = text_splitter.split_documents(doc)
-            if documents_split:
-                self.vectordb.add_documents(documents_split)
+            if metadata is None:
+                metadata = document_metadata_from_path(doc_path)
+            # Pages are read and split as the batches are stored, so only one batch of chunks is in memory.
+            tokens_before = self.embedding_executor.tokens
+            with track("add_db_doc"):
+                for documents in batched(iter_chunks(doc_path, metadata)):
+                    self.add_documents(documents)
+            self.total_token_count += self.embedding_executor.tokens - tokens_before
 
-            result = f"stored in database: {filename} file number {self.vectordb._collection.count()}"
+            result = f"stored in database: {filename} file number {vectordb_count(self.vectordb)}, {self.embedding_executor.tokens - tokens_before} tokens embedded"
             print(result)
             self.docs_counter += 1
             return result
@@ -97,7 +315,30 @@ class UtilsDB():
             print("failed to store document, filename doesn't exist")
 
 
+    @property
+    def embedding_executor(self):
+        if self._embedding_executor is None:
+            from embedding_cache import EmbeddingCache
+            from embedding_executor import EmbeddingExecutor
+            self._embedding_executor = EmbeddingExecutor(self.vectordb.embeddings, cache=EmbeddingCache())
+        return self._embedding_executor
+
+    def add_documents(self, documents):
+        """
+        Embeds chunks in token packed parallel requests and stores them with their embeddings.
+
+        Args:
+            documents (list): The chunks as LangChain Documents.
+
+        Returns:
+            list: The ids of the stored chunks.
+        """
+        texts = [document.page_content for document in documents]
+        embeddings = self.embedding_executor.embed_documents(texts)
+        return add_embedded_texts(self.vectordb, texts, embeddings, [document.metadata for document in documents])
+
     def num_tokens_from_string(self, string: str) -> int:
+        import tiktoken
         encoding = tiktoken.get_encoding('cl100k_base')
         num_tokens = len(encoding.encode(string))
         return num_tokens
@@ -146,13 +387,42 @@ class UtilsDB():
     #     num_sources = len(sources)
 
     #     return num_sources,num_docs
-    def ask_vector_db(self,question):
+    def backfill_metadata(self, batch_size=500):
+        """
+        Adds the topic, court, year and document id metadata to the chunks stored before it was recorded,
+        deriving it from their `downloads/<topic>/` source paths.
+
+        Args:
+            batch_size (int): The number of chunks updated per database call.
+
+        Returns:
+            int: The number of chunks updated.
+        """
+        data = self.vectordb.get(include=["metadatas"])
+        ids = []
+        metadatas = []
+        for doc_id, metadata in zip(data["ids"], data["metadatas"]):
+            derived = document_metadata_from_path(metadata.get("source", ""))
+            missing = {key: value for key, value in derived.items() if key not in metadata}
+            if missing:
+                ids.append(doc_id)
+                metadatas.append({**metadata, **missing})
+
+        for start in range(0, len(ids), batch_size):
+            if hasattr(self.vectordb, "update_metadatas"):
+                self.vectordb.update_metadatas(ids[start:start + batch_size], metadatas[start:start + batch_size])
+            else:
+                self.vectordb._collection.update(ids=ids[start:start + batch_size], metadatas=metadatas[start:start + batch_size])
+        print(f"Backfilled metadata of {len(ids)} chunks out of {len(data['ids'])}")
+        return len(ids)
+
+    def ask_vector_db(self,question, filters=None):
 
         start_time = time.time()
 
 
 
-        docs = self.vectordb.similarity_search_with_relevance_scores(question)
+        docs = self.vectordb.similarity_search_with_relevance_scores(question, filter=build_metadata_filter(filters))
         end_time = time.time()
 
         output_markdown = f"result took: {end_time - start_time:.4f} seconds\n```\n"
@@ -166,12 +436,22 @@ class UtilsDB():
         return docs
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Utilities for the abogacia_data vector database.")
+    parser.add_argument("command", nargs="?", default="stats", choices=["stats", "backfill_metadata"],
+                        help="stats: print the sources and run a sample question, backfill_metadata: derive the metadata of existing chunks from their paths")
+    args = parser.parse_args()
 
+    import openai
 
     load_dotenv()
     openai.api_key = os.getenv("OPENAI_API_KEY")
-    vectordb = Chroma(persist_directory="abogacia_data",embedding_function=OpenAIEmbeddings())   
+    vectordb = get_vectordb()
     utils_db = UtilsDB(vectordb)
+    if args.command == "backfill_metadata":
+        utils_db.backfill_metadata()
+        raise SystemExit(0)
     num_sources_urls, num_docs_urls, num_sources_non_urls, num_docs_non_urls = utils_db.number_of_sources_docs()
     print(f"num_sources_urls: {num_sources_urls}, num_docs_urls: {num_docs_urls},num_sources_non_urls: {num_sources_non_urls}, num_docs_non_urls: {num_docs_non_urls} ")
     # question = "tengo un caso de una separacion en curso, una de las personas fallecio, como funcionaria la separacion de bienes en ese proceso?"
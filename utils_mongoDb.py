@@ -42,6 +42,18 @@ class MongoDBUtils():
 
 
     
+    def session_exists(self, session_id):
+        """
+        Checks whether a session has messages, through the SessionId index of the chat history collection.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            bool: True if the session has at least one message.
+        """
+        return self.collection.find_one({"SessionId": session_id}, {"_id": 1}) is not None
+
     def get_unique_session_ids(self):
         unique_session_ids = self.collection.distinct("SessionId")
         print("unique_session_ids", unique_session_ids)
@@ -0,0 +1,355 @@
+"""
+Maintenance tooling for the HNSW index of the persisted Chroma store in abogacia_data.
+
+Reports index stats, rebuilds (compacts) the index with new HNSW parameters and benchmarks
+recall@k and latency of the approximate search against an exact search on the stored embeddings.
+Run it while the API and the downloader are stopped, Chroma does not support concurrent writers.
+"""
+import argparse
+import os
+import pickle
+import sqlite3
+import time
+
+import chromadb
+import numpy as np
+
+from utils_Chromadb import REBUILD_SUFFIX, finish_interrupted_swap
+
+DEFAULT_PERSIST_DIRECTORY = "abogacia_data"
+# Name of the collection created by langchain_community.vectorstores.Chroma.
+DEFAULT_COLLECTION_NAME = "langchain"
+# Chroma collection metadata keys of the HNSW parameters and their defaults.
+HNSW_PARAMS = {
+    "space": ("hnsw:space", "l2"),
+    "M": ("hnsw:M", 16),
+    "ef_construction": ("hnsw:construction_ef", 100),
+    "ef_search": ("hnsw:search_ef", 10),
+}
+
+
+def exact_search(embeddings, queries, k, space="l2"):
+    """
+    Finds the exact k nearest neighbours of each query with a brute force search.
+
+    Args:
+        embeddings (np.ndarray): The (n, dim) matrix of stored embeddings.
+        queries (np.ndarray): The (q, dim) matrix of query embeddings.
+        k (int): The number of neighbours to return.
+        space (str): The distance of the index: "l2", "cosine" or "ip".
+
+    Returns:
+        np.ndarray: The (q, k) row indexes of the neighbours, closest first.
+    """
+    if space == "cosine":
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        distances = -queries @ embeddings.T
+    elif space == "ip":
+        distances = -queries @ embeddings.T
+    else:
+        distances = (queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ embeddings.T + (embeddings ** 2).sum(axis=1)
+    k = min(k, embeddings.shape[0])
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, nearest, axis=1).argsort(axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def directory_size(path):
+    """
+    Computes the size on disk of a file or directory.
+
+    Args:
+        path (str): The path of the file or directory.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            total += os.path.getsize(os.path.join(root, filename))
+    return total
+
+
+class VectorIndexMaintenance:
+    """
+    A class to inspect, rebuild and benchmark the HNSW index of a persisted Chroma collection.
+
+    Attributes:
+        persist_directory (str): The directory of the persisted Chroma store.
+        collection_name (str): The name of the collection.
+        client (chromadb.PersistentClient): The Chroma client of the store.
+    """
+
+    def __init__(self, persist_directory=DEFAULT_PERSIST_DIRECTORY, collection_name=DEFAULT_COLLECTION_NAME):
+        """
+        Opens the persisted Chroma store, finishing a rebuild that was interrupted before the swap.
+
+        Args:
+            persist_directory (str): The directory of the persisted Chroma store.
+            collection_name (str): The name of the collection.
+        """
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        finish_interrupted_swap(self.client, collection_name)
+        self.collection = self.client.get_collection(collection_name)
+
+    @property
+    def rebuild_name(self):
+        return f"{self.collection_name}{REBUILD_SUFFIX}"
+
+    def hnsw_params(self, collection=None):
+        """
+        Returns the HNSW parameters of a collection, filling the ones it does not set with Chroma's defaults.
+
+        Args:
+            collection (chromadb.Collection, optional): The collection. Defaults to the maintained collection.
+
+        Returns:
+            dict: The space, M, ef_construction and ef_search of the collection.
+        """
+        metadata = (collection or self.collection).metadata or {}
+        return {name: metadata.get(key, default) for name, (key, default) in HNSW_PARAMS.items()}
+
+    def vector_segment_directory(self):
+        """
+        Finds the directory holding the HNSW files (header.bin, link_lists.bin, length.bin...) of the collection.
+
+        Returns:
+            str or None: The directory, or None if the index has not been persisted yet.
+        """
+        connection = sqlite3.connect(os.path.join(self.persist_directory, "chroma.sqlite3"))
+        try:
+            rows = connection.execute(
+                "SELECT id FROM segments WHERE collection = ? AND scope = 'VECTOR'", (str(self.collection.id),)
+            ).fetchall()
+        finally:
+            connection.close()
+        for (segment_id,) in rows:
+            segment_dir = os.path.join(self.persist_directory, segment_id)
+            if os.path.isdir(segment_dir):
+                return segment_dir
+        return None
+
+    def index_stats(self):
+        """
+        Reports the element count, deleted ratio, HNSW parameters and size on disk of the index.
+
+        Returns:
+            dict: The stats of the index.
+        """
+        stats = {"element_count": self.collection.count(), **self.hnsw_params()}
+        segment_dir = self.vector_segment_directory()
+        stats["index_directory"] = segment_dir
+        stats["index_size_bytes"] = directory_size(segment_dir) if segment_dir else 0
+        stats["store_size_bytes"] = directory_size(self.persist_directory)
+
+        metadata_path = os.path.join(segment_dir, "index_metadata.pickle") if segment_dir else None
+        if metadata_path and os.path.exists(metadata_path):
+            with open(metadata_path, "rb") as metadata_file:
+                persistent_data = pickle.load(metadata_file)
+            # Every element ever added took a new label, deleted ones stay in the index as tombstones. The pickle is only
+            # synced on adds and updates, so the live count comes from the collection, which is current. Adds not synced
+            # yet (at most hnsw:sync_threshold) make the deleted count an underestimate, never an overestimate.
+            total_added = persistent_data.total_elements_added
+            deleted = max(0, total_added - stats["element_count"])
+            stats["total_elements_added"] = total_added
+            stats["deleted_elements"] = deleted
+            stats["deleted_ratio"] = deleted / total_added if total_added else 0.0
+        return stats
+
+    def print_index_stats(self):
+        stats = self.index_stats()
+        for key, value in stats.items():
+            if isinstance(value, float):
+                value = f"{value:.2%}" if key.endswith("ratio") else f"{value:.4f}"
+            print(f"{key}: {value}")
+        return stats
+
+    def load_collection(self, collection=None, batch_size=1000, include=("embeddings", "documents", "metadatas")):
+        """
+        Loads the whole content of a collection in batches.
+
+        Args:
+            collection (chromadb.Collection, optional): The collection. Defaults to the maintained collection.
+            batch_size (int): The number of elements read per call.
+            include (tuple): The fields to load besides the ids.
+
+        Returns:
+            dict: The ids and the requested fields of every element.
+        """
+        collection = collection or self.collection
+        data = {"ids": [], **{field: [] for field in include}}
+        for offset in range(0, collection.count(), batch_size):
+            batch = collection.get(include=list(include), limit=batch_size, offset=offset)
+            data["ids"].extend(batch["ids"])
+            for field in include:
+                data[field].extend(batch[field])
+        return data
+
+    def rebuild(self, M=None, ef_construction=None, ef_search=None, space=None, batch_size=1000):
+        """
+        Rebuilds the index into a new collection with the given HNSW parameters and swaps it in,
+        which drops the tombstones left by deletions.
+
+        Args:
+            M (int, optional): The number of links per node. Defaults to the current value.
+            ef_construction (int, optional): The size of the candidate list while building. Defaults to the current value.
+            ef_search (int, optional): The size of the candidate list while searching. Defaults to the current value.
+            space (str, optional): The distance: "l2", "cosine" or "ip". Defaults to the current value.
+            batch_size (int): The number of elements copied per call.
+
+        Returns:
+            dict: The stats of the rebuilt index.
+        """
+        params = self.hnsw_params()
+        overrides = {"M": M, "ef_construction": ef_construction, "ef_search": ef_search, "space": space}
+        params.update({name: value for name, value in overrides.items() if value is not None})
+        metadata = {key: value for key, value in (self.collection.metadata or {}).items() if not key.startswith("hnsw:")}
+        metadata.update({HNSW_PARAMS[name][0]: value for name, value in params.items()})
+
+        print(f"Rebuilding '{self.collection_name}' with {params}")
+        start_time = time.time()
+        if self.rebuild_name in [collection.name for collection in self.client.list_collections()]:
+            self.client.delete_collection(self.rebuild_name)
+        rebuilt = self.client.create_collection(self.rebuild_name, metadata=metadata)
+
+        count = self.collection.count()
+        for offset in range(0, count, batch_size):
+            batch = self.collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+            rebuilt.add(ids=batch["ids"], embeddings=batch["embeddings"], documents=batch["documents"], metadatas=batch["metadatas"])
+            print(f"Copied {min(offset + batch_size, count)}/{count} elements")
+
+        if rebuilt.count() != count:
+            self.client.delete_collection(self.rebuild_name)
+            raise RuntimeError(f"Rebuild copied {rebuilt.count()} elements instead of {count}, the index was left untouched")
+
+        self.client.delete_collection(self.collection_name)
+        rebuilt.modify(name=self.collection_name)
+        self.collection = self.client.get_collection(self.collection_name)
+        self.vacuum()
+        print(f"Rebuild took {time.time() - start_time:.2f} seconds")
+        return self.index_stats()
+
+    def vacuum(self):
+        """
+        Reclaims the space of the sqlite file of the store, which keeps the pages freed by deletions and rebuilds.
+        """
+        connection = sqlite3.connect(os.path.join(self.persist_directory, "chroma.sqlite3"))
+        try:
+            connection.execute("VACUUM")
+        finally:
+            connection.close()
+
+    def benchmark(self, k=6, num_queries=100, ef_search_values=(10, 50, 100, 200), M=None, ef_construction=None, seed=0):
+        """
+        Measures recall@k and latency of the approximate search against an exact search, using a sample of the
+        stored embeddings as queries. The current index is measured as is, and every ef_search value is measured
+        on an in-memory copy built with the given M and ef_construction.
+
+        Args:
+            k (int): The number of neighbours retrieved per query.
+            num_queries (int): The number of sampled queries.
+            ef_search_values (tuple): The ef_search values to sweep.
+            M (int, optional): The M of the in-memory copies. Defaults to the current value.
+            ef_construction (int, optional): The ef_construction of the in-memory copies. Defaults to the current value.
+            seed (int): The seed of the query sample.
+
+        Returns:
+            list: One dict per configuration with its recall@k, mean and p95 latency in milliseconds.
+        """
+        data = self.load_collection(include=("embeddings",))
+        ids = np.array(data["ids"])
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        if len(ids) == 0:
+            print("The collection is empty, nothing to benchmark")
+            return []
+        params = self.hnsw_params()
+        rng = np.random.default_rng(seed)
+        query_rows = rng.choice(len(ids), size=min(num_queries, len(ids)), replace=False)
+        queries = embeddings[query_rows]
+
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            exact_search(embeddings, query[None, :], k, params["space"])
+            latencies.append(time.perf_counter() - start_time)
+        expected = ids[exact_search(embeddings, queries, k, params["space"])]
+        results = [self._benchmark_row("exact", params, expected, expected, latencies)]
+        results.append(self._benchmark_collection("current index", self.collection, params, queries, expected, k))
+
+        memory_client = chromadb.EphemeralClient()
+        for ef_search in ef_search_values:
+            config = dict(params, ef_search=ef_search)
+            if M is not None:
+                config["M"] = M
+            if ef_construction is not None:
+                config["ef_construction"] = ef_construction
+            name = f"benchmark_{config['M']}_{config['ef_construction']}_{ef_search}"
+            collection = memory_client.create_collection(name, metadata={HNSW_PARAMS[key][0]: value for key, value in config.items()})
+            for start in range(0, len(ids), 1000):
+                collection.add(ids=data["ids"][start:start + 1000], embeddings=embeddings[start:start + 1000].tolist())
+            results.append(self._benchmark_collection("in-memory copy", collection, config, queries, expected, k))
+            memory_client.delete_collection(name)
+
+        print(f"{'index':<16}{'M':>6}{'ef_c':>7}{'ef_s':>7}{f'recall@{k}':>11}{'mean ms':>10}{'p95 ms':>9}")
+        for row in results:
+            print(f"{row['index']:<16}{row['M']:>6}{row['ef_construction']:>7}{row['ef_search']:>7}"
+                  f"{row['recall']:>11.3f}{row['mean_ms']:>10.2f}{row['p95_ms']:>9.2f}")
+        return results
+
+    def _benchmark_collection(self, label, collection, params, queries, expected, k):
+        found = []
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+            latencies.append(time.perf_counter() - start_time)
+            found.append(result["ids"][0])
+        return self._benchmark_row(label, params, found, expected, latencies)
+
+    @staticmethod
+    def _benchmark_row(label, params, found, expected, latencies):
+        hits = sum(len(set(found_ids) & set(expected_ids)) for found_ids, expected_ids in zip(found, expected))
+        total = sum(len(expected_ids) for expected_ids in expected)
+        latencies_ms = np.array(latencies) * 1000
+        return {
+            "index": label,
+            "M": params["M"],
+            "ef_construction": params["ef_construction"],
+            "ef_search": params["ef_search"] if label != "exact" else "-",
+            "recall": hits / total if total else 0.0,
+            "mean_ms": float(latencies_ms.mean()),
+            "p95_ms": float(np.percentile(latencies_ms, 95)),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance of the HNSW index of the abogacia_data Chroma store.")
+    parser.add_argument("command", choices=["stats", "rebuild", "benchmark"],
+                        help="stats: report the index, rebuild: compact the index and apply new HNSW parameters, benchmark: recall@k vs latency against exact search")
+    parser.add_argument("--persist-directory", default=DEFAULT_PERSIST_DIRECTORY)
+    parser.add_argument("--collection", default=DEFAULT_COLLECTION_NAME)
+    parser.add_argument("--M", type=int)
+    parser.add_argument("--ef-construction", type=int)
+    parser.add_argument("--ef-search", type=int, nargs="+", help="ef_search of the rebuilt index, or the values swept by benchmark")
+    parser.add_argument("--space", choices=["l2", "cosine", "ip"])
+    parser.add_argument("--k", type=int, default=6)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    maintenance = VectorIndexMaintenance(args.persist_directory, args.collection)
+    if args.command == "stats":
+        maintenance.print_index_stats()
+    elif args.command == "rebuild":
+        maintenance.print_index_stats()
+        maintenance.rebuild(M=args.M, ef_construction=args.ef_construction,
+                            ef_search=args.ef_search[0] if args.ef_search else None, space=args.space)
+        maintenance.print_index_stats()
+    else:
+        maintenance.benchmark(k=args.k, num_queries=args.queries, ef_search_values=args.ef_search or (10, 50, 100, 200),
+                              M=args.M, ef_construction=args.ef_construction)